@@ -0,0 +1,184 @@
+'''
+Compiler benchmarks. Generates synthetic scripts of increasing size, times
+each phase of the compile, and compares the results against a baseline.
+'''
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import subscript.compile
+
+# Python refuses to parse more than 100 levels of indentation
+max_depth = 50
+
+def messages(size):
+    '''
+    A long, flat script with a distinct message for every line.
+    '''
+    lines = []
+    for i in range(size):
+        lines.append('message("Message number {} of the benchmark")'.format(i))
+    lines.append('exit')
+    return '\n'.join(lines) + '\n'
+
+def nested(size):
+    '''
+    Blocks of deeply nested if and while statements.
+    '''
+    lines = []
+    for block in range(0, size, max_depth):
+        depth = min(max_depth, size - block)
+        for level in range(depth):
+            indent = '    ' * level
+            var = 0x4000 + (block + level) % 0x100
+            lines.append('{}v{} = Var(0x{:X})'.format(indent, level, var))
+            if level % 2:
+                lines.append('{}while v{} < {}:'.format(indent, level, level))
+            else:
+                lines.append('{}if v{} == {}:'.format(indent, level, level))
+        lines.append('{}message("Deepest point of block {}")'.format('    ' * depth, block))
+    lines.append('exit')
+    return '\n'.join(lines) + '\n'
+
+def functions(size):
+    '''
+    Many small function definitions, each called once.
+    '''
+    lines = []
+    for i in range(size):
+        lines.append('def function{}():'.format(i))
+        lines.append('    v = Var(0x{:X})'.format(0x4000 + i % 0x100))
+        lines.append('    if v == {}:'.format(i % 0x100))
+        lines.append('        message("Function number {}")'.format(i))
+        lines.append('    v = {}'.format(i % 0x100))
+    for i in range(size):
+        lines.append('function{}()'.format(i))
+    lines.append('exit')
+    return '\n'.join(lines) + '\n'
+
+corpora = {
+    'messages': messages,
+    'nested': nested,
+    'functions': functions,
+}
+
+phases = ['parse', 'codegen', 'optimize', 'link', 'bytecode']
+
+def run(source, repeat, mode='debug'):
+    '''
+    Compile `source` `repeat` times, and return the best time of each phase.
+    '''
+    best = {}
+    for _ in range(repeat):
+        c = subscript.compile.Compile(source, 0x08740000, mode=mode)
+        c.link()
+        c.bytecode()
+
+        for phase in phases:
+            best[phase] = min(best.get(phase, float('inf')), c.timings[phase])
+
+    best['total'] = sum(best[phase] for phase in phases)
+    return best
+
+def scaling(results):
+    '''
+    Estimate how each phase grows with the size of the input. The exponent is
+    about 1 for linear phases and about 2 for quadratic ones.
+    '''
+    out = {}
+    for name, sizes in results.items():
+        order = sorted(sizes, key=int)
+        out[name] = {}
+        for phase in phases + ['total']:
+            small, large = sizes[order[0]][phase], sizes[order[-1]][phase]
+            if len(order) < 2 or small <= 0 or large <= 0:
+                continue
+            ratio = int(order[-1]) / int(order[0])
+            out[name][phase] = math.log(large / small) / math.log(ratio)
+    return out
+
+def compare(results, baseline, tolerance, floor=0.001):
+    '''
+    Return a list of (corpus, size, phase, ratio) for every timing that got
+    slower than the baseline by more than `tolerance`. Timings shorter than
+    `floor` seconds are too noisy to compare.
+    '''
+    out = []
+    for name, sizes in results.items():
+        for size, timings in sizes.items():
+            try:
+                old = baseline['results'][name][size]
+            except KeyError:
+                continue
+            for phase in phases + ['total']:
+                if old.get(phase, 0) > floor and timings[phase] / old[phase] > tolerance:
+                    out.append((name, size, phase, timings[phase] / old[phase]))
+    return out
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Subscript compiler benchmarks.')
+    parser.add_argument('--corpus', metavar='name', dest='corpora', action='append', choices=sorted(corpora), help='only run this corpus (may be repeated)')
+    parser.add_argument('--sizes', metavar='n', dest='sizes', type=int, nargs='+', default=[250, 500, 1000, 2000], help='corpus sizes to generate')
+    parser.add_argument('--repeat', metavar='n', dest='repeat', type=int, default=3, help='compiles per corpus, the best time is kept')
+    parser.add_argument('--output', metavar='file', dest='output', help='write the results as JSON')
+    parser.add_argument('--baseline', metavar='file', dest='baseline', type=open, help='compare against results from an earlier run')
+    parser.add_argument('--tolerance', metavar='ratio', dest='tolerance', type=float, default=1.25, help='slowdown against the baseline that counts as a regression')
+    parser.add_argument('--max-exponent', metavar='n', dest='exponent', type=float, default=1.5, help='growth exponent that counts as a scaling regression')
+    parser.add_argument('--mode', choices=['debug', 'release'], default='debug', help='compile mode to benchmark')
+    parser.add_argument('--save-corpus', metavar='dir', dest='save', help='write the generated scripts to this directory')
+
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.corpora or sorted(corpora):
+        results[name] = {}
+        for size in args.sizes:
+            source = corpora[name](size)
+
+            if args.save:
+                path = os.path.join(args.save, '{}-{}.sub'.format(name, size))
+                with open(path, 'w') as file:
+                    file.write(source)
+
+            timings = run(source, args.repeat, args.mode)
+            results[name][str(size)] = timings
+            print('{:10} {:6}  {}'.format(name, size, '  '.join(
+                '{} {:.4f}s'.format(phase, timings[phase]) for phase in phases + ['total'])))
+
+    growth = scaling(results)
+    failed = False
+
+    print()
+    for name, exponents in sorted(growth.items()):
+        for phase, exponent in sorted(exponents.items()):
+            flag = ''
+            if exponent > args.exponent:
+                flag = '  <- superlinear'
+                failed = True
+            print('{:10} {:8} grows as n^{:.2f}{}'.format(name, phase, exponent, flag))
+
+    if args.baseline:
+        baseline = json.load(args.baseline)
+        regressions = compare(results, baseline, args.tolerance)
+
+        print()
+        for name, size, phase, ratio in regressions:
+            print('{:10} {:6} {:8} {:.2f}x slower than baseline'.format(name, size, phase, ratio))
+        if not regressions:
+            print('No regressions against baseline')
+        failed = failed or bool(regressions)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'time': time.time(),
+                'python': sys.version,
+                'results': results,
+                'scaling': growth,
+            }, file, indent=4, sort_keys=True)
+
+    sys.exit(1 if failed else 0)
@@ -1,38 +1,306 @@
 import subscript.compile
+import subscript.content
+import subscript.freespace
+import subscript.journal
+import subscript.link
+import subscript.patch
+import subscript.pointers
+import subscript.profiler
+import subscript.project
+import subscript.resolver
+import subscript.server
+import subscript.targets
 import argparse
+import json
+import os
+import sys
 import time
 
+def number(value):
+    # Accept hexadecimal offsets as well as decimal ones
+    return int(value, 0)
+
 parser = argparse.ArgumentParser(description='Pokescript compiler.')
 
-parser.add_argument('script', metavar='script', type=open, help='the script to compile')
+parser.add_argument('script', metavar='script', type=open, nargs='?', help='the script to compile')
+parser.add_argument('--path', metavar='dir', dest='path', action='append', help='look for imports in this directory (may be repeated)')
 parser.add_argument('--raw', metavar='file', dest='out_raw', type=argparse.FileType('wb'), help='write the compiled binary to a raw file')
 parser.add_argument('--rom', metavar='file', dest='out_rom', type=argparse.FileType('rb+'), help='write the compiled binary to a ROM')
-parser.add_argument('--offset', metavar='offset', dest='offset', type=int, default=0x740000, help='offset for ROM writing')
+parser.add_argument('--patch', metavar='file', dest='out_patch', help='write an IPS, UPS or BPS patch against --rom instead of changing it')
+parser.add_argument('--offset', metavar='offset', dest='offset', type=number, default=None, help='offset for ROM writing (default: find free space, or 0x740000 without --rom)')
+parser.add_argument('--search', metavar='offset', dest='search', type=number, default=None, help='offset to start looking for free space from')
+parser.add_argument('--align', metavar='bytes', dest='align', type=number, default=4, help='alignment of automatically placed scripts')
+parser.add_argument('--reuse', dest='reuse', action='store_true', help='point at strings and movements that already exist in the ROM')
+parser.add_argument('--best-fit', dest='strategy', action='store_const', const='best', default='first', help='place scripts in the smallest free block that fits')
+parser.add_argument('--object', metavar='file', dest='out_object', help='write a relocatable object that can be placed later with --link')
+parser.add_argument('--link', metavar='object', dest='link', nargs='+', help='place these objects in --rom and resolve the pointers between them')
+parser.add_argument('--build', metavar='manifest', dest='build', help='rebuild the scripts of a project whose inputs changed')
+parser.add_argument('--jobs', metavar='n', dest='jobs', type=int, default=None, help='compiles to run at once for --build and --target (default: one per processor)')
+parser.add_argument('--no-optimize', dest='optimize', action='store_false', help='compile functions and calls exactly as written')
+parser.add_argument('--release', dest='mode', action='store_const', const='release', default='debug', help="don't keep debug information, to save memory")
+parser.add_argument('--prefer', choices=['speed', 'size'], default='speed', help='unroll loops for speed, or only when that saves space')
+parser.add_argument('--map', metavar='file', dest='map', help='write the source map here (default: next to the raw file or patch, or in a .maps directory next to --rom)')
+parser.add_argument('--check', metavar='format', dest='check', nargs='?', const='text', choices=['text', 'json'], help='only report every error and warning in the script, as text or JSON')
+parser.add_argument('--target', metavar='code[=rom]', dest='targets', action='append', help="compile for this game code, reading tables from the ROM if given (may be repeated, or 'all')")
+parser.add_argument('--output-dir', metavar='dir', dest='output_dir', default='.', help='where --target writes a raw file and source map for each game')
+parser.add_argument('--serve', metavar='address', dest='serve', help='run a compile daemon on this Unix socket path or host:port, see subscript.server')
+parser.add_argument('--listing', metavar='format', dest='listing', choices=['text', 'json', 'xse'], help='print a listing of the placed script in this format instead of the sections')
+parser.add_argument('--metrics', metavar='file', dest='metrics', type=argparse.FileType('w'), help='write compile metrics as JSON')
+parser.add_argument('--profile', metavar='file', dest='profile', help='print where the compile spent its time, and write collapsed stacks for flamegraph tools')
+parser.add_argument('--relocate', metavar='offset', dest='relocate', type=number, default=None, help='move the script at this offset to --offset (or to free space) and repoint every reference to it')
+parser.add_argument('--size', metavar='bytes', dest='size', type=number, default=None, help='size of the script to relocate (default: from the free space record)')
+parser.add_argument('--undo', dest='undo', action='store_true', help='undo the last build written to --rom')
+parser.add_argument('--redo', dest='redo', action='store_true', help='redo the last undone build')
+parser.add_argument('--restore', metavar='build', dest='restore', type=int, default=None, help='undo or redo builds until this one is the last applied (0 for none)')
+parser.add_argument('--history', dest='history', action='store_true', help='list the builds written to --rom')
+parser.add_argument('--unaligned', dest='unaligned', action='store_true', help='also repoint unaligned references, such as ones inside other scripts')
 
 args = parser.parse_args()
 
-times = []
+if args.undo or args.redo or args.restore != None or args.history:
+    if not args.out_rom:
+        parser.error('journal commands require --rom')
+
+    rom = args.out_rom.name
+    args.out_rom.close()
+    journal = subscript.journal.Journal(rom)
+
+    if args.history:
+        for build in journal.builds:
+            print('{} {:4} {} {}'.format('*' if build['build'] <= journal.head else ' ',
+                build['build'], time.ctime(build['time']), build['metadata']))
+        sys.exit()
+
+    space = subscript.freespace.FreeSpace(rom, args.search)
+    if args.undo:
+        builds = [journal.undo()]
+    elif args.redo:
+        builds = [journal.redo()]
+    else:
+        builds = journal.restore(args.restore)
+
+    for build in builds:
+        if build:
+            space.follow(build, undo=build['build'] > journal.head)
+    space.save()
+
+    print('Now at build {} of {}'.format(journal.head, len(journal.builds)))
+    sys.exit()
+
+if args.relocate != None:
+    if not args.out_rom:
+        parser.error('--relocate requires --rom')
+
+    rom = args.out_rom.name
+    space = subscript.freespace.FreeSpace(rom, args.search)
+
+    size = args.size
+    name = None
+    if args.relocate in space.allocations:
+        name = space.allocations[args.relocate]['name']
+        if size == None:
+            size = space.allocations[args.relocate]['size']
+    elif size == None:
+        parser.error('no record of a script at 0x{:06X}, use --size'.format(args.relocate))
+
+    if args.offset == None:
+        offset = space.allocate(size, name, args.align, args.strategy)
+    else:
+        offset = args.offset
+        space.reserve(offset, size, name)
+
+    index = subscript.pointers.PointerIndex(rom, not args.unaligned)
+    writes, patched = subscript.pointers.relocation(args.out_rom, args.relocate, size, offset, index)
+    args.out_rom.close()
+
+    journal = subscript.journal.Journal(rom)
+    journal.record(writes, script=name, offset=offset, size=size, relocate=args.relocate, allocated=args.offset == None)
+
+    if args.relocate in space.allocations:
+        space.release(args.relocate)
+    space.save()
+
+    print('Moved {} bytes from 0x{:06X} to 0x{:06X}, repointed {} references'.format(size, args.relocate, offset, len(patched)))
+    for location in patched:
+        print('\t0x{:06X}'.format(location))
+    sys.exit()
+
+if args.serve:
+    try:
+        subscript.server.serve(args.serve, args.path)
+    except ValueError as e:
+        parser.error(str(e))
+    sys.exit()
+
+if args.build:
+    try:
+        project = subscript.project.Project(args.build)
+        built = project.build(args.jobs)
+    except subscript.project.BuildError as e:
+        sys.exit(str(e))
+
+    if not built:
+        print('Nothing to do')
+    sys.exit()
+
+if args.link:
+    if not args.out_rom:
+        parser.error('--link requires --rom')
+
+    rom = args.out_rom.name
+    args.out_rom.close()
+    space = subscript.freespace.FreeSpace(rom, args.search)
+
+    linker = subscript.link.Linker()
+    for n, path in enumerate(args.link):
+        # --offset places the first object, the rest go in free space
+        linker.add(subscript.link.Object.load(path), args.offset if n == 0 else None)
+    for obj in linker.objects:
+        if obj.name in linker.offsets:
+            space.reserve(linker.offsets[obj.name], obj.size, obj.name)
+    allocated = [obj.name for obj in linker.objects if obj.name not in linker.offsets]
+    linker.place(space, args.align, args.strategy)
+
+    journal = subscript.journal.Journal(rom)
+    for obj, (offset, data) in zip(linker.objects, linker.link()):
+        journal.record([(offset, data)], script=obj.name, offset=offset, size=len(data), allocated=obj.name in allocated)
+        print('Placed {} at 0x{:06X} ({} bytes)'.format(obj.name, offset, len(data)))
+    space.save()
+    sys.exit()
 
-tests = 100
-for i in range(tests):
-    start_time = time.process_time()
-    c = subscript.compile.Compile(args.script.read(), args.offset + 0x8000000)
-    end_time = time.process_time()
-    times.append(end_time - start_time)
+if not args.script:
+    parser.error('a script to compile is required')
 
-    # Seek to beginning of file to redo test
-    args.script.seek(0)
+if args.out_patch and not args.out_rom:
+    parser.error('--patch requires --rom')
 
-mean = sum(times) / len(times)
-print('Compiled {tests} times, mean compile time is {mean}'.format(tests=tests, mean=mean))
-c.output()
+rom = args.out_rom.name if args.out_rom else None
+# Free space is only looked for when writing to a ROM
+offset = args.offset if args.offset != None else subscript.compile.default_offset
+
+profiler = subscript.profiler.Profiler() if args.profile else None
+resolver = subscript.resolver.Resolver(args.path) if args.path else None
+
+if args.check:
+    c = subscript.compile.Compile(args.script.read(), offset + 0x8000000, rom, profiler, args.script.name, resolver, args.optimize, prefer=args.prefer, mode=args.mode, recover=True)
+    diagnostics = c.diagnostics()
+    if args.check == 'json':
+        print(json.dumps(diagnostics, indent=4, sort_keys=True))
+    else:
+        for d in diagnostics:
+            location = '{}:{}:{}'.format(args.script.name, d['line'], d['column']) if d['line'] else args.script.name
+            print('{}: {}: {}'.format(location, d['severity'], d['message']))
+    sys.exit(1 if c.errors else 0)
+
+if args.targets:
+    if args.out_rom or args.out_raw or args.out_object:
+        parser.error('--target writes a raw file for each game to --output-dir')
+
+    targets = {}
+    for target in args.targets:
+        code, _, path = target.partition('=')
+        if code == 'all':
+            targets.update((code, None) for code in subscript.targets.games() if code not in targets)
+        else:
+            targets[code] = path if path else None
+
+    try:
+        built = subscript.targets.compile_all(args.script.read(), offset + 0x8000000, targets, args.script.name, args.path, args.jobs,
+            optimize=args.optimize, prefer=args.prefer, mode=args.mode)
+    except subscript.targets.TargetError as e:
+        sys.exit(str(e))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(args.script.name))[0]
+    for code in sorted(built):
+        data, sourcemap, warnings = built[code]
+        for warning in warnings:
+            print('Warning: {}: {}'.format(code, warning), file=sys.stderr)
+
+        out = os.path.join(args.output_dir, '{}.{}.bin'.format(name, code))
+        with open(out, 'wb') as file:
+            file.write(data)
+        sourcemap.save(out + '.map.json')
+        print('Wrote {} ({} bytes)'.format(out, len(data)))
+    sys.exit()
+
+c = subscript.compile.Compile(args.script.read(), offset + 0x8000000, rom, profiler, args.script.name, resolver, args.optimize, prefer=args.prefer, mode=args.mode)
+for warning in c.warnings:
+    print('Warning: {}'.format(warning), file=sys.stderr)
+
+space = None
+if args.out_rom:
+    space = subscript.freespace.FreeSpace(rom, args.search)
+
+    if args.reuse:
+        # Never point into anything we inserted, it may be moved or wiped
+        exclude = [(k, k + v['size']) for k, v in space.allocations.items()]
+        if args.offset != None:
+            # Nor into the bytes this write replaces. Reuse only makes the
+            # script smaller, so its size now covers them.
+            exclude.append((offset, offset + len(c.bytecode())))
+        index = subscript.content.ContentIndex(rom, exclude=exclude)
+        reused = c.script.reuse(index)
+        print('Reused {} existing blocks, saving {} bytes'.format(len(reused), sum(s.size for s in reused)))
+
+    size = len(c.bytecode())
+
+    if args.offset == None:
+        offset = space.allocate(size, args.script.name, args.align, args.strategy)
+        c.script.base = offset + 0x8000000
+    else:
+        space.reserve(offset, size, args.script.name)
+
+    print('Placing script at 0x{:06X} ({} bytes)'.format(offset, size))
+
+if args.listing:
+    for line in c.listing(args.listing):
+        print(line)
+else:
+    c.output()
 
 data = c.bytecode()
 
+if args.metrics:
+    metrics = c.metrics()
+    metrics['script'] = args.script.name
+    metrics['offset'] = offset
+    json.dump(metrics, args.metrics, indent=4, sort_keys=True)
+
+if profiler:
+    print(profiler.table())
+    profiler.save(args.profile)
+
 if args.out_raw:
     args.out_raw.write(data)
 
-if args.out_rom:
-    args.out_rom.seek(args.offset)
-    args.out_rom.write(data)
+if args.out_object:
+    name = os.path.splitext(os.path.basename(args.script.name))[0]
+    c.object(name, embed=True).save(args.out_object)
+
+# Where each command came from, for debuggers and crash reports
+sourcemap = args.map
+if not sourcemap:
+    if args.out_patch:
+        sourcemap = args.out_patch + '.map.json'
+    elif args.out_rom:
+        os.makedirs(rom + '.maps', exist_ok=True)
+        sourcemap = os.path.join(rom + '.maps', '{:06X}.map.json'.format(offset))
+    elif args.out_raw:
+        sourcemap = args.out_raw.name + '.map.json'
+if sourcemap:
+    c.sourcemap().save(sourcemap)
+
+if args.out_patch:
+    # The ROM is left alone, so the free space map is too
+    patch = subscript.patch.Patch(rom)
+    patch.write(offset, data)
+    patch.save(args.out_patch)
+elif args.out_rom:
+    args.out_rom.close()
+
+    journal = subscript.journal.Journal(rom)
+    journal.record([(offset, data)], script=args.script.name, offset=offset, size=len(data), allocated=args.offset == None)
 
+    # Only record the placement once the ROM holds the data
+    space.save()
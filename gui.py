@@ -1,6 +1,9 @@
 import interface.tabs
 import interface.xse
 import subscript.compile
+import subscript.freespace
+import subscript.journal
+import subscript.resolver
 from gi.repository import Gtk, Gio, GObject, Gdk, GtkSource, Pango, GtkSpell, GLib
 
 class MyWindow(Gtk.Window):
@@ -28,8 +31,6 @@ class MyWindow(Gtk.Window):
         self.box.add(self.tabs)
         #self.tabs.open(path)
 
-        self.last_compile = None
-
         self.add(self.box)
 
         self.connect('delete-event', Gtk.main_quit)
@@ -48,52 +49,51 @@ class MyWindow(Gtk.Window):
         self.tabs.new('subscript')
 
     def clean(self):
-        if self.last_compile != None:
-            with open(self.rom, 'rb+') as rom:
-                rom.seek(self.last_compile[0])
-                wipe = bytes(0xFF for _ in range(len(self.last_compile[1])))
-                rom.write(wipe)
+        if self.rom == None:
+            return
+
+        journal = subscript.journal.Journal(self.rom)
+        build = journal.undo()
+        if build != None:
+            space = subscript.freespace.FreeSpace(self.rom, subscript.freespace.FreeSpace.start)
+            space.follow(build, undo=True)
+            space.save()
 
     def compile(self):
         index = self.tabs.get_current_page()
         page = self.tabs.get_nth_page(index)
 
-        start = 0x800000
-
         text = page.buffer.props.text
-        script = subscript.compile.Compile(text, 0xDEADBEEF, self.rom)
-        size = len(script.bytecode())
 
-        with open(self.rom, 'rb') as rom:
-            rom.seek(start)
-            for chunk in iter(lambda: rom.read(size), b''):
-                if all(byte == 0xFF for byte in chunk) and len(chunk) == size:
-                    break
-            else:
-                # We reached the end of file, throw error
-                dialog = Gtk.MessageDialog(self, 0, Gtk.MessageType.ERROR, Gtk.ButtonsType.CANCEL, "No free space")
-                dialog.format_secondary_text("Subscript could not find enough free space to insert your script.")
-                dialog.run()
+        # Pick up any modules that were edited since the last compile
+        subscript.resolver.default.refresh()
+        script = subscript.compile.Compile(text, 0xDEADBEEF, self.rom, path=page.path)
+        size = len(script.bytecode())
 
-                dialog.destroy()
-                return
+        space = subscript.freespace.FreeSpace(self.rom, subscript.freespace.FreeSpace.start)
+        try:
+            offset = space.allocate(size, page.path)
+        except MemoryError:
+            dialog = Gtk.MessageDialog(self, 0, Gtk.MessageType.ERROR, Gtk.ButtonsType.CANCEL, "No free space")
+            dialog.format_secondary_text("Subscript could not find enough free space to insert your script.")
+            dialog.run()
 
-            offset = rom.tell() - size
+            dialog.destroy()
+            return
 
         script.script.base = offset + 0x08000000
         data = script.bytecode()
 
-        with open(self.rom, 'rb+') as rom:
-            rom.seek(offset)
-            rom.write(data)
+        journal = subscript.journal.Journal(self.rom)
+        journal.record([(offset, data)], script=page.path, offset=offset, size=size, allocated=True)
 
-            self.last_compile = (offset, data)
+        space.save()
 
-            dialog = Gtk.MessageDialog(self, 0, Gtk.MessageType.INFO,
-            Gtk.ButtonsType.OK, "Success!")
-            dialog.format_secondary_text("Inserted your script at 0x{:6x}.".format(offset))
-            dialog.run()
-            dialog.destroy()
+        dialog = Gtk.MessageDialog(self, 0, Gtk.MessageType.INFO,
+        Gtk.ButtonsType.OK, "Success!")
+        dialog.format_secondary_text("Inserted your script at 0x{:6x}.".format(offset))
+        dialog.run()
+        dialog.destroy()
 
 win = MyWindow()
 win.show_all()
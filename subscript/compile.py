@@ -1,16 +1,27 @@
 import ast
+import collections
+import contextlib
 import json
 import operator
 import os
-import runpy
+import time
 
 import subscript.codec
+import subscript.config
 import subscript.datatypes as datatypes
 import subscript.errors as errors
 import subscript.functions as functions
 import subscript.langtypes as langtypes
+import subscript.link
+import subscript.listing
+import subscript.optimize
+import subscript.profiler
+import subscript.resolver
 import subscript.script as script
-from subscript import registry
+import subscript.sourcemap
+
+# Offset scripts are compiled for when nothing else chooses one
+default_offset = 0x740000
 
 class Compile(object):
     '''
@@ -43,6 +54,16 @@ class Compile(object):
         # TODO: Comparison?
     }
 
+    # Comparisons of two constants are worked out while compiling
+    comparisons = {
+        ast.Lt: operator.lt,
+        ast.Eq: operator.eq,
+        ast.Gt: operator.gt,
+        ast.LtE: operator.le,
+        ast.GtE: operator.ge,
+        ast.NotEq: operator.ne,
+    }
+
     conditions = {
         ast.Lt: 0,
         ast.Eq: 1,
@@ -57,7 +78,9 @@ class Compile(object):
         ast.Lt: ast.Gt(),
         ast.Gt: ast.Lt(),
         ast.LtE: ast.GtE(),
-        ast.GtE: ast.LtE()
+        ast.GtE: ast.LtE(),
+        ast.Eq: ast.Eq(),
+        ast.NotEq: ast.NotEq()
     }
 
     # Invert the operator for an opposite (not) comparison
@@ -70,11 +93,42 @@ class Compile(object):
         ast.NotEq: ast.Eq()
     }
 
-    def __init__(self, source, base):
+    # A switch tests up to this many ranges one after another. With more, it
+    # splits them in half with a single compare.
+    switch_linear = 3
+
+    # Loops are unrolled if that takes at most this many bytes, unless the
+    # compile prefers size
+    unroll_limit = 100
+
+    def __init__(self, source, base, rom=None, profiler=None, path=None, resolver=None, optimize=True, library=False, prefer='speed', mode='debug', recover=False, code=None, tree=None):
         '''
         Constructor.
         :param source: The source to be parsed, as a string.
         :param base: The offset at which to start the script.
+        :param rom: Path to the ROM the script is compiled for.
+        :param profiler: A subscript.profiler.Profiler to record timings in.
+        :param path: Path of the source file. Imports are looked for next
+            to it first.
+        :param resolver: A subscript.resolver.Resolver to find imports with.
+        :param optimize: Inline small and single use functions, drop
+            commands that can't change anything, and turn calls that are
+            followed by a return into gotos.
+        :param library: The script is imported by others, so its functions
+            must be kept even if every use in the script was inlined.
+        :param prefer: 'speed' to unroll loops up to unroll_limit bytes, or
+            'size' to only unroll them when that makes them smaller.
+        :param mode: 'debug' keeps the source, and readable copies of strings
+            and movements. 'release' keeps neither, to save memory in large
+            builds.
+        :param recover: Record errors in :attr:`errors` and carry on with the
+            next statement, instead of raising the first one. The script is
+            not optimised if there were any, and must not be used.
+        :param code: Game code to compile for, if there is no ROM or it
+            should not be asked.
+        :param tree: The ast.Module of `source`, if it was parsed already.
+            It is only read, so one tree can be shared by the compiles for
+            several games.
         '''
 
         self.node_types = {
@@ -82,11 +136,13 @@ class Compile(object):
               ast.Expr: self._handle_expr,
               ast.If: self._handle_if,
               ast.While: self._handle_while,
+              ast.For: self._handle_for,
               ast.AugAssign: self._handle_aug_assign,
               ast.FunctionDef: self._handle_function_def,
               ast.Return: self._handle_return,
               ast.Import: self._handle_import,
               ast.ImportFrom: self._handle_import_from,
+              ast.Pass: self._handle_pass,
               }
 
         # Ast node to script condition number
@@ -97,10 +153,30 @@ class Compile(object):
         # Use None so that we base line numbers from 1 instead of 0
         self.lines = [None] + self.source.split('\n')
 
+        if prefer not in ['speed', 'size']:
+            raise ValueError('Unknown preference "{}"'.format(prefer))
+        self.prefer = prefer
+
+        if mode not in ['debug', 'release']:
+            raise ValueError('Unknown mode "{}"'.format(mode))
+        self.mode = mode
+
+        self.path = path
         self.modules = {}
+        self.directory = os.path.dirname(os.path.abspath(path)) if path else None
+        self.resolver = resolver if resolver else subscript.resolver.default
+
+        # Function name -> the section holding its body
+        self.functions = {}
+
+        # Imported script name -> the subscript.link.SectionObject holding it
+        self.libraries = {}
 
         # State variables
-        self.script = script.Script(base)
+        self.script = script.Script(base, rom, code)
+        self.script.debug = mode == 'debug'
+        self.profiler = profiler if profiler else subscript.profiler.null
+        self.script.profiler = self.profiler
         self.symbols = {
                         # General variables
                         'LASTRESULT': langtypes.Var(self.script, 0x800D),
@@ -122,10 +198,61 @@ class Compile(object):
         self.section = self.script.add()
         self.returnhere = None
 
+        # Wall time spent in each phase of the compile
+        self.timings = {}
+
+        # subscript.errors.CompileWarning for anything suspicious
+        self.warnings = []
+
+        # Errors of a recovering compile
+        self.recover = recover
+        self.errors = []
+
         # Create the tree, and begin to parse
-        tree = ast.parse(self.source)
-        for node in tree.body:
-            self._handle_node(node)
+        with self._timed('parse'):
+            try:
+                if tree == None:
+                    tree = ast.parse(self.source)
+            except SyntaxError as e:
+                if not recover:
+                    raise
+                self.errors.append(e)
+                tree = ast.Module(body=[])
+
+        with self._timed('codegen'):
+            for node in tree.body:
+                self._handle_node(node)
+            self.script.position = None
+
+        if mode == 'release':
+            # Nothing refers back to the source from here on
+            del tree
+            self.source = None
+            self.lines = None
+
+        if self.errors:
+            return
+
+        with self._timed('optimize'):
+            if optimize:
+                subscript.optimize.inline(self.script, self.functions, keep=library)
+                subscript.optimize.simplify(self.script, self.functions.values())
+                subscript.optimize.tail_calls(self.script)
+            depth = subscript.optimize.call_depth(self.script)
+
+        if depth == None:
+            self.warnings.append(errors.CompileWarning('Functions call each other recursively, calls nested more than {} deep behave like goto'.format(subscript.optimize.max_depth)))
+        elif depth > subscript.optimize.max_depth:
+            self.warnings.append(errors.CompileWarning('Calls are nested up to {} deep, but only {} are allowed, deeper calls behave like goto'.format(depth, subscript.optimize.max_depth)))
+
+    @contextlib.contextmanager
+    def _timed(self, phase):
+        start = time.perf_counter()
+        try:
+            with self.profiler.measure('phase', phase):
+                yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0) + time.perf_counter() - start
 
     def output(self):
         for section in self.script.sections:
@@ -136,33 +263,102 @@ class Compile(object):
             else:
                 print('', section.debug, sep='\t')
 
+    def listing(self, format='text'):
+        '''
+        Return a generator over the lines of a listing of the compiled
+        script. See subscript.listing for the formats.
+        '''
+        return subscript.listing.listing(self.script, format)
+
+    def sourcemap(self, embed=True):
+        '''
+        Return a subscript.sourcemap.SourceMap from the address of every
+        command to the statement it came from.
+        :param embed: Count imported scripts as part of this one, as in the
+            bytecode. Otherwise the map matches an object without them.
+        '''
+        sections = [s for s in self.script.sections if embed or type(s) != subscript.link.SectionObject]
+        return subscript.sourcemap.SourceMap.from_sections(sections, self.script.base, self.path)
+
+    def object(self, name='main', embed=False):
+        '''
+        Return the script as a relocatable subscript.link.Object, exporting
+        every function that was defined.
+        :param embed: Include imported scripts in the object. Otherwise they
+            have to be linked alongside it.
+        '''
+        return subscript.link.Object.from_script(self.script, name, self.functions, embed)
+
     def status(self):
+        return ''.join(line + '\n' for line in self.listing())
 
-        out = ''
-        for section in self.script.sections:
-            offset = section.dynamic().value + 0x08000000
-            if type(section) == script.Section:
-                out += 'Section ({} bytes) at 0x{:08X} (@{})\n'.format(section.size, offset, section.name.strip())
-                for command in section.commands:
-                    out += '\t{}\n'.format(command)
-            else:
-                out += 'Raw data ({} bytes) at 0x{:08X} (@{})\n'.format(section.size, offset, section.name.strip())
-        return out
+    def link(self):
+        '''
+        Resolve the address of every section. Returns a dictionary mapping
+        section names to addresses.
+        '''
+        with self._timed('link'):
+            return {section.name: section.dynamic().value for section in self.script.sections}
 
     def bytecode(self):
         data = bytearray()
 
+        with self._timed('bytecode'):
+            for section in self.script.sections:
+                if type(section) == script.Section:
+                    for command in section.commands:
+                        data.extend(command.compile())
+                elif isinstance(section, script.SectionRaw):
+                    data.extend(section.data)
+                    pass
+                else:
+                    raise Exception
+
+        return bytes(data)
+
+    def metrics(self):
+        '''
+        Return machine readable statistics about the compile, for tracking
+        ROM space and build time over many builds.
+        '''
+        stats = self.script.stats
+        opcodes = collections.Counter()
+        sizes = collections.Counter()
+
         for section in self.script.sections:
             if type(section) == script.Section:
+                sizes['commands'] += section.size
                 for command in section.commands:
-                    data.extend(command.compile())
-            elif type(section) == script.SectionRaw:
-                data.extend(section.data)
-                pass
+                    opcodes[command.name] += 1
             else:
-                raise Exception
-
-        return bytes(data)
+                sizes['raw'] += section.size
+
+        def shared(kind):
+            return {
+                'emitted': stats['emitted', kind],
+                'deduplicated': stats['deduplicated', kind],
+            }
+
+        return {
+            'sections': {
+                'code': sum(1 for s in self.script.sections if type(s) == script.Section),
+                'raw': sum(1 for s in self.script.sections if type(s) != script.Section),
+                'reused': stats['reused'],
+            },
+            'commands': {
+                'total': sum(opcodes.values()),
+                'opcodes': dict(opcodes),
+            },
+            'bytes': {
+                'commands': sizes['commands'],
+                'raw': sizes['raw'],
+                'total': sizes['commands'] + sizes['raw'],
+            },
+            'strings': shared('String'),
+            'movements': shared('Movement'),
+            'rom_reads': stats['rom_reads'],
+            'timings': dict(self.timings),
+        }
 
     def _add_command(self, command, *args):
         self.section.append(script.Command.create(command, *args))
@@ -171,11 +367,35 @@ class Compile(object):
         # New -- trying things out
         # Does this work?
 
+        # Commands are tagged with the statement they come from
+        outer = self.script.position
+        self.script.position = (node.lineno, node.col_offset)
+
+        # Where to carry on if the statement fails
+        state = self.section, self.nextsection, self.returnhere
+
         # Try to handle the node, if possible.
+        handler = self.node_types.get(type(node))
         try:
-            self.node_types[type(node)](node)
+            if not handler:
+                raise errors.CompileSyntaxError(node)
+            with self.profiler.measure('node', handler.__name__):
+                handler(node)
         except KeyError:
-            raise errors.CompileSyntaxError(node)
+            # An operator missing from one of the tables. Unknown names raise
+            # CompileNameError
+            self._error(errors.CompileSyntaxError(node), state)
+        except errors.CompileError as e:
+            # Errors about values rather than nodes are placed at the statement
+            if e.line == None:
+                e.line, e.col = node.lineno, node.col_offset
+            self._error(e, state)
+        except (ValueError, TypeError, ImportError, subscript.config.NotSupported) as e:
+            if not self.recover:
+                raise
+            self._error(errors.CompileError(node, str(e)), state)
+        finally:
+            self.script.position = outer
 
         # Old Stuff VV
         """
@@ -201,6 +421,32 @@ class Compile(object):
             raise errors.CompileSyntaxError(node)
         """
 
+    def _symbol(self, node):
+        '''
+        Return what the Name `node` refers to.
+        '''
+        try:
+            return self.symbols[node.id]
+        except KeyError:
+            raise errors.CompileNameError(node, node.id)
+
+    def _ends(self, names):
+        # Whether the current section ends with one of the commands in `names`
+        return bool(self.section.commands) and self.section.last().name in names
+
+    def _error(self, error, state):
+        if not self.recover:
+            raise error
+        self.errors.append(error)
+        self.section, self.nextsection, self.returnhere = state
+
+    def diagnostics(self):
+        '''
+        Return every error and warning as a list of dictionaries, see
+        subscript.errors.diagnostic.
+        '''
+        return [errors.diagnostic(e) for e in self.errors + self.warnings]
+
     def _handle_attribute(self, node):
         print(node.__dict__)
 
@@ -211,56 +457,38 @@ class Compile(object):
             asname = name.asname if name.asname else target
 
             # Find what we're importing
-            #search_path = ['/home/james/here/code']
-            # This gets the current directory
-            search_path = os.path.split(os.path.abspath(__file__))[0]
-            for path in search_path:
-                for file in os.listdir(path):
-                    # Just loop over files
-                    absolute = os.path.join(path, file)
-
-                    if os.path.isfile(absolute):
-                        base, ext = os.path.splitext(file)
-
-                        if base != target:
-                            # Don't bother, the file doesn't match the import
-                            continue
-
-                        # FIXME: All extensions
-                        if ext in ['.py', '.pyc']:
-                            # Python module. These will register custom functions
-                            self.modules[asname] = registry.Registry(target)
-                            runpy.run_path(absolute, init_globals={'register': self.modules[asname].register})
-                            return
-                        elif ext in ['.sub']:
-                            # TODO: Compile this file first
-                            raise ImportError('Script import not yet supported.')
-                            return
-                        elif ext in ['.asm', '.s']:
-                            # TODO: Assemble
-                            raise ImportError('Assembly import not yet supported.')
-                            return
-                        elif ext in ['.c']:
-                            # TODO: Compile C code
-                            raise ImportError('C import not yet supported.')
-                            return
-                        elif ext in ['.bin', '.raw']:
-                            # Raw copy
-                            self.symbols[asname] = langtypes.RawFile(self.script, absolute)
-                            return
-                        elif ext in ['.json']:
-                            # TODO: Definitions?
-                            raise ImportError('Definition import not yet supported.')
-                            return
-                        elif ext in ['.rbt']:
-                            # TODO: Definitions?
-                            raise ImportError('Definition import not yet supported.')
-                            return
-            else:
-                # Import not found
+            absolute = self.resolver.find(target, self.directory)
+            if absolute == None:
                 # TODO: Create special import exception
                 raise ImportError('Import of "{}" unresolved.'.format(name.name))
 
+            ext = os.path.splitext(absolute)[1]
+            if ext in ['.py', '.pyc']:
+                # Python module. These will register custom functions
+                self.modules[asname] = self.resolver.module(absolute, target)
+            elif ext in ['.sub']:
+                # Compiled separately, and linked in as a whole
+                section = subscript.link.SectionObject(self.script, self.resolver.script(absolute, target, self.script.rom, self.script.code))
+                self.script.add(section)
+                section.include()
+                self.libraries[asname] = section
+            elif ext in ['.asm', '.s']:
+                # TODO: Assemble
+                raise ImportError('Assembly import not yet supported.')
+            elif ext in ['.c']:
+                # TODO: Compile C code
+                raise ImportError('C import not yet supported.')
+            elif ext in ['.bin', '.raw']:
+                # Raw copy
+                self.symbols[asname] = langtypes.Raw(self.script, self.resolver.raw(absolute))
+            elif ext in ['.json', '.rbt']:
+                # Constants go straight into the symbol table
+                for symbol, kind, value in self.resolver.definitions(absolute):
+                    if kind:
+                        self.symbols[symbol] = langtypes.Type[kind](self.script, value)
+                    else:
+                        self.symbols[symbol] = value
+
     def _handle_import_from(self, node):
         # TODO
         print(node.__dict__)
@@ -278,12 +506,13 @@ class Compile(object):
 
         # Create a new section for the function
         self.section = self.script.add()
+        self.functions[node.name] = self.section
 
         for item in node.body:
             self._handle_node(item)
 
         # Register the function in the symbol table by adding a script command to it
-        if self.section.last().name in ['end']:
+        if self._ends(['end']):
             # The last function was an end, so we use goto instead of call
             self.symbols[node.name] = script.Command.create('goto', self.section.dynamic())
         else:
@@ -294,6 +523,9 @@ class Compile(object):
         # Restore state
         self.section = store
 
+    def _handle_pass(self, node):
+        pass
+
     def _handle_return(self, node):
         if node.value:
             fake = ast.Assign(targets=[ast.Name('LASTRESULT', ast.Load())], value=node.value)
@@ -344,7 +576,8 @@ class Compile(object):
         else:
             value = self._handle_arithmetic(argument)
 
-        return langtypes.Type[name](self.script, value)
+        with self.profiler.measure('type', name):
+            return langtypes.Type[name](self.script, value)
 
     def _op_bin(self, op):
         # Get the appropriate binary operator from the dictionary
@@ -405,7 +638,7 @@ class Compile(object):
     def _handle_arithmetic(self, node):
         if type(node) == ast.Name:
             # Resolve variable
-            return self._handle_arithmetic(self.symbols[node.id])
+            return self._handle_arithmetic(self._symbol(node))
         elif type(node) == ast.BinOp:
             left = self._handle_arithmetic(node.left)
             right = self._handle_arithmetic(node.right)
@@ -435,7 +668,7 @@ class Compile(object):
         elif type(node.value) == ast.Num:
             self._handle_set_value(what, node.value.n)
         elif type(node.value) == ast.Name:
-            self._handle_set_value(what, self.symbols[node.value.id])
+            self._handle_set_value(what, self._symbol(node.value))
         else:
             self.symbols[what] = self._handle_type(node.value)
 
@@ -443,7 +676,7 @@ class Compile(object):
         if type(node.target) != ast.Name:
             raise errors.CompileSyntaxError(node.target)
 
-        what = self.symbols[node.target.id]
+        what = self._symbol(node.target)
 
         if type(what) == langtypes.Var:
             value = self._handle_arithmetic(node.value)
@@ -498,12 +731,23 @@ class Compile(object):
 
             # If the name is in the symbol table, we have a user-defined function
             if call in self.symbols:
-                self.section.append(self.symbols[call])
+                # A copy, so every call knows where it came from
+                command = self.symbols[call]
+                self._add_command(command.name, *command.args)
 
                 # We don't want to handle the next case
                 return
         elif type(node.func) == ast.Attribute:
             call = node.func.attr
+
+            # Functions of imported scripts are called where they were linked
+            if node.func.value.id in self.libraries:
+                symbol = '{}.{}'.format(self.libraries[node.func.value.id].object.name, call)
+                if symbol not in self.script.externals:
+                    raise errors.CompileNameError(node, 'Imported script has no function "{}"'.format(call))
+                self._add_command('call', datatypes.SymbolPointer(self.script, symbol))
+                return
+
             registry = self.modules[node.func.value.id]
 
         # Otherwise, we have a built-in function
@@ -519,16 +763,18 @@ class Compile(object):
         if call not in registry:
             raise errors.CompileNameError(node, node.func.id)
 
-        cmd = registry[call](*args, **kwargs)
+        with self.profiler.measure('function', '{}.{}'.format(registry.name, call)):
+            cmd = registry[call](self.script, *args, **kwargs)
         self.section.append(cmd)
 
     def _handle_function_arg(self, node):
         if type(node) == ast.Name:
             # Resolve variables
-            try:
-                return self._handle_function_arg(self.symbols[node.id])
-            except KeyError:
-                raise errors.CompileNameError(node)
+            value = self._symbol(node)
+            # Loop constants and plain definitions are numbers already
+            if type(value) == int:
+                return value
+            return self._handle_function_arg(value)
         elif type(node) == ast.NameConstant:
             return node.value
         elif type(node) == ast.Num:
@@ -545,6 +791,11 @@ class Compile(object):
 
     # Control flow
     def _handle_if(self, node):
+        switch = self._switch_cases(node)
+        if switch:
+            self._handle_switch(*switch)
+            return
+
         store3 = self.section
         store = self.nextsection
         rethere = self.returnhere
@@ -558,18 +809,235 @@ class Compile(object):
                 store2 = self.nextsection
                 self.nextsection = self.script.add()
                 self._add_command('goto', self.nextsection.dynamic())
+                self.returnhere = store3.dynamic(len(store3.commands))
                 self._handle_control_body(node.orelse)
                 self._handle_control_end()
                 self.nextsection = store2
 
+        # Every branch continues after the whole chain of tests
+        self.returnhere = store3.dynamic(len(store3.commands))
+
         self._handle_control_body(node.body)
         self._handle_control_end()
         self.nextsection = store
         self.section = store3
         self.returnhere = rethere
 
+    def _switch_cases(self, node):
+        '''
+        Recognise a chain of if and elif that tests a single variable against
+        constants, e.g. "if v == 1: ... elif v in range(2, 5): ...".
+        Returns a (variable, [(ranges, body)], orelse) tuple, or None if the
+        chain is better handled as ordinary conditions.
+        '''
+        var = None
+        cases = []
+        plain = True
+        while True:
+            test = self._switch_test(node.test)
+            if not test or (var and test[0]._value != var._value):
+                return None
+            var = test[0]
+            cases.append((test[1], node.body))
+
+            if type(node.test) != ast.Compare or len(node.test.ops) != 1 or type(node.test.ops[0]) not in self.conditions:
+                plain = False
+
+            if len(node.orelse) == 1 and type(node.orelse[0]) == ast.If:
+                node = node.orelse[0]
+            else:
+                break
+
+        # A lone "if v == 1" or "if v < 5" is just a condition
+        if len(cases) == 1 and plain:
+            return None
+        return var, cases, node.orelse
+
+    def _constant(self, node):
+        try:
+            value = self._handle_arithmetic(node)
+        except KeyError:
+            return None
+        return value if type(value) == int else None
+
+    def _switch_test(self, node):
+        '''
+        Return the (variable, [(low, high)]) ranges that a case test matches,
+        or None.
+        '''
+        if type(node) == ast.BoolOp and type(node.op) == ast.Or:
+            var = None
+            ranges = []
+            for term in node.values:
+                test = self._switch_test(term)
+                if not test or (var and test[0]._value != var._value):
+                    return None
+                var = test[0]
+                ranges.extend(test[1])
+            return var, ranges
+
+        if type(node) != ast.Compare:
+            return None
+
+        operands = [node.left] + node.comparators
+        names = [n for n, operand in enumerate(operands)
+                 if type(operand) == ast.Name and type(self.symbols.get(operand.id)) == langtypes.Var]
+        if len(names) != 1:
+            return None
+        var = self.symbols[operands[names[0]].id]
+
+        if len(node.ops) == 1 and names == [0] and type(node.ops[0]) == ast.In:
+            # v in [1, 2, 3], or v in range(1, 4)
+            values = node.comparators[0]
+            if type(values) in [ast.List, ast.Tuple, ast.Set]:
+                constants = [self._constant(value) for value in values.elts]
+                if None in constants:
+                    return None
+                return var, [(value, value) for value in constants]
+            if (type(values) == ast.Call and type(values.func) == ast.Name and
+                    values.func.id == 'range' and 1 <= len(values.args) <= 2 and not values.keywords):
+                bounds = [self._constant(arg) for arg in values.args]
+                if None in bounds:
+                    return None
+                low, high = bounds if len(bounds) == 2 else (0, bounds[0])
+                return var, [(low, high - 1)] if low < high else []
+            return None
+
+        if len(node.ops) == 1 and type(node.ops[0]) == ast.Eq:
+            value = self._constant(operands[1 - names[0]])
+            return (var, [(value, value)]) if value != None else None
+
+        if len(node.ops) == 1 and type(node.ops[0]) in [ast.Lt, ast.LtE, ast.Gt, ast.GtE]:
+            # v < 5, or 5 > v
+            value = self._constant(operands[1 - names[0]])
+            if value == None:
+                return None
+            op = node.ops[0] if names == [0] else self.swap_operator[type(node.ops[0])]
+            low, high = {
+                ast.Lt: (0, value - 1),
+                ast.LtE: (0, value),
+                ast.Gt: (value + 1, 0xFFFF),
+                ast.GtE: (value, 0xFFFF),
+            }[type(op)]
+            return var, [(low, high)] if low <= high else []
+
+        if len(node.ops) == 2 and names == [1] and all(type(op) in [ast.Lt, ast.LtE] for op in node.ops):
+            # 2 <= v < 5
+            low = self._constant(operands[0])
+            high = self._constant(operands[2])
+            if low == None or high == None:
+                return None
+            if type(node.ops[0]) == ast.Lt:
+                low += 1
+            if type(node.ops[1]) == ast.Lt:
+                high -= 1
+            return var, [(low, high)] if low <= high else []
+
+        return None
+
+    def _handle_switch(self, var, cases, orelse):
+        '''
+        Compile a switch as a balanced tree of compares, so finding the case
+        takes a logarithmic number of tests instead of one for each case.
+        '''
+        store = self.section
+        storenext = self.nextsection
+        rethere = self.returnhere
+
+        # Where every case continues, set once the tree is written
+        after = datatypes.RelativePointer(self.script, store, 0)
+
+        # Earlier cases win where they overlap with later ones
+        claimed = []
+        ranges = []
+        for values, body in cases:
+            section = self.script.add()
+            for low, high in values:
+                low, high = max(low, 0), min(high, 0xFFFF)
+                for piece in _subtract(low, high, claimed):
+                    ranges.append(piece + (section,))
+                    claimed.append(piece)
+            self.nextsection = section
+            self.returnhere = after
+            self._handle_control_body(body)
+            self._handle_control_end()
+
+        if orelse:
+            default = self.script.add()
+            self.nextsection = default
+            self.returnhere = after
+            self._handle_control_body(orelse)
+            self._handle_control_end()
+            default = default.dynamic()
+        else:
+            default = after
+
+        # Neighbouring ranges that lead to the same case are tested as one
+        ranges.sort(key=lambda r: r[0])
+        merged = []
+        for low, high, section in ranges:
+            if merged and merged[-1][2] is section and merged[-1][1] + 1 == low:
+                merged[-1] = (merged[-1][0], high, section)
+            else:
+                merged.append((low, high, section))
+
+        self.section = store
+        self._switch_tree(var, merged, 0, 0xFFFF, default)
+        if orelse and not self._ends(['goto']):
+            self._add_command('goto', default)
+        after.offset = len(store.commands)
+
+        self.section = store
+        self.nextsection = storenext
+        self.returnhere = rethere
+
+    def _switch_tree(self, var, ranges, low, high, default):
+        '''
+        Write the tests for `ranges` to the current section. The variable is
+        known to be between `low` and `high`. Jumps to the section of the
+        matching range, or falls through if there is none.
+        '''
+        if len(ranges) > self.switch_linear:
+            middle = len(ranges) // 2
+            pivot = ranges[middle][0]
+
+            store = self.section
+            left = self.script.add()
+            self._add_command('compare', var.value, pivot)
+            self._add_command('if1', self._op(ast.Lt()), left.dynamic())
+
+            self.section = left
+            self._switch_tree(var, ranges[:middle], low, pivot - 1, default)
+            if not self._ends(['goto']):
+                self._add_command('goto', default)
+
+            self.section = store
+            self._switch_tree(var, ranges[middle:], pivot, high, default)
+            return
+
+        for start, end, section in ranges:
+            target = section.dynamic()
+            if start <= low and end >= high:
+                self._add_command('goto', target)
+            elif start == end:
+                self._add_command('compare', var.value, start)
+                self._add_command('if1', self._op(ast.Eq()), target)
+            elif start <= low:
+                self._add_command('compare', var.value, end)
+                self._add_command('if1', self._op(ast.LtE()), target)
+            elif end >= high:
+                self._add_command('compare', var.value, start)
+                self._add_command('if1', self._op(ast.GtE()), target)
+            else:
+                skip = self.section.dynamic(len(self.section.commands) + 4)
+                self._add_command('compare', var.value, start)
+                self._add_command('if1', self._op(ast.Lt()), skip)
+                self._add_command('compare', var.value, end)
+                self._add_command('if1', self._op(ast.LtE()), target)
+
     def _handle_while(self, node):
         store = self.nextsection
+        rethere = self.returnhere
         self.nextsection = self.script.add()
         self._handle_condition(node.test)
 
@@ -582,6 +1050,114 @@ class Compile(object):
         self._handle_control_end()
         self.section = store2
         self.nextsection = store
+        self.returnhere = rethere
+
+    def _loop_values(self, node):
+        '''
+        Return the constants that a for loop goes through.
+        '''
+        if type(node) in [ast.List, ast.Tuple]:
+            values = [self._constant(value) for value in node.elts]
+        elif (type(node) == ast.Call and type(node.func) == ast.Name and node.func.id == 'range' and
+                1 <= len(node.args) <= 3 and not node.keywords):
+            values = [self._constant(arg) for arg in node.args]
+            if None not in values:
+                try:
+                    values = list(range(*values))
+                except ValueError:
+                    raise errors.CompileSyntaxError(node)
+        else:
+            raise errors.CompileSyntaxError(node)
+
+        if None in values:
+            raise errors.CompileTypeError(node, 'Loops must go through constants')
+        return values
+
+    def _handle_for(self, node):
+        if node.orelse:
+            raise errors.CompileSyntaxError(node.orelse[0])
+
+        if type(node.target) != ast.Name:
+            raise errors.CompileSyntaxError(node.target)
+
+        values = self._loop_values(node.iter)
+        name = node.target.id
+
+        # A variable is set to each value, anything else names a constant
+        var = self.symbols.get(name)
+        if type(var) != langtypes.Var:
+            if name in self.symbols and type(var) != int:
+                raise errors.CompileTypeError(node.target)
+            var = None
+        elif any(value < 0 or value > 0xFFFF for value in values):
+            raise errors.CompileTypeError(node.iter, 'Loop values do not fit in a variable')
+
+        if not values:
+            return
+
+        # Evenly spaced values can be counted in the variable, unless the
+        # body changes it
+        steps = set(b - a for a, b in zip(values, values[1:]))
+        counted = (var != None and len(steps) == 1 and 0 not in steps and
+                   0 <= values[-1] + min(steps) <= 0xFFFF and
+                   not self._assigns(node.body, name))
+
+        # The first pass is written the same way whether the loop is unrolled
+        # or not, and tells how large the body is
+        section = self.section
+        start = section.size
+        if var:
+            self._add_command('setvar', var.value, values[0])
+        head = len(section.commands)
+        self._handle_loop_body(node.body, name, values[0])
+
+        # Unrolled, every pass takes as much as the first one. Counted, the
+        # body is followed by an addvar, a compare and an if1, and the loop
+        # by a setvar.
+        unrolled = (section.size - start) * len(values)
+        loop = section.size - start + 21
+        if not counted or unrolled <= loop or (self.prefer == 'speed' and unrolled <= self.unroll_limit):
+            for value in values[1:]:
+                if var:
+                    self._add_command('setvar', var.value, value)
+                self._handle_loop_body(node.body, name, value)
+            return
+
+        step = steps.pop()
+        if step > 0:
+            self._add_command('addvar', var.value, step)
+            self._add_command('compare', var.value, values[-1])
+            self._add_jump(ast.LtE(), section.dynamic(head))
+        else:
+            self._add_command('subvar', var.value, -step)
+            self._add_command('compare', var.value, values[-1])
+            self._add_jump(ast.GtE(), section.dynamic(head))
+
+        # The count went one step past the end, but an unrolled loop leaves
+        # the last value
+        self._add_command('setvar', var.value, values[-1])
+
+    def _assigns(self, body, name):
+        '''
+        Return whether any statement in `body` assigns to `name`.
+        '''
+        for item in body:
+            for child in ast.walk(item):
+                if type(child) == ast.Assign:
+                    targets = child.targets
+                elif type(child) in [ast.AugAssign, ast.For]:
+                    targets = [child.target]
+                else:
+                    continue
+                if any(type(target) == ast.Name and target.id == name for target in targets):
+                    return True
+        return False
+
+    def _handle_loop_body(self, body, name, value):
+        if type(self.symbols.get(name)) != langtypes.Var:
+            self.symbols[name] = value
+        for item in body:
+            self._handle_node(item)
 
     def _handle_control_body(self, node):
         self.section = self.nextsection
@@ -590,64 +1166,100 @@ class Compile(object):
 
     def _handle_control_end(self):
         # The the last command ends the section, don't return
-        if self.section.last().name not in ['end', 'return', 'goto']:
+        if not self._ends(['end', 'return', 'goto']):
             # self.section.append(script.Command.create('return'))
             self.section.append(script.Command.create('goto', self.returnhere))
 
     def _handle_condition(self, node, allow_return=True, invert=False):
+        # Jump to the next section if the condition holds, fall through if not
+        self._handle_branch(node, self.nextsection.dynamic(), not invert)
+
+        if allow_return:
+            self.returnhere = self.section.dynamic(len(self.section.commands))
+
+    def _handle_branch(self, node, target, when=True):
+        '''
+        Jump to `target` if the truth of the condition equals `when`, and fall
+        through otherwise. "and" and "or" short-circuit by jumping past their
+        remaining terms, so every term takes a single test and no sections are
+        added.
+        '''
         # We need to resolve the comparison into left, right and op
         if type(node) == ast.Name:
-            left = self.symbols[node.id]
+            left = self._symbol(node)
             right = 1
             op = ast.Eq()
+        elif type(node) == ast.NameConstant:
+            # True, False and None
+            if bool(node.value) == when:
+                self._add_command('goto', target)
+            return
         elif type(node) == ast.Compare:
-            if len(node.comparators) != 1:
-                errors.CompileSyntaxError(node.comparators[1])
+            if len(node.ops) > 1:
+                # "a < b < c" is "a < b and b < c"
+                operands = [node.left] + node.comparators
+                terms = [ast.copy_location(ast.Compare(left=operands[n], ops=[op], comparators=[operands[n + 1]]), node)
+                         for n, op in enumerate(node.ops)]
+                self._handle_branch(ast.copy_location(ast.BoolOp(op=ast.And(), values=terms), node), target, when)
+                return
 
-            if len(node.ops) != 1:
-                errors.CompileSyntaxError(node.ops[1])
+            if type(node.ops[0]) in [ast.In, ast.NotIn]:
+                self._handle_branch(self._membership(node), target, when == (type(node.ops[0]) == ast.In))
+                return
+
+            if type(node.ops[0]) not in self.conditions:
+                raise errors.CompileSyntaxError(node, 'Unsupported comparison {}'.format(type(node.ops[0]).__name__))
 
             if type(node.left) == ast.Name:
-                left = self.symbols[node.left.id]
+                left = self._symbol(node.left)
             else:
                 left = self._handle_type(node.left)
 
             op = node.ops[0]
 
             if type(node.comparators[0]) == ast.Name:
-                right = self.symbols[node.comparators[0].id]
+                right = self._symbol(node.comparators[0])
             else:
                 right = self._handle_type(node.comparators[0])
         elif type(node) == ast.UnaryOp:
-            if type(node.op) == ast.Not:
-                self._handle_condition(node.operand, invert=True)
-            else:
+            if type(node.op) != ast.Not:
                 raise errors.CompileSyntaxError(node.op)
 
-            # We don't want to add this condition too, so return
+            self._handle_branch(node.operand, target, not when)
             return
         elif type(node) == ast.BoolOp:
-            if type(node.op) == ast.And:
+            # "a and b" is true only if every term is, "a or b" is false only
+            # if every term is. Until the last term, a term that decides the
+            # outcome the other way skips the rest.
+            decides = type(node.op) == ast.Or
+            if decides == when:
                 for term in node.values:
-                    self.nextsection = self.script.add()
-                    self._handle_condition(term, allow_return)
-                    self.section = self.nextsection
-            elif type(node.op) == ast.Or:
-                for term in node.values:
-                    self._handle_condition(term, allow_return)
+                    self._handle_branch(term, target, when)
+            else:
+                skip = datatypes.RelativePointer(self.script, self.section, 0)
+                for term in node.values[:-1]:
+                    self._handle_branch(term, skip, decides)
+                self._handle_branch(node.values[-1], target, when)
+                skip.offset = len(self.section.commands)
             return
         else:
             raise errors.CompileSyntaxError(node)
 
-        if invert:
+        if not when:
             op = self.invert_operator[type(op)]
 
+        # Loop constants and plain definitions are known now
+        if type(left) == int and type(right) == int:
+            if self.comparisons[type(op)](left, right):
+                self._add_command('goto', target)
+            return
+
         try:
-            self._handle_comparision(left, op, right, allow_return)
+            self._handle_comparision(left, op, right, target)
         except errors.CompileTypeError:
             # Swap operands and try again
             op = self.swap_operator[type(op)]
-            self._handle_comparision(right, op, left, allow_return)
+            self._handle_comparision(right, op, left, target)
 
 #     def _swap_operator(self, op):
 #         '''
@@ -679,16 +1291,39 @@ class Compile(object):
 #         elif type(op) == ast.NotEq:
 #             return ast.Eq()
 
+    def _membership(self, node):
+        '''
+        Return a condition that holds when the left side of an "in" test is
+        one of the values on its right: "v in [1, 2]" is "v == 1 or v == 2",
+        and "v in range(1, 4)" is "1 <= v < 4".
+        '''
+        values = node.comparators[0]
+        if type(values) in [ast.List, ast.Tuple, ast.Set]:
+            if not values.elts:
+                return ast.copy_location(ast.NameConstant(False), node)
+            terms = [ast.copy_location(ast.Compare(left=node.left, ops=[ast.Eq()], comparators=[value]), value)
+                     for value in values.elts]
+            return ast.copy_location(ast.BoolOp(op=ast.Or(), values=terms), node)
+
+        if (type(values) == ast.Call and type(values.func) == ast.Name and
+                values.func.id == 'range' and 1 <= len(values.args) <= 2 and not values.keywords):
+            bounds = [self._constant(arg) for arg in values.args]
+            if None not in bounds:
+                low, high = bounds if len(bounds) == 2 else (0, bounds[0])
+                bounds = [ast.copy_location(ast.Num(n=bound), values) for bound in [low, high]]
+                return ast.copy_location(ast.Compare(left=bounds[0], ops=[ast.LtE(), ast.Lt()],
+                                                     comparators=[node.left, bounds[1]]), node)
+
+        raise errors.CompileSyntaxError(values, '"in" needs a list, tuple or set, or a range of constants')
+
     def _op(self, op):
         # Convert op to its script value
         return self.conditions[type(op)]
 
-    def _add_jump(self, op, allow_return):
-        self.section.append(script.Command.create('if1', self._op(op), self.nextsection.dynamic()))
-        if allow_return:
-            self.returnhere = self.section.dynamic(len(self.section.commands))
+    def _add_jump(self, op, target):
+        self.section.append(script.Command.create('if1', self._op(op), target))
 
-    def _handle_comparision(self, left, op, right, allow_return):
+    def _handle_comparision(self, left, op, right, target):
         if type(left) == langtypes.Flag and type(right):
             if not right:
                 # Switch the comparison to limit the amount of testing
@@ -698,7 +1333,6 @@ class Compile(object):
                 raise errors.CompileSyntaxError(op, "Invalid comparison")
 
             self._add_command('checkflag', left.value)
-            self._add_jump(op, allow_return)
         elif type(left) == langtypes.Var:
             if type(right) == int:
                 self._add_command('compare', left.value, right)
@@ -706,12 +1340,11 @@ class Compile(object):
                 self._add_command('comparevars', left.value, right.value)
             else:
                 raise errors.CompileTypeError(right, "Invalid comparison")
-            self._add_jump(op, allow_return)
         elif type(left) == langtypes.Bank:
             if type(right) == langtypes.Bank:
                 self._add_command('comparebanks', left.value, right.value)
             elif type(right) == int:
-                self._add_command('comparebanktobyte', left.value, right.value)
+                self._add_command('comparebanktobyte', left.value, right)
             elif type(right) == langtypes.Pointer:
                 self._add_command('comparebanktofarbyte', left.value, right.value)
             else:
@@ -720,16 +1353,35 @@ class Compile(object):
             if type(right) == langtypes.Bank:
                 self._add_command('comparefarbytetobank', left.value, right.value)
             elif type(right) == int:
-                self._add_command('comparefarbytetobyte', left.value, right.value)
+                self._add_command('comparefarbytetobyte', left.value, right)
             elif type(right) == langtypes.Pointer:
                 self._add_command('comparefarbytes', left.value, right.value)
             else:
                 raise errors.CompileTypeError(right, "Invalid comparison")
         elif type(left) == langtypes.HiddenVar and type(right) == int:
-            self._add_command('comparehiddenvar', right)
+            self._add_command('comparehiddenvar', left.value, right)
         else:
             raise errors.CompileTypeError(left, "Invalid comparison")
 
+        # Every kind of compare sets the same condition
+        self._add_jump(op, target)
+
+
+def _subtract(low, high, ranges):
+    '''
+    Return the parts of the range from `low` to `high` that none of the
+    (low, high) `ranges` cover.
+    '''
+    out = []
+    for start, end in sorted(ranges):
+        if end < low or start > high:
+            continue
+        if start > low:
+            out.append((low, start - 1))
+        low = max(low, end + 1)
+    if low <= high:
+        out.append((low, high))
+    return out
 
 def pdecode(data):
     out = ''
@@ -1,46 +1,194 @@
+'''
+Settings for each supported ROM, from config/roms.json.
+
+Every entry is checked and flattened once, with everything it inherits
+copied in, and the result is kept in a __subcache__ directory next to the
+file until it changes. Lookups are attribute access on plain objects::
+
+    rom = RomConfig()['BPRE']
+    rom.language                # 'red'
+    rom.table('pokemon').start  # 0x245EE0
+'''
+
+import collections
+import hashlib
 import json
+import marshal
 import os
 
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Keys every entry needs once its parents are merged in
+required = ['title', 'locale', 'language', 'tables']
+
+# Where the game code is in the ROM header
+header = 0xAC
+
+Table = collections.namedtuple('Table', ['start', 'length', 'number'])
+
+class NotSupported(IndexError):
+    pass
+
+class Rom(object):
+    '''
+    The flattened settings of one ROM.
+    '''
+
+    def __init__(self, code, data):
+        self.code = code
+        self.title = data['title']
+        self.locale = data['locale']
+        self.language = data['language']
+        self.tables = {name: Table(*value) for name, value in data['tables'].items()}
+
+    def table(self, name):
+        '''
+        Return the Table of `name` entries in the ROM.
+        '''
+        try:
+            return self.tables[name]
+        except KeyError:
+            raise NotSupported('{} has no {} table'.format(self.title, name))
+
+def _number(code, key, value):
+    # Offsets are written as hexadecimal strings, since JSON has no syntax for it
+    if type(value) == str:
+        try:
+            return int(value, 0)
+        except ValueError:
+            pass
+    elif type(value) == int:
+        return value
+    raise ValueError('"{}" of {} is not a number'.format(key, code))
+
+def flatten(config):
+    '''
+    Return every entry of a parsed roms.json with its parents merged in, as
+    marshallable dictionaries. Raises ValueError for anything missing or
+    malformed.
+    '''
+    def merged(code, seen):
+        if code not in config:
+            raise ValueError('{} inherits from unknown ROM {}'.format(seen[-1], code))
+        if code in seen:
+            raise ValueError('{} inherits from itself'.format(code))
+
+        entry = config[code]
+        if not entry.get('inherits'):
+            return dict(entry)
+
+        # Anything the child sets wins
+        out = merged(entry['inherits'], seen + [code])
+        out.update(entry)
+        return out
+
+    out = {}
+    for code in config:
+        entry = merged(code, [])
+        for key in required:
+            if key not in entry:
+                raise ValueError('{} has no "{}"'.format(code, key))
+
+        tables = {}
+        for name, table in entry['tables'].items():
+            try:
+                tables[name] = [_number(code, name + '.' + key, table[key]) for key in Table._fields]
+            except KeyError as e:
+                raise ValueError('Table {} of {} has no "{}"'.format(name, code, e.args[0]))
+
+        out[code] = {
+            'title': entry['title'],
+            'locale': entry['locale'],
+            'language': entry['language'],
+            'tables': tables,
+        }
+    return out
+
+def load(path):
+    '''
+    Return the flattened entries of a roms.json file, from its __subcache__
+    copy if it is up to date.
+    '''
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    digest = hashlib.sha1(data).hexdigest()[:16]
+    cache = os.path.join(os.path.dirname(path), '__subcache__', '{}.{}.flat'.format(os.path.basename(path), digest))
+    try:
+        with open(cache, 'rb') as file:
+            return marshal.load(file)
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+
+    try:
+        flat = flatten(json.loads(data.decode()))
+    except ValueError as e:
+        raise ValueError('{} in "{}"'.format(e, path))
+
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(cache, 'wb') as file:
+            marshal.dump(flat, file)
+    except OSError:
+        pass
+    return flat
+
+# Path -> (mtime, {code: Rom}), shared by every RomConfig in the process
+_loaded = {}
+# ROM path -> ((size, mtime, config), code), so each ROM is only detected once
+_detected = {}
+
 class RomConfig(object):
     '''
     Load settings file for a given ROM.
     Everything reading settings must use this class, so that the mechanism can
-    be easily changed. Caches lookups to speed up item retrieval.
+    be easily changed. The file is only read again when it changes.
     '''
 
-    def __init__(self):
+    def __init__(self, path=None):
+        '''
+        Constructor.
+        :param path: The settings file. Defaults to config/roms.json.
+        '''
+        self.path = path if path else os.path.join(root, 'config', 'roms.json')
+
+        mtime = os.stat(self.path).st_mtime
+        if self.path not in _loaded or _loaded[self.path][0] != mtime:
+            roms = {code: Rom(code, data) for code, data in load(self.path).items()}
+            _loaded[self.path] = (mtime, roms)
+        self.roms = _loaded[self.path][1]
+
+    def __getitem__(self, code):
+        try:
+            return self.roms[code]
+        except KeyError:
+            raise NotSupported('Rom {} not supported'.format(code) if code else 'Rom not supported')
+
+    def __contains__(self, code):
+        return code in self.roms
+
+    def __iter__(self):
+        return iter(sorted(self.roms))
+
+    def detect(self, path):
         '''
-        Constructor
+        Return the game code in the header of the ROM at `path`, or None if
+        it isn't supported.
         '''
-        with open('config/roms.json') as file:
-            self.config = json.load(file)
-
-        self.cache = {}
-
-    def __getitem__(self, index):
-        if index in self.cache:
-            return self.cache[index]
-        elif index in self.config:
-            out = self.config[index]
-
-            child = self.config[index]
-            while child['inherits']:
-                parent = self.config[child['inherits']]
-
-                # Add all parent keys to the output, unless they already exist
-                for key in parent:
-                    if key not in out:
-                        out[key] = parent[key]
-
-                # Check if parent inherited anything
-                child = parent
-
-            # Cache item for faster lookup next time
-            self.cache[index] = out
-            return out
-        else:
-            # TODO: Raise a "NotSupported" exception
-            raise IndexError("Rom not supported")
-
-c = RomConfig()
-c['AXVE']
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime, self.path)
+        if path in _detected and _detected[path][0] == key:
+            return _detected[path][1]
+
+        code = self._detect(path)
+        _detected[path] = (key, code)
+        return code
+
+    def _detect(self, path):
+        with open(path, 'rb') as file:
+            file.seek(header)
+            # Code is in ASCII, but any byte must be accepted here
+            code = file.read(4).decode('latin-1')
+            if code in self.roms:
+                return code
+            return None
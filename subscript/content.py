@@ -0,0 +1,130 @@
+'''
+Index of data that already exists in a ROM, so identical strings and
+movements can be pointed at instead of being inserted again.
+'''
+
+import marshal
+import mmap
+import os
+import re
+import zlib
+
+class ContentIndex(object):
+    '''
+    Maps the checksum of every terminated block in the ROM to the offset of its
+    first occurrence. Text is terminated by 0xFF and movements by 0xFE.
+
+    The index is cached next to the ROM, and rebuilt whenever the ROM changes.
+    '''
+
+    terminators = [0xFF, 0xFE]
+
+    # Bytes that also mark the start of a block. Movements never contain 0xFF,
+    # so a movement can start right after the end of a string.
+    boundaries = {0xFF: [], 0xFE: [0xFF]}
+
+    def __init__(self, rom, maximum=1024, exclude=None, path=None):
+        '''
+        Constructor.
+        :param rom: Path to the ROM.
+        :param maximum: The longest block worth indexing.
+        :param exclude: List of (start, end) ranges that must not be reused,
+            e.g. places this script was inserted at before.
+        :param path: Where to cache the index. Defaults to next to the ROM.
+        '''
+        self.rom = rom
+        self.path = path if path else rom + '.content'
+        self.maximum = maximum
+        self.exclude = exclude if exclude else []
+        self.blocks = {}
+
+        if not self.load():
+            self.scan()
+            self.save()
+
+    def _stamp(self):
+        stat = os.stat(self.rom)
+        return (stat.st_size, stat.st_mtime, self.maximum)
+
+    def load(self):
+        '''
+        Read the cached index. Returns False if it is missing or out of date.
+        '''
+        try:
+            with open(self.path, 'rb') as file:
+                stamp, blocks = marshal.load(file)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+
+        if stamp != self._stamp():
+            return False
+
+        self.blocks = blocks
+        return True
+
+    def save(self):
+        with open(self.path, 'wb') as file:
+            marshal.dump((self._stamp(), self.blocks), file)
+
+    def scan(self):
+        '''
+        Rebuild the index from the ROM.
+        '''
+        self.blocks = {}
+
+        with open(self.rom, 'rb') as file:
+            if not os.fstat(file.fileno()).st_size:
+                return
+
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for terminator in self.terminators:
+                    self._scan(data, terminator)
+            finally:
+                data.close()
+
+    def _scan(self, data, terminator):
+        byte = bytes([terminator])
+        run = re.compile(re.escape(byte) + b'+')
+        blocks = self.blocks
+
+        start = 0
+        position = data.find(byte)
+        while position != -1:
+            if position == start:
+                # Nothing but terminators (usually free space), skip them all
+                start = run.match(data, position).end()
+            else:
+                for boundary in self.boundaries[terminator]:
+                    start = max(start, data.rfind(bytes([boundary]), start, position) + 1)
+
+                if position > start and position - start < self.maximum:
+                    key = zlib.crc32(data[start:position + 1])
+                    if key not in blocks:
+                        blocks[key] = start
+                start = position + 1
+            position = data.find(byte, start)
+
+    def find(self, data):
+        '''
+        Return the offset of an existing copy of `data` in the ROM, or None.
+        Only terminated blocks can be found.
+        '''
+        if not data or data[-1] not in self.terminators:
+            return None
+
+        offset = self.blocks.get(zlib.crc32(data))
+        if offset == None:
+            return None
+
+        for start, end in self.exclude:
+            if offset < end and offset + len(data) > start:
+                return None
+
+        # Make sure this isn't just a checksum collision
+        with open(self.rom, 'rb') as file:
+            file.seek(offset)
+            if file.read(len(data)) != data:
+                return None
+
+        return offset
@@ -202,17 +202,11 @@ class DynamicPointer(Pointer):
     def value(self):
         # A bit more complicated than a regular value
 
-        target = self.script.sections.index(self.section)
-        # TODO: Handle if target == -1 (shouldn't happen though)
+        if self.section.address != None:
+            # The section already exists elsewhere in the ROM
+            return self.section.address
 
-        # Set the base pointer
-        size = self.script.base
-
-        # Add the size of all the sections before this one
-        for i in range(target):
-            size += self.script.sections[i].size
-
-        return size
+        return self.script.layout()[self.section]
 
     @classmethod
     def from_hex(cls, data, offset=0):
@@ -232,16 +226,35 @@ class RelativePointer(DynamicPointer):
 
     @property
     def value(self):
-        val = super().value
-        target = self.script.sections.index(self.section)
-        # Fix out by one error
-        for i in range(self.offset + 1):
-            val += self.script.sections[target].commands[i].size
-        return val
+        # The offset is the number of commands to skip
+        return super().value + self.section.offset(self.offset)
 
     def __str__(self):
         return '@' + self.section.name + '+' + str(self.offset)
 
+class SymbolPointer(Pointer):
+    '''
+    Pointer to a symbol defined by an imported object, such as a function in
+    an imported script.
+    '''
+
+    def __init__(self, script, name):
+        self._size = 4
+        self.script = script
+        self.name = name
+
+    @property
+    def value(self):
+        section, offset = self.script.externals[self.name]
+        return section.dynamic().value + offset
+
+    @classmethod
+    def from_hex(cls, data, offset=0):
+        return None
+
+    def __str__(self):
+        return '@' + self.name
+
 class Variable(Word):
     def __init__(self, val):
         if val < 0x3FFF:
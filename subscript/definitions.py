@@ -0,0 +1,81 @@
+'''
+Definition files. These hold named constants - flags, variables, item and
+species numbers - that are imported straight into a script's symbol table.
+
+A .json file groups the constants by type::
+
+    {
+        "Flag": {"GOT_STARTER": "0x200"},
+        "Var": {"STORY_PROGRESS": "0x4050"},
+        "Item": {"POTION": 13}
+    }
+
+Groups named after a simple type become that type. Any other group, such as
+"Item" above, holds plain numbers.
+
+A .rbt file is an XSE style header of "#define NAME value" lines. Names that
+start with FLAG_ or VAR_ become flags and variables, anything else is a plain
+number.
+'''
+
+import json
+
+# Types that need nothing but a number
+types = ['Flag', 'Var', 'Bank', 'Buffer', 'HiddenVar', 'Pointer']
+
+prefixes = {
+    'FLAG_': 'Flag',
+    'VAR_': 'Var',
+}
+
+def number(value):
+    # Hexadecimal is written as a string, since JSON has no syntax for it
+    if type(value) == str:
+        return int(value, 0)
+    if type(value) != int:
+        raise ValueError('"{}" is not a number'.format(value))
+    return value
+
+def parse_json(text):
+    '''
+    Return a list of (name, type, value) definitions from a .json file. The
+    type is None for plain numbers.
+    '''
+    out = []
+    for group, values in sorted(json.loads(text).items()):
+        kind = group if group in types else None
+        for name, value in sorted(values.items()):
+            out.append((name, kind, number(value)))
+    return out
+
+def parse_rbt(text):
+    '''
+    Return a list of (name, type, value) definitions from a .rbt file.
+    '''
+    out = []
+    for n, line in enumerate(text.split('\n'), 1):
+        # Comments
+        line = line.split('//')[0].split("'")[0].strip()
+        if not line:
+            continue
+
+        parts = line.split()
+        if parts[0].lower() != '#define' or len(parts) != 3:
+            raise ValueError('Invalid definition on line {}'.format(n))
+
+        name, value = parts[1], parts[2]
+        kind = None
+        for prefix, prefixed in prefixes.items():
+            if name.upper().startswith(prefix):
+                kind = prefixed
+
+        try:
+            out.append((name, kind, number(value)))
+        except ValueError:
+            raise ValueError('Invalid value on line {}'.format(n))
+    return out
+
+parsers = {
+    '.json': parse_json,
+    '.rbt': parse_rbt,
+}
@@ -3,8 +3,9 @@ class CompileError(Exception):
     def __init__(self, astnode, message=''):
         super().__init__(message)
         self.message = message
-        self.line = astnode.lineno
-        self.col = astnode.col_offset
+        # Not every error is about a node, e.g. an operand of the wrong type
+        self.line = getattr(astnode, 'lineno', None)
+        self.col = getattr(astnode, 'col_offset', None)
         self.node = astnode
 
     def __str__(self):
@@ -20,3 +21,40 @@ class CompileTypeError(CompileError):
 
 class CompileNameError(CompileError):
     pass
+
+class CompileWarning(UserWarning):
+    '''
+    Something that compiles, but is likely not to work as intended.
+    '''
+    pass
+
+def diagnostic(error):
+    '''
+    Return a dictionary describing a compile error or warning, for editors and
+    build tools: its severity ("error" or "warning"), type, message, and the
+    line and column it refers to, which are None if it has no location.
+    '''
+    out = {
+        'severity': 'warning' if isinstance(error, Warning) else 'error',
+        'type': type(error).__name__,
+        'message': None,
+        'line': None,
+        'column': None,
+    }
+
+    if isinstance(error, CompileError):
+        message = error.message
+        if not message:
+            message = 'Unexpected {}'.format(type(error.node).__name__)
+        elif isinstance(error, CompileNameError) and message.isidentifier():
+            message = 'Unknown name "{}"'.format(message)
+        out['message'] = message
+        out['line'] = error.line
+        out['column'] = error.col
+    elif isinstance(error, SyntaxError):
+        out['message'] = error.msg
+        out['line'] = error.lineno
+        out['column'] = error.offset - 1 if error.offset else None
+    else:
+        out['message'] = str(error)
+    return out
@@ -0,0 +1,263 @@
+'''
+Free space management for ROM insertion.
+'''
+
+import json
+import mmap
+import os
+import re
+
+def scan(data, byte=0xFF, minimum=16, start=0, end=None):
+    '''
+    Find every run of at least `minimum` copies of `byte` in `data`. Yields
+    (start, end) tuples, with `end` being exclusive.
+
+    The search is done with bytes.find, so the scan runs at memchr speed
+    instead of looping over the data in Python.
+
+    :param data: A bytes-like object or mmap to search.
+    :param byte: The filler byte that marks free space.
+    :param minimum: The shortest run that counts as free.
+    :param start: Offset to start scanning from.
+    :param end: Offset to stop scanning at.
+    '''
+    if end == None:
+        end = len(data)
+
+    needle = bytes([byte]) * minimum
+    run = re.compile(re.escape(bytes([byte])) + b'*')
+
+    position = start
+    while True:
+        found = data.find(needle, position, end)
+        if found == -1:
+            return
+
+        # Extend the run as far as it goes
+        stop = min(run.match(data, found).end(), end)
+        yield (found, stop)
+        position = stop
+
+class FreeSpace(object):
+    '''
+    Persistent map of the free blocks in a ROM, together with a record of
+    everything that was inserted into them.
+
+    The map is stored next to the ROM, and is rescanned whenever the ROM is
+    changed by something else.
+    '''
+
+    # The old default insertion offset. Nothing below it is touched.
+    start = 0x740000
+
+    def __init__(self, rom, start=None, fill=(0xFF,), minimum=16, path=None):
+        '''
+        Constructor.
+        :param rom: Path to the ROM.
+        :param start: Offset from which to look for free space.
+        :param fill: The bytes that count as free space.
+        :param minimum: The shortest run that counts as a free block.
+        :param path: Where to keep the map. Defaults to next to the ROM.
+        '''
+        self.rom = rom
+        self.path = path if path else rom + '.free.json'
+        if start != None:
+            self.start = start
+        self.fill = list(fill)
+        self.minimum = minimum
+
+        self.blocks = []
+        self.allocations = {}
+
+        if not self.load():
+            self.scan()
+
+    def _stamp(self):
+        stat = os.stat(self.rom)
+        return [stat.st_size, stat.st_mtime]
+
+    def load(self):
+        '''
+        Read the stored map. Returns False if there is no map, or if it is out
+        of date.
+        '''
+        try:
+            with open(self.path) as file:
+                stored = json.load(file)
+        except (IOError, ValueError):
+            return False
+
+        # The record of what lives where is kept even if the blocks are stale
+        self.allocations = {int(k): v for k, v in stored['allocations'].items()}
+
+        settings = [self.start, self.fill, self.minimum]
+        if stored['stamp'] != self._stamp() or stored['settings'] != settings:
+            return False
+
+        self.blocks = [tuple(block) for block in stored['blocks']]
+        return True
+
+    def save(self):
+        '''
+        Write the map next to the ROM. Must be called after the ROM was
+        written, so the map is not considered stale on the next load.
+        '''
+        stored = {
+            'stamp': self._stamp(),
+            'settings': [self.start, self.fill, self.minimum],
+            'blocks': self.blocks,
+            'allocations': {str(k): v for k, v in self.allocations.items()},
+        }
+
+        with open(self.path, 'w') as file:
+            json.dump(stored, file, indent=4, sort_keys=True)
+
+    def scan(self):
+        '''
+        Rebuild the list of free blocks from the ROM.
+        '''
+        blocks = []
+
+        with open(self.rom, 'rb') as file:
+            if os.fstat(file.fileno()).st_size > self.start:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for byte in self.fill:
+                        for start, end in scan(data, byte, self.minimum, self.start):
+                            # The first byte of a run may be the terminator of
+                            # whatever comes before it, so leave it alone.
+                            if start != self.start:
+                                start += 1
+                            blocks.append((start, end))
+                finally:
+                    data.close()
+
+        # Anything we inserted ourselves is not free, even if it looks like it
+        for offset, allocation in self.allocations.items():
+            blocks = self._remove(blocks, offset, offset + allocation['size'])
+
+        self.blocks = sorted(blocks)
+
+    def _remove(self, blocks, start, end):
+        out = []
+        for a, b in blocks:
+            if b <= start or a >= end:
+                out.append((a, b))
+                continue
+            if a < start:
+                out.append((a, start))
+            if b > end:
+                out.append((end, b))
+        return out
+
+    def find(self, size, align=4, strategy='first'):
+        '''
+        Find room for `size` bytes without reserving it. Returns the offset,
+        or None if there is no block large enough.
+        :param size: The number of bytes needed.
+        :param align: The alignment of the returned offset.
+        :param strategy: Either 'first' (first fit) or 'best' (best fit).
+        '''
+        if strategy not in ['first', 'best']:
+            raise ValueError('Unknown allocation strategy "{}"'.format(strategy))
+
+        best = None
+        for start, end in self.blocks:
+            offset = (start + align - 1) // align * align
+            if offset + size > end:
+                continue
+
+            if strategy == 'first':
+                return offset
+
+            waste = (end - start) - size
+            if best == None or waste < best[0]:
+                best = (waste, offset)
+
+        return best[1] if best else None
+
+    def allocate(self, size, name=None, align=4, strategy='first'):
+        '''
+        Reserve `size` bytes and record what was placed there. Returns the
+        offset.
+        :param size: The number of bytes needed.
+        :param name: A description of what will live there, e.g. a script path.
+        :param align: The alignment of the returned offset.
+        :param strategy: Either 'first' (first fit) or 'best' (best fit).
+        '''
+        offset = self.find(size, align, strategy)
+        if offset == None:
+            raise MemoryError('Not enough free space for {} bytes'.format(size))
+
+        self.reserve(offset, size, name)
+        return offset
+
+    def reserve(self, offset, size, name=None):
+        '''
+        Record that `size` bytes at `offset` are in use, whether or not they
+        were found by :meth:`allocate`.
+        '''
+        self.blocks = self._remove(self.blocks, offset, offset + size)
+        self.allocations[offset] = {'size': size, 'name': name}
+
+    def release(self, offset):
+        '''
+        Forget an allocation and return its bytes to the free list. The ROM
+        itself is not touched.
+        '''
+        allocation = self.allocations.pop(offset)
+        start, end = offset, offset + allocation['size']
+
+        # Merge with any neighbouring blocks
+        merged = []
+        for a, b in self.blocks:
+            if b == start:
+                start = a
+            elif a == end:
+                end = b
+            else:
+                merged.append((a, b))
+        merged.append((start, end))
+        self.blocks = sorted(merged)
+
+    def follow(self, build, undo=False):
+        '''
+        Keep the allocation record in step with a journal build that was just
+        applied, undone or redone. Builds that placed something record its
+        'offset', 'size' and 'script' in their metadata, whether it was
+        'allocated' from free space, and relocations also record the
+        'relocate' offset the data was moved from.
+        '''
+        meta = build['metadata']
+        if 'offset' not in meta:
+            return
+
+        placed, removed = meta['offset'], meta.get('relocate')
+        if undo:
+            placed, removed = removed, placed
+
+        if removed != None and removed in self.allocations:
+            if undo and not meta.get('allocated'):
+                # The undo put back whatever was there before, which was
+                # never free space
+                del self.allocations[removed]
+            else:
+                self.release(removed)
+        if placed != None:
+            self.reserve(placed, meta['size'], meta.get('script'))
+
+    def owner(self, offset):
+        '''
+        Return the (offset, allocation) pair that contains `offset`, or None.
+        '''
+        for start, allocation in self.allocations.items():
+            if start <= offset < start + allocation['size']:
+                return start, allocation
+        return None
+
+    @property
+    def free(self):
+        '''
+        Total number of free bytes.
+        '''
+        return sum(end - start for start, end in self.blocks)
@@ -128,7 +128,7 @@ def msgbox(script, string, keepopen=False):
     Alias for :func:`message`
     '''
     # An alias for message()
-    return message.inner(string, keepopen)
+    return message.inner(script, string, keepopen)
 
 @functions.register
 def question(script, string):
@@ -579,7 +579,7 @@ def hide(script, sprite):
     '''
     An alias for :func:`disappear`.
     '''
-    return disappear.inner(sprite)
+    return disappear.inner(script, sprite)
 
 # TODO: 0x54 hidespritepos
 # Commands 0x55 - 0x59 are missing
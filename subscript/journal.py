@@ -0,0 +1,242 @@
+'''
+Journaled ROM writes. Every build records the bytes it overwrote, so it can
+be undone and redone without touching anything else in the ROM.
+'''
+
+import binascii
+import json
+import os
+import time
+
+def apply(rom, writes):
+    '''
+    Write every (offset, data) pair to an open ROM file as one transaction:
+    if any write fails, the ones before it are rolled back. Returns the bytes
+    that were overwritten, in the same order as `writes`.
+    '''
+    original = []
+    for offset, data in writes:
+        rom.seek(offset)
+        original.append((offset, rom.read(len(data))))
+
+    try:
+        for offset, data in writes:
+            rom.seek(offset)
+            rom.write(data)
+        rom.flush()
+    except:
+        for offset, data in reversed(original):
+            rom.seek(offset)
+            rom.write(data)
+        rom.flush()
+        raise
+
+    return original
+
+class JournalError(Exception):
+    pass
+
+class Journal(object):
+    '''
+    The history of writes made to a ROM, stored next to it.
+
+    The journal file is only ever appended to. Each line is either a build,
+    holding the old and new bytes of every region it touched, or a move of
+    the head after an undo or redo. Recording a build after an undo drops the
+    builds that were undone.
+
+    The builds are only headers: their number, time, metadata and where their
+    line starts. These are kept in an index next to the journal, so loading it
+    only reads what was appended since, and the regions of a build are read
+    when it is undone or redone.
+    '''
+
+    def __init__(self, rom, path=None):
+        '''
+        Constructor.
+        :param rom: Path to the ROM.
+        :param path: Where to keep the journal. Defaults to next to the ROM.
+        '''
+        self.rom = rom
+        self.path = path if path else rom + '.journal'
+        self.index = self.path + '.index'
+
+        # Builds are numbered from 1, head is the last one applied
+        self.builds = []
+        self.head = 0
+        # How much of the journal the builds and head cover
+        self.size = 0
+
+        self.load()
+
+    def load(self):
+        '''
+        Read whatever was added to the journal since it was last read, by
+        this or any other Journal.
+        '''
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size == self.size:
+            return
+        if size < self.size:
+            # Not the journal that was read before
+            self.builds, self.head, self.size = [], 0, 0
+
+        try:
+            with open(self.index) as file:
+                stored = json.load(file)
+            if self.size < stored['size'] <= size:
+                self.builds, self.head, self.size = stored['builds'], stored['head'], stored['size']
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+        if self.size < size:
+            with open(self.path, 'rb') as file:
+                file.seek(self.size)
+                for line in file:
+                    if line.strip():
+                        self._follow(json.loads(line.decode()), self.size)
+                    self.size += len(line)
+            self._save()
+
+    def _follow(self, line, position):
+        # Apply a journal line to the headers
+        if 'head' in line:
+            self.head = line['head']
+        else:
+            del self.builds[line['build'] - 1:]
+            self.builds.append({
+                'build': line['build'],
+                'time': line['time'],
+                'metadata': line['metadata'],
+                'position': position,
+            })
+            self.head = line['build']
+
+    def _save(self):
+        stored = {'size': self.size, 'head': self.head, 'builds': self.builds}
+        try:
+            with open(self.index, 'w') as file:
+                json.dump(stored, file, sort_keys=True)
+        except IOError:
+            pass
+
+    def _append(self, line):
+        data = (json.dumps(line, sort_keys=True) + '\n').encode()
+        with open(self.path, 'ab') as file:
+            file.write(data)
+        self._follow(line, self.size)
+        self.size += len(data)
+        self._save()
+
+    def regions(self, build):
+        '''
+        Return the (offset, old, new) regions a build touched, read from the
+        journal.
+        '''
+        with open(self.path, 'rb') as file:
+            file.seek(build['position'])
+            return self._decode(json.loads(file.readline().decode()))['regions']
+
+    @staticmethod
+    def _encode(build):
+        out = dict(build)
+        out['regions'] = [[offset, binascii.hexlify(old).decode(), binascii.hexlify(new).decode()]
+                          for offset, old, new in build['regions']]
+        return out
+
+    @staticmethod
+    def _decode(line):
+        out = dict(line)
+        out['regions'] = [(offset, binascii.unhexlify(old), binascii.unhexlify(new))
+                          for offset, old, new in line['regions']]
+        return out
+
+    def record(self, writes, **metadata):
+        '''
+        Write to the ROM, recording what was there before. Returns the build
+        number.
+        :param writes: A list of (offset, data) pairs.
+        :param metadata: Anything worth keeping with the build, e.g. the name of
+            the script and where it was placed.
+        '''
+        writes = [(offset, bytes(data)) for offset, data in writes]
+        self.load()
+
+        with open(self.rom, 'rb+') as rom:
+            original = apply(rom, writes)
+
+        build = {
+            'build': self.head + 1,
+            'time': time.time(),
+            'metadata': metadata,
+            'regions': [(offset, old, new) for (offset, old), (_, new) in zip(original, writes)],
+        }
+        self._append(self._encode(build))
+
+        return self.head
+
+    def _replay(self, build, undo):
+        # Regions are (offset, old, new). Undo expects the new bytes to be there
+        # and puts the old ones back, redo does the opposite.
+        regions = self.regions(build)
+        if undo:
+            expect, writes = 2, reversed(regions)
+        else:
+            expect, writes = 1, regions
+        writes = list(writes)
+
+        with open(self.rom, 'rb+') as rom:
+            # Refuse to clobber anything changed behind the journal's back
+            for region in writes:
+                rom.seek(region[0])
+                if rom.read(len(region[expect])) != region[expect]:
+                    raise JournalError('ROM was modified at 0x{:06X} outside of build {}'.format(region[0], build['build']))
+
+            apply(rom, [(region[0], region[3 - expect]) for region in writes])
+
+    def undo(self):
+        '''
+        Undo the last applied build. Returns it, or None if there is nothing to
+        undo.
+        '''
+        self.load()
+        if not self.head:
+            return None
+
+        build = self.builds[self.head - 1]
+        self._replay(build, undo=True)
+        self._append({'head': self.head - 1})
+        return build
+
+    def redo(self):
+        '''
+        Reapply the last undone build. Returns it, or None if there is nothing
+        to redo.
+        '''
+        self.load()
+        if self.head == len(self.builds):
+            return None
+
+        build = self.builds[self.head]
+        self._replay(build, undo=False)
+        self._append({'head': self.head + 1})
+        return build
+
+    def restore(self, number):
+        '''
+        Undo or redo builds until `number` is the last one applied. Build 0 is
+        the ROM before any build. Returns the list of builds that were undone
+        or redone.
+        '''
+        if not 0 <= number <= len(self.builds):
+            raise IndexError('No build {}'.format(number))
+
+        out = []
+        while self.head > number:
+            out.append(self.undo())
+        while self.head < number:
+            out.append(self.redo())
+        return out
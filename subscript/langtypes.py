@@ -5,6 +5,7 @@ import subscript.codec
 import ast
 from subscript import errors
 import json
+import os
 import textwrap
 
 class TypeRegistry(type):
@@ -61,8 +62,13 @@ class SectionType(Type):
         requested.
         '''
         if self._section == None:
-            self._section = self.section()
+            with self.parent.profiler.measure('type', type(self).__name__):
+                self._section = self.section()
             self.parent.add(self._section)
+            self.parent.stats['emitted', type(self).__name__] += 1
+        else:
+            # The same data is used again, so it is only emitted once
+            self.parent.stats['deduplicated', type(self).__name__] += 1
 
         return self._section.dynamic()
 
@@ -88,20 +94,21 @@ class Movement(SectionType):
             raise TypeError
 
         out = bytearray()
-        debug = []
         for move in self._value:
             if type(move) == ast.Str:
                 out.append(self.__class__.table[move.s])
-                debug.append(move.s)
             elif type(move) == ast.Num:
                 out.append(move.n)
-                debug.append(move.n)
             else:
                 raise errors.CompileSyntaxError(move)
 
         # Sentinel
         if out[-1] != 0xFE:
             out.append(0xFE)
+
+        debug = None
+        if self.parent.debug:
+            debug = [move.s if type(move) == ast.Str else move.n for move in self._value]
         return subscript.script.SectionRaw(self.parent, bytes(out), debug=debug)
 
 class String(SectionType):
@@ -127,7 +134,7 @@ class String(SectionType):
         p = textparse.PoketextParser()
         p.feed(value)
         data = p.output
-        return subscript.script.SectionRaw(self.parent, data, debug=repr(text))
+        return subscript.script.SectionRaw(self.parent, data, debug=repr(text) if self.parent.debug else None)
 
 class Raw(SectionType):
     '''
@@ -194,6 +201,10 @@ class Pointer(Type):
     def value(self):
         return subscript.datatypes.Pointer(self._value)
 
+# (path, size, mtime, offset) -> TableLookup, so a long running session reads
+# each table from a ROM once
+tables = {}
+
 class TableLookup():
     '''
     Looks up a string in a table in the ROM.
@@ -207,11 +218,14 @@ class TableLookup():
         self.entry = length
         # The number of entries for this type
         self.entries = count
+        # The number of reads done on the ROM
+        self.reads = 0
 
         with open(path, 'rb') as rom:
             rom.seek(self.offset)
             for _ in range(self.entries):
                 data = rom.read(self.entry)
+                self.reads += 1
                 self.table.append(self.handle_entry(data))
 
     def handle_entry(self, data):
@@ -243,6 +257,22 @@ class TableLookup():
             raise TypeError(value)
 
 class Table(Type):
+    @staticmethod
+    def lookup(script, name):
+        '''
+        Return a TableLookup of the `name` table in the script's ROM.
+        '''
+        if not script.rom:
+            raise ValueError('Looking up {} needs a ROM'.format(name))
+
+        start, length, number = script.config[script.code].table(name)
+        stat = os.stat(script.rom)
+        key = (script.rom, stat.st_size, stat.st_mtime, start)
+        if key not in tables:
+            tables[key] = TableLookup(script.rom, start, length, number)
+            script.stats['rom_reads'] += tables[key].reads
+        return tables[key]
+
     def __init__(self, script, value):
         super().__init__(script, value)
 
@@ -256,19 +286,19 @@ class Table(Type):
 class Pokemon(Table):
 
     def __init__(self, script, value):
-        self.table = TableLookup(script.rom, 0x245EE0, 0xB, 412)
+        self.table = self.lookup(script, 'pokemon')
         super().__init__(script, value)
 
 class Item(Table):
 
     def __init__(self, script, value):
-        self.table = TableLookup(script.rom, 0x3DB028, 0x2C, 375)
+        self.table = self.lookup(script, 'items')
         super().__init__(script, value)
 
 class Attack(Table):
 
     def __init__(self, script, value):
-        self.table = TableLookup(script.rom, 0x247094, 0xD, 355)
+        self.table = self.lookup(script, 'attacks')
         super().__init__(script, value)
 
 class File(SectionType):
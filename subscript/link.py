@@ -0,0 +1,262 @@
+'''
+Relocatable objects and the linker that places them.
+
+An object holds the compiled bytes of every section of a script, the symbols
+it defines and the places in it that hold pointers. It can be placed anywhere
+in a ROM without compiling the script again.
+'''
+
+import marshal
+import struct
+import subscript.datatypes
+import subscript.script
+
+class Object(object):
+    '''
+    A compiled, but not yet placed, script.
+
+    Sections are kept in order and always placed one after the other. Symbols
+    map a name to a (section, offset) pair. Each relocation is a
+    (section, offset, target, addend) tuple: the four bytes at `offset` in
+    `section` become a pointer to `addend` bytes into `target`, which is either
+    the index of a section in this object or the name of a symbol defined by
+    another object.
+    '''
+
+    version = 1
+
+    def __init__(self, name, sections=None, symbols=None, relocations=None):
+        '''
+        Constructor.
+        :param name: Name of the object. Its symbols are known to other
+            objects as "name.symbol".
+        :param sections: A list of (name, data) pairs.
+        :param symbols: A dictionary mapping names to (section, offset) pairs.
+        :param relocations: A list of (section, offset, target, addend) tuples.
+        '''
+        self.name = name
+        self.sections = sections if sections else []
+        self.symbols = symbols if symbols else {}
+        self.relocations = relocations if relocations else []
+
+    @classmethod
+    def from_script(cls, script, name, symbols=None, embed=False):
+        '''
+        Create an object from a compiled script.
+        :param script: A subscript.script.Script.
+        :param symbols: A dictionary mapping names to the sections they start.
+            The first section is always exported as "main".
+        :param embed: Keep the objects imported by the script inside this one.
+            Otherwise pointers into them become relocations against their
+            symbols, to be resolved by the linker.
+        '''
+        sections = [s for s in script.sections if embed or type(s) != SectionObject]
+        index = {section: n for n, section in enumerate(sections)}
+        obj = cls(name)
+
+        for n, section in enumerate(sections):
+            if type(section) == SectionObject:
+                # Pointers inside an embedded object are now pointers within
+                # this section
+                offsets = section.object.offsets()
+                for source, offset, target, addend in section.object.relocations:
+                    if type(target) == str:
+                        obj.relocations.append((n, offsets[source] + offset, target, addend))
+                    else:
+                        obj.relocations.append((n, offsets[source] + offset, n, offsets[target] + addend))
+                obj.sections.append((section.name, section.object.data()))
+                continue
+
+            if isinstance(section, subscript.script.SectionRaw):
+                obj.sections.append((section.name, bytes(section.data)))
+                continue
+
+            data = bytearray()
+            for command in section.commands:
+                position = len(data) + 1
+                data.extend(command.compile())
+
+                for arg in command.args:
+                    target = None
+                    addend = 0
+                    if isinstance(arg, subscript.datatypes.SymbolPointer):
+                        target, offset = script.externals[arg.name]
+                        if target in index:
+                            addend = offset
+                        else:
+                            target = arg.name
+                    elif isinstance(arg, subscript.datatypes.DynamicPointer) and arg.section.address == None:
+                        # Pointers to sections that already exist in the ROM
+                        # are left as they are
+                        target = arg.section
+                        if isinstance(arg, subscript.datatypes.RelativePointer):
+                            addend = arg.section.offset(arg.offset)
+
+                    if target != None:
+                        if type(target) != str:
+                            target = index[target]
+                        obj.relocations.append((n, position, target, addend))
+                        data[position:position + 4] = bytes(4)
+                    position += arg.size
+
+            obj.sections.append((section.name, bytes(data)))
+
+        if sections:
+            obj.symbols['main'] = (0, 0)
+        for symbol, section in (symbols or {}).items():
+            if section in index:
+                obj.symbols[symbol] = (index[section], 0)
+
+        return obj
+
+    @property
+    def size(self):
+        return sum(len(data) for _, data in self.sections)
+
+    def offsets(self):
+        '''
+        Return the offset of every section from the start of the object.
+        '''
+        out = []
+        position = 0
+        for _, data in self.sections:
+            out.append(position)
+            position += len(data)
+        return out
+
+    def data(self):
+        '''
+        Return the bytes of every section, with the relocations left as zero.
+        '''
+        return b''.join(data for _, data in self.sections)
+
+    def relocated(self, base, symbols=None):
+        '''
+        Return the bytes of the object placed at `base`, with every relocation
+        resolved.
+        :param base: Pointer to where the object is placed.
+        :param symbols: A dictionary mapping the "object.symbol" names used by
+            the relocations to pointers.
+        '''
+        offsets = self.offsets()
+        data = bytearray(self.data())
+
+        for section, offset, target, addend in self.relocations:
+            if type(target) == str:
+                try:
+                    pointer = symbols[target] + addend
+                except (KeyError, TypeError):
+                    raise ValueError('Undefined symbol "{}" in {}'.format(target, self.name))
+            else:
+                pointer = base + offsets[target] + addend
+
+            position = offsets[section] + offset
+            data[position:position + 4] = struct.pack('<I', pointer)
+
+        return bytes(data)
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            marshal.dump((self.version, self.name, self.sections, self.symbols, self.relocations), file)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read an object written by :meth:`save`.
+        '''
+        with open(path, 'rb') as file:
+            try:
+                version, name, sections, symbols, relocations = marshal.load(file)
+            except (EOFError, ValueError, TypeError):
+                raise ValueError('"{}" is not an object file'.format(path))
+
+        if version != cls.version:
+            raise ValueError('"{}" has unsupported object version {}'.format(path, version))
+
+        return cls(name, sections, symbols, relocations)
+
+class Linker(object):
+    '''
+    Places objects in a ROM and resolves the pointers between them.
+    '''
+
+    def __init__(self):
+        self.objects = []
+        # Object name -> ROM offset
+        self.offsets = {}
+
+    def add(self, obj, offset=None):
+        '''
+        Add an object to be linked.
+        :param offset: Where to place it. If not given, it is placed by
+            :meth:`place`.
+        '''
+        if any(other.name == obj.name for other in self.objects):
+            raise ValueError('Duplicate object "{}"'.format(obj.name))
+
+        self.objects.append(obj)
+        if offset != None:
+            self.offsets[obj.name] = offset
+
+    def place(self, space, align=4, strategy='first'):
+        '''
+        Allocate room for every object that has no offset yet.
+        :param space: A subscript.freespace.FreeSpace for the ROM.
+        '''
+        for obj in self.objects:
+            if obj.name not in self.offsets:
+                self.offsets[obj.name] = space.allocate(obj.size, obj.name, align, strategy)
+
+    def symbols(self):
+        '''
+        Return a dictionary mapping "object.symbol" names to pointers.
+        '''
+        out = {}
+        for obj in self.objects:
+            offsets = obj.offsets()
+            base = self.offsets[obj.name] + 0x08000000
+            for symbol, (section, offset) in obj.symbols.items():
+                out['{}.{}'.format(obj.name, symbol)] = base + offsets[section] + offset
+        return out
+
+    def link(self):
+        '''
+        Resolve every relocation. Returns a list of (offset, data) writes, one
+        for each object.
+        '''
+        missing = [obj.name for obj in self.objects if obj.name not in self.offsets]
+        if missing:
+            raise ValueError('No offset for {}'.format(', '.join(missing)))
+
+        symbols = self.symbols()
+        writes = []
+        for obj in self.objects:
+            offset = self.offsets[obj.name]
+            writes.append((offset, obj.relocated(offset + 0x08000000, symbols)))
+
+        return writes
+
+class SectionObject(subscript.script.SectionRaw):
+    '''
+    A relocatable object included in a script, such as an imported script.
+    Its pointers are resolved against wherever the section ends up.
+    '''
+
+    def __init__(self, parent, obj):
+        subscript.script.Section.__init__(self, parent)
+        self.object = obj
+        self._size = obj.size
+        self.debug = 'import ' + obj.name
+
+    @property
+    def data(self):
+        return self.object.relocated(self.dynamic().value)
+
+    def include(self):
+        '''
+        Make the symbols of the object known to the script as "name.symbol".
+        '''
+        offsets = self.object.offsets()
+        for symbol, (section, offset) in self.object.symbols.items():
+            name = '{}.{}'.format(self.object.name, symbol)
+            self.parent.externals[name] = (self, offsets[section] + offset)
@@ -0,0 +1,82 @@
+'''
+Listings of compiled scripts. Lines are generated one at a time from a single
+layout of the script, so even very large listings can be shown or written out
+as they are produced.
+'''
+
+import json
+import subscript.script
+
+def text(script, layout):
+    '''
+    Human readable listing, with the address and size of every section.
+    '''
+    for section in script.sections:
+        address = layout[section]
+        if type(section) == subscript.script.Section:
+            yield 'Section ({} bytes) at 0x{:08X} (@{})'.format(section.size, address, section.name)
+            for command in section.commands:
+                yield '\t' + str(command)
+        else:
+            yield 'Raw data ({} bytes) at 0x{:08X} (@{})'.format(section.size, address, section.name)
+
+def jsonl(script, layout):
+    '''
+    One JSON object per line: one for each section, followed by one for each
+    of its commands. Pointers are resolved to addresses.
+    '''
+    for section in script.sections:
+        address = layout[section]
+        if type(section) == subscript.script.Section:
+            yield json.dumps({'section': section.name, 'address': address, 'size': section.size})
+            for command in section.commands:
+                yield json.dumps({
+                    'command': command.name,
+                    'address': address,
+                    'args': [arg.value for arg in command.args],
+                })
+                address += command.size
+        else:
+            yield json.dumps({
+                'section': section.name,
+                'address': address,
+                'size': section.size,
+                'data': section.data.hex(),
+            })
+
+def xse(script, layout):
+    '''
+    Listing in the style of XSE scripts, with every section at a fixed offset
+    instead of a dynamic one.
+    '''
+    for section in script.sections:
+        yield '#org 0x{:X}'.format(layout[section] - 0x08000000)
+        if type(section) == subscript.script.Section:
+            for command in section.commands:
+                args = [command.argument(arg, resolve=True) for arg in command.args]
+                yield ' '.join([command.name] + args)
+        elif type(section) == subscript.script.SectionRaw and type(section.debug) == str:
+            # The debug text of a string is its repr, quotes included
+            yield '= ' + section.debug[1:-1]
+        else:
+            yield '#raw ' + ' '.join('0x{:02X}'.format(byte) for byte in section.data)
+        yield ''
+
+formats = {
+    'text': text,
+    'json': jsonl,
+    'xse': xse,
+}
+
+def listing(script, format='text'):
+    '''
+    Return a generator over the lines of a listing of `script`, without line
+    endings.
+    :param format: One of 'text', 'json' or 'xse'.
+    '''
+    try:
+        generate = formats[format]
+    except KeyError:
+        raise ValueError('Unknown listing format "{}"'.format(format))
+
+    return generate(script, script.layout())
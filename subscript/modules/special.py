@@ -1,7 +1,7 @@
 # http://www.pokecommunity.com/showthread.php?t=184273
 # The special table is located at 0x0815FD60.
 
-register = None
+# `register` is provided by the compiler when the module is imported
 
 def special(number, variable=None):
     if variable:
@@ -10,9 +10,9 @@ def special(number, variable=None):
     return ('special', number)
 
 @register
-def heal():
+def heal(script):
     return special(0)
 
 @register
-def clear():
+def clear(script):
     return special(1)
\ No newline at end of file
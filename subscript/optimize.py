@@ -0,0 +1,615 @@
+'''
+Optimisations on compiled scripts, run after code generation and before the
+script is laid out.
+'''
+
+import collections
+import subscript.datatypes
+import subscript.script
+
+# The engine keeps at most this many return addresses. Deeper calls behave
+# like goto.
+max_depth = 20
+
+# Commands that jump to a pointer, and ones that also remember where to return
+jumps = ['goto', 'if1', 'call', 'if2']
+calls = ['call', 'if2']
+
+def code(script):
+    return [s for s in script.sections if type(s) == subscript.script.Section]
+
+def references(script):
+    '''
+    Return a dictionary mapping every section to the (section, command, arg)
+    places that point to it.
+    '''
+    out = collections.defaultdict(list)
+    for section in code(script):
+        for command in section.commands:
+            for arg in command.args:
+                if isinstance(arg, subscript.datatypes.DynamicPointer):
+                    out[arg.section].append((section, command, arg))
+    return out
+
+def _relative(refs, section):
+    # Unique relative pointers into a section. Pointer objects are shared
+    # between commands, so each must only be moved once.
+    out = {}
+    for _, _, arg in refs[section]:
+        if type(arg) == subscript.datatypes.RelativePointer:
+            out[id(arg)] = arg
+    return list(out.values())
+
+def _rewrite(section, commands, mapping, refs):
+    '''
+    Replace the commands of a section, moving every relative pointer into it.
+    :param mapping: The new index of each old command index, plus one more
+        entry for the end of the section.
+    '''
+    for pointer in _relative(refs, section):
+        pointer.offset = mapping[min(pointer.offset, len(mapping) - 1)]
+    section.replace(commands)
+
+def _is_site(command, function):
+    return (command.name in ['call', 'goto'] and command.args and
+            type(command.args[0]) == subscript.datatypes.DynamicPointer and
+            command.args[0].section is function)
+
+def _order(functions):
+    '''
+    Return the function sections callees first, leaving out any that are part
+    of a cycle of calls.
+    '''
+    callees = {}
+    for function in functions:
+        callees[function] = []
+        for command in function.commands:
+            for arg in command.args:
+                if isinstance(arg, subscript.datatypes.DynamicPointer) and arg.section in functions:
+                    callees[function].append(arg.section)
+
+    order = []
+    recursive = set()
+    state = {}
+    for root in functions:
+        if root in state:
+            continue
+        stack = [(root, iter(callees[root]))]
+        state[root] = 'visiting'
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if state.get(child) == 'visiting':
+                    recursive.add(child)
+                elif child not in state:
+                    state[child] = 'visiting'
+                    stack.append((child, iter(callees[child])))
+                    break
+            else:
+                state[node] = 'done'
+                order.append(node)
+                stack.pop()
+
+    return [f for f in order if f not in recursive]
+
+def inline(script, functions, limit=5, keep=False):
+    '''
+    Replace calls to small or single use functions with the body of the
+    function. A function is only inlined if nothing but call and goto commands
+    point to it, so its body holds no return points of its own.
+    Returns the number of calls that were replaced.
+    :param functions: A dictionary mapping names to function sections.
+    :param limit: Functions with a body of at most this many bytes are
+        inlined wherever they are used. A call takes five bytes.
+    :param keep: Keep the sections of inlined functions, e.g. because other
+        scripts can call them.
+    '''
+    refs = references(script)
+    sections = set(functions.values())
+    replaced = 0
+
+    for function in _order(sections):
+        sites = refs[function]
+        if not sites or not function.commands:
+            continue
+        if any(not _is_site(command, function) or section is function for section, command, _ in sites):
+            continue
+
+        body = function.commands
+        called = body[:-1] if body[-1].name == 'return' else None
+        if called == None and any(command.name == 'call' for _, command, _ in sites):
+            continue
+
+        size = sum(command.size for command in (called if called != None else body))
+        if len(sites) > 1 and size > limit:
+            continue
+
+        callers = []
+        for section, _, _ in sites:
+            if section not in callers:
+                callers.append(section)
+
+        inlined = []
+        for section in callers:
+            commands = []
+            mapping = []
+            for command in section.commands:
+                mapping.append(len(commands))
+                if _is_site(command, function):
+                    copy = called if command.name == 'call' else body
+                    commands.extend(copy)
+                    inlined.extend((section, c) for c in copy)
+                    replaced += 1
+                else:
+                    commands.append(command)
+            mapping.append(len(commands))
+            _rewrite(section, commands, mapping, refs)
+
+        # The inlined body now lives in the callers too
+        for section, command in inlined:
+            for arg in command.args:
+                if isinstance(arg, subscript.datatypes.DynamicPointer):
+                    refs[arg.section].append((section, command, arg))
+        del refs[function]
+
+        if not keep:
+            script.remove(function)
+
+    return replaced
+
+def tail_calls(script):
+    '''
+    Turn a call followed by a return into a goto. The return is dropped unless
+    something jumps straight to it. Returns the number of calls changed.
+    '''
+    refs = references(script)
+    changed = 0
+
+    for section in code(script):
+        targets = set(pointer.offset for pointer in _relative(refs, section))
+        commands = []
+        mapping = []
+        skip = False
+        found = False
+        for i, command in enumerate(section.commands):
+            mapping.append(len(commands))
+            if skip:
+                skip = False
+                continue
+
+            following = section.commands[i + 1] if i + 1 < len(section.commands) else None
+            if command.name == 'call' and following != None and following.name == 'return':
+                goto = subscript.script.Command.create('goto', command.args[0])
+                goto.source = command.source
+                commands.append(goto)
+                changed += 1
+                found = True
+                skip = i + 1 not in targets
+            else:
+                commands.append(command)
+        mapping.append(len(commands))
+
+        if found:
+            _rewrite(section, commands, mapping, refs)
+
+    return changed
+
+def call_depth(script):
+    '''
+    Return the deepest nesting of calls that the script can reach from its
+    first section, or None if calls can recurse without limit.
+    '''
+    sections = code(script)
+    if not sections:
+        return 0
+    known = set(sections)
+
+    # Edges are (target, weight): a call nests one level deeper, a jump doesn't
+    edges = {}
+    for section in sections:
+        edges[section] = []
+        for command in section.commands:
+            if command.name not in jumps:
+                continue
+            weight = 1 if command.name in calls else 0
+            for arg in command.args:
+                if isinstance(arg, subscript.datatypes.DynamicPointer) and arg.section in known:
+                    edges[section].append((arg.section, weight))
+                elif isinstance(arg, subscript.datatypes.SymbolPointer) and weight:
+                    # Calls into an imported script count, but what it calls
+                    # in turn is not known
+                    edges[section].append((None, weight))
+
+    components = _components(sections[0], edges)
+
+    # Components come out with every component after the ones it reaches
+    component = {}
+    for n, members in enumerate(components):
+        for member in members:
+            component[member] = n
+
+    depth = [0] * len(components)
+    for n, members in enumerate(components):
+        best = 0
+        for member in members:
+            for target, weight in edges[member]:
+                if target == None:
+                    best = max(best, weight)
+                elif component[target] == n:
+                    if weight:
+                        # A call back into the same component recurses
+                        return None
+                elif depth[component[target]] == None:
+                    return None
+                else:
+                    best = max(best, depth[component[target]] + weight)
+        depth[n] = best
+
+    return depth[component[sections[0]]]
+
+def _components(root, edges):
+    '''
+    Tarjan's algorithm, without recursion. Returns the strongly connected
+    components reachable from `root`, each after the components it reaches.
+    '''
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    out = []
+    counter = 0
+
+    # Jump targets of each node, without the ones outside the script
+    targets = {node: [t for t, _ in out if t != None] for node, out in edges.items()}
+
+    work = [(root, 0)]
+    while work:
+        node, i = work.pop()
+        if i == 0:
+            index[node] = low[node] = counter
+            counter += 1
+            stack.append(node)
+            on_stack.add(node)
+
+        if i < len(targets[node]):
+            work.append((node, i + 1))
+            target = targets[node][i]
+            if target not in index:
+                work.append((target, 0))
+            elif target in on_stack:
+                low[node] = min(low[node], index[target])
+            continue
+
+        # All children done
+        for target in targets[node]:
+            if target in on_stack:
+                low[node] = min(low[node], low[target])
+
+        if low[node] == index[node]:
+            members = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                members.append(member)
+                if member is node:
+                    break
+            out.append(members)
+
+    return out
+
+# Commands that leave every variable, flag and the condition alone
+pure = [
+    'nop', 'nop1', 'loadpointer', 'lock', 'lockall', 'release', 'releaseall',
+    'faceplayer', 'applymovement', 'applymovementpos', 'waitmovement',
+    'waitmovementpos', 'pause', 'sound', 'checksound', 'fanfare',
+    'waitfanfare', 'playsong', 'playsong2', 'fadesong', 'fadedefault',
+    'fadescreen', 'cry', 'waitcry', 'preparemsg', 'waitmsg',
+    'closeonkeypress', 'waitkeypress', 'textcolor', 'showmoney',
+    'hidemoney', 'updatemoney', 'showcoins', 'hidecoins', 'updatecoins',
+    'bufferstring', 'buffernumber', 'bufferitem', 'bufferattack',
+    'bufferPokémon', 'bufferfirstPokémon', 'bufferpartyPokémon', 'bufferstd',
+]
+
+# Commands that only set the condition
+compares = [
+    'compare', 'comparevars', 'checkflag', 'comparebanks', 'comparebanktobyte',
+    'comparebanktofarbyte', 'comparefarbytes', 'comparefarbytetobank',
+    'comparefarbytetobyte', 'comparehiddenvar',
+]
+
+# Commands that read the condition
+conditional = ['if1', 'if2', 'callstdif', 'gotostdif']
+
+# Commands after which a script doesn't go on
+stops = ['end', 'return', 'killscript']
+
+# Variables from 0x8000 up are used by the engine, e.g. for the results of
+# standard scripts
+special = 0x8000
+
+# Condition numbers of if1, as functions of the compared values
+tests = [
+    lambda a, b: a < b,
+    lambda a, b: a == b,
+    lambda a, b: a > b,
+    lambda a, b: a <= b,
+    lambda a, b: a >= b,
+    lambda a, b: a != b,
+]
+
+def _target(pointer, known):
+    # The (section, index) a pointer jumps to, or None if it leaves the script
+    if isinstance(pointer, subscript.datatypes.DynamicPointer) and pointer.section in known:
+        if type(pointer) == subscript.datatypes.RelativePointer:
+            return pointer.section, pointer.offset
+        return pointer.section, 0
+    return None
+
+def _values(command):
+    # Numbers of the arguments. Pointers are left alone, their value needs a
+    # layout of the script.
+    return [arg if isinstance(arg, subscript.datatypes.Pointer) else arg.value for arg in command.args]
+
+def _meet(a, b):
+    return {key: value for key, value in a.items() if b.get(key) == value}
+
+def _transfer(command, state, known):
+    '''
+    Return the state after `command` when it goes on to the next command, or
+    None if it never does, and a list of the (target, state) jumps it can
+    take.
+    '''
+    name = command.name
+    args = _values(command)
+
+    if name in ['goto', 'call', 'if1', 'if2']:
+        target = _target(command.args[-1], known)
+        jumps = [(target, state)] if target else []
+        if name == 'goto':
+            return None, jumps
+        if name == 'call':
+            # The function may change anything
+            return {}, jumps
+        if 'cond' in state:
+            taken = tests[args[0]](*state['cond'])
+            if name == 'if1':
+                return (None, jumps) if taken else (state, [])
+            return ({}, jumps) if taken else (state, [])
+        return ({} if name == 'if2' else state), jumps
+
+    if name in stops:
+        return None, []
+
+    state = dict(state)
+    if name == 'setvar':
+        state['var', args[0]] = args[1]
+    elif name in ['addvar', 'subvar']:
+        value = state.pop(('var', args[0]), None)
+        # Word or variable arguments from 0x4000 up name a variable
+        if isinstance(command.args[1], subscript.datatypes.Variable):
+            change = state.get(('var', args[1]))
+        else:
+            change = args[1]
+        if value != None and change != None:
+            sign = 1 if name == 'addvar' else -1
+            state['var', args[0]] = (value + sign * change) & 0xFFFF
+    elif name == 'copyvar':
+        state.pop(('var', args[0]), None)
+        if ('var', args[1]) in state:
+            state['var', args[0]] = state['var', args[1]]
+    elif name in ['setflag', 'clearflag']:
+        if args[0] < 0x4000:
+            state['flag', args[0]] = int(name == 'setflag')
+        else:
+            # The flag is named by a variable
+            state = {key: value for key, value in state.items() if key[0] != 'flag'}
+    elif name in compares:
+        state.pop('cond', None)
+        if name == 'compare':
+            operands = [state.get(('var', args[0])), args[1]]
+        elif name == 'comparevars':
+            operands = [state.get(('var', args[0])), state.get(('var', args[1]))]
+        elif name == 'checkflag':
+            operands = [state.get(('flag', args[0])), 1]
+        else:
+            operands = [None]
+        if None not in operands:
+            state['cond'] = tuple(operands)
+    elif name == 'callstd':
+        # Standard scripts only leave results in the engine's variables
+        state = {key: value for key, value in state.items()
+                 if key != 'cond' and (key[0] == 'flag' or key[1] < special)}
+    elif name not in pure:
+        state = {}
+    return state, []
+
+def _states(script, entries):
+    '''
+    Forward dataflow over the commands of the script. Returns a dictionary
+    mapping each code section to the known values before each of its
+    commands, or None for commands that can't be reached.
+    '''
+    sections = code(script)
+    known = set(sections)
+
+    # Only the places jumped to keep a state while iterating
+    starts = set((section, 0) for section in sections)
+    for section in sections:
+        for command in section.commands:
+            for arg in command.args:
+                target = _target(arg, known)
+                if target:
+                    starts.add(target)
+
+    entry = {}
+    work = []
+    for section in entries:
+        if section in known:
+            entry[section, 0] = {}
+            work.append((section, 0))
+
+    def merge(point, state):
+        if point not in entry:
+            entry[point] = state
+        else:
+            merged = _meet(entry[point], state)
+            if merged == entry[point]:
+                return
+            entry[point] = merged
+        work.append(point)
+
+    while work:
+        section, i = work.pop()
+        state = entry[section, i]
+        while state != None and i < len(section.commands):
+            state, jumps = _transfer(section.commands[i], state, known)
+            for target, jumped in jumps:
+                merge(target, jumped)
+            i += 1
+            if state != None and (section, i) in starts:
+                merge((section, i), state)
+                break
+
+    out = {}
+    for section in sections:
+        states = []
+        state = None
+        for i, command in enumerate(section.commands):
+            if (section, i) in entry:
+                state = entry[section, i]
+            states.append(state)
+            if state != None:
+                state, _ = _transfer(command, state, known)
+        out[section] = states
+    return out
+
+def _live(script):
+    '''
+    Backward dataflow of the condition. Returns a dictionary mapping each code
+    section to whether the condition may still be read after each command.
+    '''
+    sections = code(script)
+    known = set(sections)
+    live = {section: [False] * (len(section.commands) + 1) for section in sections}
+    for section in sections:
+        # Falling off the end of a section goes somewhere unknown
+        live[section][-1] = True
+
+    def before(section, i):
+        command = section.commands[i]
+        after = live[section][i + 1]
+        if command.name in conditional or command.name == 'return':
+            return True
+        if command.name in compares:
+            return False
+        if command.name in ['goto', 'call', 'if1', 'if2']:
+            target = _target(command.args[-1], known)
+            jumped = live[target[0]][min(target[1], len(target[0].commands))] if target else True
+            if command.name == 'goto':
+                return jumped
+            return jumped or after
+        if command.name in stops:
+            return False
+        return after
+
+    changed = True
+    while changed:
+        changed = False
+        for section in sections:
+            for i in reversed(range(len(section.commands))):
+                value = before(section, i)
+                if value != live[section][i]:
+                    live[section][i] = value
+                    changed = True
+
+    return {section: values[1:] for section, values in live.items()}
+
+def simplify(script, entries):
+    '''
+    Drop commands that can't change anything on any path that reaches them:
+    setting a variable or flag to the value it already has, and tests whose
+    outcome is already known, which become gotos or disappear. Then drops
+    commands and sections that can no longer be reached. Returns the number
+    of commands removed.
+    :param entries: Sections that may be started from outside the script,
+        such as functions. The first section always is.
+    '''
+    present = set(script.sections)
+    entries = [s for s in code(script)[:1] + list(entries) if s in present]
+    removed = 0
+
+    while True:
+        states = _states(script, entries)
+        refs = references(script)
+        changed = 0
+        folded = 0
+
+        for section in code(script):
+            commands = []
+            mapping = []
+            for command, state in zip(section.commands, states[section]):
+                mapping.append(len(commands))
+                if state == None:
+                    continue
+
+                name = command.name
+                args = _values(command)
+                if name == 'setvar' and state.get(('var', args[0])) == args[1]:
+                    continue
+                if name in ['addvar', 'subvar'] and args[1] == 0:
+                    continue
+                if name == 'copyvar' and (args[0] == args[1] or
+                        state.get(('var', args[0]), -1) == state.get(('var', args[1]))):
+                    continue
+                if name in ['setflag', 'clearflag'] and state.get(('flag', args[0])) == int(name == 'setflag'):
+                    continue
+                if name == 'if1' and 'cond' in state:
+                    if tests[args[0]](*state['cond']):
+                        goto = subscript.script.Command.create('goto', command.args[1])
+                        goto.source = command.source
+                        commands.append(goto)
+                        folded += 1
+                    continue
+                commands.append(command)
+            mapping.append(len(commands))
+
+            if len(commands) != len(section.commands) or folded:
+                changed += len(section.commands) - len(commands)
+                _rewrite(section, commands, mapping, refs)
+
+        # Tests whose result is never used
+        live = _live(script)
+        refs = references(script)
+        for section in code(script):
+            keep = [command.name not in compares or live[section][i] for i, command in enumerate(section.commands)]
+            if all(keep):
+                continue
+            commands = []
+            mapping = []
+            for command, kept in zip(section.commands, keep):
+                mapping.append(len(commands))
+                if kept:
+                    commands.append(command)
+            mapping.append(len(commands))
+            changed += len(section.commands) - len(commands)
+            _rewrite(section, commands, mapping, refs)
+
+        # Sections nothing points to any more
+        while True:
+            used = set(entries)
+            for section in code(script):
+                for command in section.commands:
+                    for arg in command.args:
+                        if isinstance(arg, subscript.datatypes.DynamicPointer):
+                            used.add(arg.section)
+            unused = [s for s in script.sections if s not in used and type(s) in [subscript.script.Section, subscript.script.SectionRaw]]
+            if not unused:
+                break
+            for section in unused:
+                if type(section) == subscript.script.Section:
+                    changed += len(section.commands)
+                script.remove(section)
+
+        if not changed and not folded:
+            return removed
+        removed += changed
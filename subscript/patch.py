@@ -0,0 +1,252 @@
+'''
+Patch file output. Writes to a ROM are collected and saved as an IPS, UPS or
+BPS patch, without the ROM itself being modified.
+'''
+
+import os
+import struct
+import zlib
+
+class Patch(object):
+    '''
+    A set of writes against a source ROM.
+
+    Only the regions that are written are ever read back from the ROM, so the
+    size of the patch depends on how much changed, not on the size of the ROM.
+    The UPS and BPS formats also checksum the whole ROM, which is done by
+    streaming it once.
+    '''
+
+    # How much of the ROM to read at a time when checksumming
+    chunk = 0x100000
+
+    def __init__(self, rom):
+        '''
+        Constructor.
+        :param rom: Path to the source ROM.
+        '''
+        self.rom = rom
+        self.writes = []
+
+    def write(self, offset, data):
+        '''
+        Record that `data` is written at `offset`. Later writes win over
+        earlier ones.
+        '''
+        if data:
+            self.writes.append((offset, bytes(data)))
+
+    @property
+    def source_size(self):
+        return os.path.getsize(self.rom)
+
+    @property
+    def target_size(self):
+        end = max([offset + len(data) for offset, data in self.writes] + [0])
+        return max(self.source_size, end)
+
+    def regions(self):
+        '''
+        Merge the writes into a sorted list of non-overlapping (offset, data)
+        regions.
+        '''
+        regions = []
+        for offset, data in sorted(self.writes, key=lambda write: write[0]):
+            if regions and offset <= regions[-1][0] + len(regions[-1][1]):
+                start, merged = regions[-1]
+                end = max(start + len(merged), offset + len(data))
+                merged = merged + bytearray(end - start - len(merged))
+                regions[-1] = (start, merged)
+            else:
+                regions.append((offset, bytearray(data)))
+
+        # Overlaps are resolved in the order the writes were made
+        for offset, data in self.writes:
+            for start, merged in regions:
+                if start <= offset < start + len(merged):
+                    merged[offset - start:offset - start + len(data)] = data
+                    break
+
+        return [(offset, bytes(data)) for offset, data in regions]
+
+    def changes(self, gap=0):
+        '''
+        Yields (offset, old, new) for every run of bytes that actually changes.
+        Bytes past the end of the ROM count as 0x00.
+        :param gap: Runs separated by at most this many unchanged bytes are
+            joined together.
+        '''
+        with open(self.rom, 'rb') as rom:
+            for offset, new in self.regions():
+                rom.seek(offset)
+                old = rom.read(len(new))
+                old += bytes(len(new) - len(old))
+
+                start = None
+                last = None
+                for i in range(len(new)):
+                    if old[i] == new[i]:
+                        continue
+
+                    if start == None:
+                        start = i
+                    elif i - last - 1 > gap:
+                        yield (offset + start, old[start:last + 1], new[start:last + 1])
+                        start = i
+                    last = i
+
+                if start != None:
+                    yield (offset + start, old[start:last + 1], new[start:last + 1])
+
+    def _source(self):
+        '''
+        Stream the source ROM in chunks.
+        '''
+        with open(self.rom, 'rb') as rom:
+            for data in iter(lambda: rom.read(self.chunk), b''):
+                yield data
+
+    def _target(self):
+        '''
+        Stream the patched ROM in chunks, without building it in memory.
+        '''
+        changes = list(self.changes())
+        size = self.target_size
+
+        position = 0
+        source = self._source()
+        while position < size:
+            data = bytearray(next(source, b''))
+            data += bytes(min(self.chunk, size - position) - len(data))
+
+            for offset, _, new in changes:
+                if offset + len(new) <= position or offset >= position + len(data):
+                    continue
+                a = max(offset, position)
+                b = min(offset + len(new), position + len(data))
+                data[a - position:b - position] = new[a - offset:b - offset]
+
+            yield bytes(data)
+            position += len(data)
+
+    @staticmethod
+    def _crc(chunks):
+        crc = 0
+        for data in chunks:
+            crc = zlib.crc32(data, crc)
+        return crc & 0xFFFFFFFF
+
+    @staticmethod
+    def _number(value):
+        '''
+        Variable length integer, as used by UPS and BPS.
+        '''
+        out = bytearray()
+        while True:
+            low = value & 0x7F
+            value >>= 7
+            if value == 0:
+                out.append(0x80 | low)
+                return bytes(out)
+            out.append(low)
+            value -= 1
+
+    def _checksums(self, out):
+        out += struct.pack('<I', self._crc(self._source()))
+        out += struct.pack('<I', self._crc(self._target()))
+        out += struct.pack('<I', zlib.crc32(bytes(out)) & 0xFFFFFFFF)
+        return bytes(out)
+
+    def ips(self):
+        '''
+        Create an IPS patch. IPS cannot address more than 16MB.
+        '''
+        out = bytearray(b'PATCH')
+        for offset, old, new in self.changes(gap=5):
+            # An offset that spells "EOF" would end the patch early, so the
+            # record starts a byte earlier. That byte is unchanged, so it is
+            # the one in the ROM, or 0x00 past its end.
+            if offset == 0x454F46:
+                with open(self.rom, 'rb') as rom:
+                    rom.seek(offset - 1)
+                    new = (rom.read(1) or b'\x00') + new
+                offset -= 1
+
+            for i in range(0, len(new), 0xFFFF):
+                start = offset + i
+                if start + min(len(new) - i, 0xFFFF) > 0xFFFFFF:
+                    raise ValueError('IPS patches cannot write past 16MB, use UPS or BPS')
+                data = new[i:i + 0xFFFF]
+                out += struct.pack('>I', start)[1:] + struct.pack('>H', len(data)) + data
+
+        out += b'EOF'
+        return bytes(out)
+
+    def ups(self):
+        '''
+        Create a UPS patch.
+        '''
+        out = bytearray(b'UPS1')
+        out += self._number(self.source_size)
+        out += self._number(self.target_size)
+
+        position = 0
+        for offset, old, new in self.changes():
+            out += self._number(offset - position)
+            out += bytes(a ^ b for a, b in zip(old, new))
+            out.append(0)
+            position = offset + len(new) + 1
+
+        return self._checksums(out)
+
+    def bps(self):
+        '''
+        Create a BPS patch.
+        '''
+        source = self.source_size
+        target = self.target_size
+
+        out = bytearray(b'BPS1')
+        out += self._number(source)
+        out += self._number(target)
+        # No metadata
+        out += self._number(0)
+
+        def action(kind, length):
+            return self._number(((length - 1) << 2) | kind)
+
+        def keep(start, end):
+            # Unchanged bytes come from the source, but only where it exists
+            out = bytearray()
+            if start < min(end, source):
+                out += action(0, min(end, source) - start)
+            if end > max(start, source):
+                length = end - max(start, source)
+                out += action(1, length) + bytes(length)
+            return out
+
+        position = 0
+        for offset, old, new in self.changes(gap=2):
+            out += keep(position, offset)
+            out += action(1, len(new)) + new
+            position = offset + len(new)
+        out += keep(position, target)
+
+        return self._checksums(out)
+
+    def save(self, path):
+        '''
+        Write the patch to `path`, in the format given by its extension.
+        '''
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.ips':
+            data = self.ips()
+        elif ext == '.ups':
+            data = self.ups()
+        elif ext == '.bps':
+            data = self.bps()
+        else:
+            raise ValueError('Unknown patch format "{}"'.format(ext))
+
+        with open(path, 'wb') as file:
+            file.write(data)
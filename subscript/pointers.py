@@ -0,0 +1,187 @@
+'''
+Index of every pointer in a ROM, for repointing and relocating data.
+'''
+
+import array
+import bisect
+import marshal
+import mmap
+import os
+import re
+import struct
+import subscript.journal
+import sys
+
+# Where the ROM is mapped in memory
+base = 0x08000000
+
+class PointerIndex(object):
+    '''
+    Every 32-bit word in the ROM whose value points into the ROM, sorted by the
+    offset it points at. Offsets, not pointers, are used throughout.
+
+    Only aligned words are indexed unless `aligned` is False. Script commands
+    are not aligned, so pointers inside scripts need the unaligned index.
+    '''
+
+    def __init__(self, rom, aligned=True, path=None):
+        '''
+        Constructor.
+        :param rom: Path to the ROM.
+        :param aligned: Only index words at offsets that are a multiple of 4.
+        :param path: Where to cache the index. Defaults to next to the ROM.
+        '''
+        self.rom = rom
+        self.aligned = aligned
+        if path:
+            self.path = path
+        else:
+            self.path = rom + ('.pointers' if aligned else '.pointers-unaligned')
+
+        # Parallel arrays, sorted by target
+        self.targets = array.array('I')
+        self.locations = array.array('I')
+
+        if not self.load():
+            self.scan()
+            self.save()
+
+    def _stamp(self):
+        stat = os.stat(self.rom)
+        return (stat.st_size, stat.st_mtime)
+
+    def load(self):
+        '''
+        Read the cached index. Returns False if it is missing or out of date.
+        '''
+        try:
+            with open(self.path, 'rb') as file:
+                stamp, targets, locations = marshal.load(file)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+
+        if stamp != self._stamp():
+            return False
+
+        self.targets = array.array('I', targets)
+        self.locations = array.array('I', locations)
+        return True
+
+    def save(self):
+        with open(self.path, 'wb') as file:
+            marshal.dump((self._stamp(), self.targets.tobytes(), self.locations.tobytes()), file)
+
+    def scan(self):
+        '''
+        Rebuild the index from the ROM.
+
+        The words are read into arrays, one for each alignment, and the regex
+        engine picks out the ones whose top byte can be that of a ROM pointer,
+        so Python only looks at those candidates. Each is kept as one integer,
+        target above location, so a plain integer sort orders them by target.
+        '''
+        with open(self.rom, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size < 4:
+                self.targets = array.array('I')
+                self.locations = array.array('I')
+                return
+
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                keys = []
+                top = min((base + size - 1) >> 24, 0x09)
+                candidate = re.compile(b'[' + re.escape(bytes([base >> 24])) + b'-' + re.escape(bytes([top])) + b']')
+                for phase in [0] if self.aligned else range(4):
+                    count = (size - phase) // 4
+                    words = array.array('I')
+                    words.frombytes(data[phase:phase + count * 4])
+                    if sys.byteorder == 'big':
+                        words.byteswap()
+
+                    # The top byte of every word of this alignment
+                    tops = data[phase + 3:phase + count * 4:4]
+                    keys.extend([(words[i] - base) << 32 | i << 2 | phase
+                                 for i in [match.start() for match in candidate.finditer(tops)]])
+            finally:
+                data.close()
+
+        keys.sort()
+        # Words past the end of the ROM aren't pointers into it
+        del keys[bisect.bisect_left(keys, size << 32):]
+
+        halves = memoryview(array.array('Q', keys).tobytes()).cast('I')
+        low, high = (0, 1) if sys.byteorder == 'little' else (1, 0)
+        self.targets = array.array('I', halves[high::2].tobytes())
+        self.locations = array.array('I', halves[low::2].tobytes())
+
+    def references(self, start, end=None):
+        '''
+        Return a list of (location, target) pairs for every pointer to an
+        offset between `start` and `end` (exclusive). If `end` is not given,
+        only pointers to `start` itself are returned.
+        '''
+        if end == None:
+            end = start + 1
+
+        low = bisect.bisect_left(self.targets, start)
+        high = bisect.bisect_left(self.targets, end)
+        return [(self.locations[i], self.targets[i]) for i in range(low, high)]
+
+    def __len__(self):
+        return len(self.targets)
+
+def relocation(rom, old, size, new, index, fill=0xFF):
+    '''
+    Work out the writes needed to move `size` bytes at offset `old` to offset
+    `new`, and repoint every reference to the old location. Pointers inside
+    the moved data move with it.
+
+    Returns a list of (offset, data) writes, and the list of locations that
+    are repointed.
+    :param rom: A ROM file opened for reading.
+    :param old: Where the data is now.
+    :param size: How many bytes to move.
+    :param new: Where to move the data to.
+    :param index: A PointerIndex for the ROM.
+    :param fill: Byte used to wipe the old location.
+    '''
+    rom.seek(old)
+    data = bytearray(rom.read(size))
+    if len(data) != size:
+        raise ValueError('Cannot relocate past the end of the ROM')
+
+    writes = []
+    patched = []
+    outside = {}
+    for location, target in index.references(old, old + size):
+        pointer = struct.pack('<I', target - old + new + 0x08000000)
+
+        if old <= location and location + 4 <= old + size:
+            # The pointer moves along with the data
+            data[location - old:location - old + 4] = pointer
+            patched.append(location - old + new)
+        else:
+            outside[location] = pointer
+            patched.append(location)
+
+    # Wipe whatever part of the old location the new data doesn't cover
+    for start, end in [(old, min(old + size, new)), (max(old, new + size), old + size)]:
+        if start < end:
+            writes.append((start, bytes([fill]) * (end - start)))
+    writes.append((new, bytes(data)))
+    writes.extend(sorted(outside.items()))
+
+    return writes, sorted(patched)
+
+def relocate(rom, old, size, new, index, fill=0xFF):
+    '''
+    Move data and repoint every reference to it, as described in
+    :func:`relocation`. Either every write happens, or none of them do.
+
+    Returns the list of locations that were repointed.
+    :param rom: A ROM file opened in 'rb+' mode.
+    '''
+    writes, patched = relocation(rom, old, size, new, index, fill)
+    subscript.journal.apply(rom, writes)
+    return patched
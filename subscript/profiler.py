@@ -0,0 +1,118 @@
+'''
+Compile profiler. Records where the time goes during a compile: per phase,
+per AST node handler, per registry function and per language type.
+'''
+
+import collections
+import time
+
+class _Measure(object):
+    '''
+    Context manager for a single measurement.
+    '''
+
+    def __init__(self, profiler, key):
+        self.profiler = profiler
+        self.key = key
+
+    def __enter__(self):
+        # [key, start time, time spent in children]
+        self.profiler.stack.append([self.key, time.perf_counter(), 0.0])
+
+    def __exit__(self, *exc):
+        self.profiler._finish(time.perf_counter())
+        return False
+
+class Profiler(object):
+    '''
+    Collects timings for nested measurements. Each measurement has a category
+    (e.g. 'node', 'function' or 'type') and a name within that category.
+
+    For every (category, name) pair, the number of calls, the cumulative time
+    (including anything measured inside it) and the own time (excluding it)
+    are recorded. Own time is also recorded per stack, in the collapsed format
+    used by flamegraph tools.
+    '''
+
+    def __init__(self):
+        self.stack = []
+        # (category, name) -> [calls, cumulative, own]
+        self.stats = {}
+        self.stacks = collections.Counter()
+
+    def measure(self, category, name):
+        '''
+        Return a context manager that measures the code run inside it.
+        '''
+        return _Measure(self, (category, name))
+
+    def _finish(self, end):
+        key, start, children = self.stack.pop()
+        elapsed = end - start
+        own = elapsed - children
+
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+        stat = self.stats.setdefault(key, [0, 0.0, 0.0])
+        stat[0] += 1
+        stat[2] += own
+
+        # Recursive calls are already counted by the outermost one
+        if all(frame[0] != key for frame in self.stack):
+            stat[1] += elapsed
+
+        path = ';'.join('{}:{}'.format(*frame[0]) for frame in self.stack)
+        path += (';' if path else '') + '{}:{}'.format(*key)
+        self.stacks[path] += own
+
+    def table(self, sort='cumulative', limit=None):
+        '''
+        Return the statistics as a formatted table, sorted by 'cumulative',
+        'own' or 'calls'.
+        '''
+        column = {'calls': 0, 'cumulative': 1, 'own': 2}[sort]
+        rows = sorted(self.stats.items(), key=lambda item: item[1][column], reverse=True)
+        if limit:
+            rows = rows[:limit]
+
+        out = ['{:>8} {:>12} {:>12}  {}'.format('calls', 'cumulative', 'own', 'name')]
+        for (category, name), (calls, cumulative, own) in rows:
+            out.append('{:>8} {:>11.6f}s {:>11.6f}s  {}:{}'.format(calls, cumulative, own, category, name))
+        return '\n'.join(out)
+
+    def collapsed(self):
+        '''
+        Return the own time of every stack in collapsed stack format, one
+        "frame;frame;frame microseconds" line per stack.
+        '''
+        lines = []
+        for path, seconds in sorted(self.stacks.items()):
+            lines.append('{} {}'.format(path, int(round(seconds * 1000000))))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path):
+        '''
+        Write the collapsed stacks to a file.
+        '''
+        with open(path, 'w') as file:
+            file.write(self.collapsed())
+
+class _NullMeasure(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+class NullProfiler(object):
+    '''
+    Stands in for a Profiler when nothing is being profiled.
+    '''
+    _measure = _NullMeasure()
+
+    def measure(self, category, name):
+        return self._measure
+
+# Shared instance for unprofiled compiles
+null = NullProfiler()
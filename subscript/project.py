@@ -0,0 +1,367 @@
+'''
+Project builds. A manifest lists the scripts of a hack, and building it
+compiles only the scripts whose inputs changed, in parallel, and places the
+results in the ROM.
+
+A manifest is a JSON file::
+
+    {
+        "rom": "hack.gba",
+        "scripts": ["scripts/*.sub"],
+        "path": ["scripts/lib"],
+        "start": "0x740000",
+        "align": 4,
+        "build": "build",
+        "mode": "release"
+    }
+
+Paths are relative to the manifest. Only "rom" and "scripts" are required.
+The mode is passed on to subscript.compile.Compile, and is "release" unless
+the manifest asks for "debug".
+'''
+
+import ast
+import concurrent.futures
+import glob
+import json
+import os
+import struct
+import subscript.compile
+import subscript.errors
+import subscript.freespace
+import subscript.journal
+import subscript.link
+import subscript.pointers
+import subscript.resolver
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Every script depends on these
+tables = [
+    os.path.join(root, 'tables', 'commands.json'),
+    os.path.join(root, 'tables', 'movements.json'),
+    os.path.join(root, 'tables', 'text.json'),
+    os.path.join(root, 'config', 'roms.json'),
+]
+
+# One resolver per search path, kept for the life of a worker process
+resolvers = {}
+
+class BuildError(Exception):
+    pass
+
+def stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+def imports(path):
+    '''
+    Return the names imported by a script.
+    '''
+    with open(path) as file:
+        tree = ast.parse(file.read(), path)
+
+    names = []
+    for node in ast.walk(tree):
+        if type(node) == ast.Import:
+            names.extend(alias.name for alias in node.names)
+    return names
+
+def compile_object(path, rom, name, search, mode='release'):
+    '''
+    Compile a single script into a relocatable object. Returns the object,
+    the objects of the scripts it imports, and a source map of the object.
+    Runs in a worker process, so only picklable errors are raised.
+    '''
+    with open(path) as file:
+        source = file.read()
+
+    key = tuple(search)
+    if key not in resolvers:
+        resolvers[key] = subscript.resolver.Resolver(search)
+
+    # Report every error in the script at once
+    c = subscript.compile.Compile(source, 0x08000000, rom, path=path, resolver=resolvers[key], mode=mode, recover=True)
+    if c.errors:
+        raise BuildError('\n'.join('{}:{}: {}'.format(path, d['line'], d['message']) for d in c.diagnostics() if d['severity'] == 'error'))
+
+    return c.object(name), [section.object for section in c.libraries.values()], c.sourcemap(embed=False)
+
+def labels(old, obj, offset):
+    '''
+    Return a dictionary mapping the old offset of a rebuilt script, and of
+    every function in it, to the new one.
+    :param old: The build record of the old copy.
+    '''
+    start = old['offset']
+    out = {start: offset}
+    try:
+        previous = subscript.link.Object.load(old['object'])
+    except (KeyError, IOError, ValueError):
+        return out
+
+    before = previous.offsets()
+    after = obj.offsets()
+    for symbol, (section, position) in previous.symbols.items():
+        if symbol in obj.symbols:
+            new_section, new_position = obj.symbols[symbol]
+            out[start + before[section] + position] = offset + after[new_section] + new_position
+    return out
+
+class Project(object):
+    '''
+    A set of scripts built into one ROM.
+
+    What was built from which inputs is kept in a state file in the build
+    directory. A script is rebuilt when any of its inputs changes, or when the
+    ROM was changed by something other than the build.
+    '''
+
+    def __init__(self, path):
+        '''
+        Constructor.
+        :param path: Path to the manifest.
+        '''
+        self.path = os.path.abspath(path)
+        self.directory = os.path.dirname(self.path)
+
+        with open(self.path) as file:
+            manifest = json.load(file)
+
+        try:
+            self.rom = self._path(manifest['rom'])
+            patterns = manifest['scripts']
+        except KeyError as e:
+            raise BuildError('Manifest is missing "{}"'.format(e.args[0]))
+
+        self.search = [self._path(p) for p in manifest.get('path', [])]
+        self.resolver = subscript.resolver.Resolver(self.search)
+        self.start = self._number(manifest.get('start', subscript.freespace.FreeSpace.start))
+        self.align = self._number(manifest.get('align', 4))
+        self.build_directory = self._path(manifest.get('build', 'build'))
+        self.mode = manifest.get('mode', 'release')
+        if self.mode not in ['debug', 'release']:
+            raise BuildError('Unknown mode "{}"'.format(self.mode))
+        self.state_path = os.path.join(self.build_directory, 'state.json')
+
+        scripts = set()
+        for pattern in patterns:
+            scripts.update(glob.glob(self._path(pattern)))
+        self.targets = {self._name(script): script for script in scripts}
+
+        self.state = {'rom': None, 'targets': {}}
+        try:
+            with open(self.state_path) as file:
+                self.state = json.load(file)
+        except (IOError, ValueError):
+            pass
+
+    def _path(self, path):
+        return os.path.normpath(os.path.join(self.directory, path))
+
+    @staticmethod
+    def _number(value):
+        # Hexadecimal is written as a string, since JSON has no syntax for it
+        return int(value, 0) if type(value) == str else value
+
+    def _name(self, script):
+        name = os.path.splitext(os.path.relpath(script, self.directory))[0]
+        return name.replace(os.sep, '.')
+
+    def resolve(self, name, script):
+        '''
+        Return the path of the file that an import of `name` in `script`
+        refers to, or None.
+        '''
+        return self.resolver.find(name, os.path.dirname(script))
+
+    def inputs(self, script):
+        '''
+        Return every file that the compile of `script` reads, including the
+        scripts imported by the scripts it imports.
+        '''
+        found = set(tables)
+        pending = [script]
+        while pending:
+            path = pending.pop()
+            if path in found:
+                continue
+            found.add(path)
+
+            for name in imports(path):
+                resolved = self.resolve(name, path)
+                if resolved == None:
+                    # The compile will report it
+                    continue
+                if resolved.endswith('.sub'):
+                    pending.append(resolved)
+                else:
+                    found.add(resolved)
+
+        return sorted(found)
+
+    def graph(self):
+        '''
+        Return a dictionary mapping every target to its inputs.
+        '''
+        return {name: self.inputs(script) for name, script in self.targets.items()}
+
+    def stale(self):
+        '''
+        Return the names of the targets that need to be rebuilt.
+        '''
+        if self.state['rom'] != stamp(self.rom):
+            return sorted(self.targets)
+
+        out = []
+        for name in sorted(self.targets):
+            built = self.state['targets'].get(name)
+            if not built or not self._current(built['inputs']):
+                out.append(name)
+        return out
+
+    def _current(self, inputs):
+        # Only stat the inputs, so a no-op build never parses anything
+        for path, old in inputs.items():
+            try:
+                if stamp(path) != old:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def build(self, jobs=None, log=print):
+        '''
+        Rebuild every stale target and place it in the ROM. Nothing is written
+        unless every target compiles. Returns the names that were rebuilt.
+        :param jobs: How many compiles to run at once. Defaults to the number
+            of processors.
+        '''
+        stale = self.stale()
+        removed = [name for name in self.state['targets'] if name not in self.targets]
+        if not stale and not removed:
+            return []
+
+        # Stamp the inputs before compiling, so edits made during the build
+        # are picked up by the next one
+        inputs = {}
+        for name in stale:
+            inputs[name] = {path: stamp(path) for path in self.inputs(self.targets[name])}
+
+        objects = {}
+        libraries = {}
+        sourcemaps = {}
+        failed = []
+        if len(stale) > 1 and jobs != 1:
+            with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+                futures = {pool.submit(compile_object, self.targets[name], self.rom, name, self.search, self.mode): name for name in stale}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        objects[futures[future]], imported, sourcemaps[futures[future]] = future.result()
+                        libraries.update((lib.name, lib) for lib in imported)
+                    except BuildError as e:
+                        failed.append(str(e))
+        else:
+            for name in stale:
+                try:
+                    objects[name], imported, sourcemaps[name] = compile_object(self.targets[name], self.rom, name, self.search, self.mode)
+                    libraries.update((lib.name, lib) for lib in imported)
+                except BuildError as e:
+                    failed.append(str(e))
+
+        if failed:
+            raise BuildError('\n'.join(sorted(failed)))
+
+        os.makedirs(self.build_directory, exist_ok=True)
+        built = self.state['targets']
+        # Imported scripts are placed once, and linked against by every script
+        # that imports them
+        placed = self.state.setdefault('libraries', {})
+        space = subscript.freespace.FreeSpace(self.rom, self.start)
+
+        for name in removed:
+            offset = built.pop(name)['offset']
+            if offset in space.allocations:
+                space.release(offset)
+            log('Removed {}'.format(name))
+
+        # Free the old copies first, so a script that still fits stays put
+        linker = subscript.link.Linker()
+        pending = [(objects[name], built.get(name)) for name in sorted(objects)]
+        pending += [(libraries[name], placed.get(name)) for name in sorted(libraries)]
+        for obj, old in pending:
+            if old and old['offset'] in space.allocations:
+                space.release(old['offset'])
+
+            offset = None
+            if old and obj.size <= old['size']:
+                offset = old['offset']
+                space.reserve(offset, obj.size, obj.name)
+            linker.add(obj, offset)
+        # Scripts that didn't stay put are placed in free space
+        allocated = [obj.name for obj, _ in pending if obj.name not in linker.offsets]
+        linker.place(space, self.align)
+
+        placements = list(zip(linker.objects, linker.link()))
+        written = [(offset, offset + len(data)) for _, (offset, data) in placements]
+
+        # Work out every write first, so a script that can't be moved stops
+        # the build before anything is written
+        index = None
+        changes = []
+        for obj, (offset, data) in placements:
+            writes = [(offset, data)]
+
+            # Anything pointing at a script that moved, or at a function in
+            # it, is pointed at the new copy. Functions can move even if the
+            # script stays put.
+            moved = None
+            records = placed if obj.name in libraries else built
+            old = records.get(obj.name)
+            targets = labels(old, obj, offset) if old else {}
+            if any(before != after for before, after in targets.items()):
+                if old['offset'] != offset:
+                    moved = old['offset']
+                if index == None:
+                    # Pointers in scripts are not aligned
+                    index = subscript.pointers.PointerIndex(self.rom, False)
+                start, end = old['offset'], old['offset'] + old['size']
+                for location, target in index.references(start, end):
+                    # Pointers in the old copy, or in anything this build
+                    # writes over, are gone anyway
+                    if any(low < location + 4 and location < high for low, high in [(start, end)] + written):
+                        continue
+                    if target not in targets:
+                        raise BuildError('Can\'t rebuild {}: 0x{:06X} points to 0x{:06X} inside it, which is not the start of one of its functions'.format(obj.name, location, target))
+                    if targets[target] != target:
+                        writes.append((location, struct.pack('<I', targets[target] + 0x08000000)))
+
+            changes.append((obj, offset, data, writes, moved))
+
+        journal = subscript.journal.Journal(self.rom)
+        for obj, offset, data, writes, moved in changes:
+            records = placed if obj.name in libraries else built
+            journal.record(writes, script=obj.name, offset=offset, size=len(data), relocate=moved, allocated=obj.name in allocated)
+
+            path = os.path.join(self.build_directory, obj.name + '.subo')
+            obj.save(path)
+            records[obj.name] = {'offset': offset, 'size': len(data), 'object': path}
+            if obj.name in objects:
+                records[obj.name]['inputs'] = inputs[obj.name]
+
+                sourcemap = sourcemaps[obj.name]
+                sourcemap.base = offset + 0x08000000
+                records[obj.name]['map'] = os.path.join(self.build_directory, obj.name + '.map.json')
+                sourcemap.save(records[obj.name]['map'])
+            log('Built {} at 0x{:06X} ({} bytes)'.format(obj.name, offset, len(data)))
+
+        space.save()
+        self.state['rom'] = stamp(self.rom)
+        self.save()
+
+        return sorted(objects)
+
+    def save(self):
+        os.makedirs(self.build_directory, exist_ok=True)
+        with open(self.state_path, 'w') as file:
+            json.dump(self.state, file, indent=4, sort_keys=True)
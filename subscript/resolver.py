@@ -0,0 +1,290 @@
+'''
+Import resolution. Finds the file that an import refers to, and keeps what
+was loaded from it for the rest of the session.
+'''
+
+import ast
+import hashlib
+import marshal
+import os
+import runpy
+import subscript.compile
+import subscript.config
+import subscript.definitions
+import subscript.link
+import subscript.registry
+
+# Modules that ship with the compiler. Always searched last.
+modules = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modules')
+
+# Digest of the compiler's own code and tables, see compiler()
+_compiler = None
+
+def compiler():
+    '''
+    Return a digest of everything that decides how a script compiles, apart
+    from the script and its imports: the compiler, its tables and the object
+    format. Objects cached by a different compiler are not used.
+    '''
+    global _compiler
+    if _compiler == None:
+        digest = hashlib.sha1(str(subscript.link.Object.version).encode())
+        package = os.path.dirname(os.path.abspath(__file__))
+        root = os.path.dirname(package)
+        for directory in [package, os.path.join(root, 'tables'), os.path.join(root, 'config')]:
+            for name in sorted(os.listdir(directory)):
+                if os.path.splitext(name)[1] in ['.py', '.json']:
+                    with open(os.path.join(directory, name), 'rb') as file:
+                        digest.update(name.encode())
+                        digest.update(file.read())
+        _compiler = digest.hexdigest()
+    return _compiler
+
+class Resolver(object):
+    '''
+    Resolves import names against a list of directories.
+
+    Each directory is listed once, and every file that is loaded is only
+    checked for changes once, until :meth:`refresh` is called. A long running
+    session (the GUI, a project build) should call it before each compile, so
+    edits are picked up without hitting the file system for every import.
+    '''
+
+    # When several files share a name, the first extension wins
+    extensions = ['.py', '.pyc', '.sub', '.asm', '.s', '.c', '.bin', '.raw', '.json', '.rbt']
+
+    def __init__(self, search=None):
+        '''
+        Constructor.
+        :param search: Directories to look for imports in, before the bundled
+            modules.
+        '''
+        self.search = list(search if search else []) + [modules]
+
+        # Directory -> {name: path}
+        self._index = {}
+        # Path -> (mtime, value), for Python modules, raw includes and
+        # definitions
+        self._modules = {}
+        self._raw = {}
+        self._definitions = {}
+        # (path, rom, code) -> (key, object), for imported scripts
+        self._scripts = {}
+        # Scripts being compiled for an import, to catch circular imports
+        self._compiling = set()
+        # Paths whose mtime was checked since the last refresh
+        self._checked = set()
+
+    def refresh(self):
+        '''
+        Forget the directory listings, and check loaded files for changes the
+        next time they are imported.
+        '''
+        self._index = {}
+        self._checked = set()
+
+    def index(self, directory):
+        '''
+        Return a dictionary mapping import names to the files in `directory`.
+        '''
+        try:
+            return self._index[directory]
+        except KeyError:
+            pass
+
+        found = {}
+        try:
+            entries = [entry for entry in os.scandir(directory) if entry.is_file()]
+        except OSError:
+            entries = []
+
+        for entry in entries:
+            base, ext = os.path.splitext(entry.name)
+            if ext in self.extensions:
+                found.setdefault(base, []).append((self.extensions.index(ext), entry.path))
+
+        index = {name: min(paths)[1] for name, paths in found.items()}
+        self._index[directory] = index
+        return index
+
+    def find(self, name, directory=None):
+        '''
+        Return the path of the file that an import of `name` refers to, or
+        None.
+        :param directory: Directory of the importing script, which is searched
+            first.
+        '''
+        for path in ([directory] if directory else []) + self.search:
+            found = self.index(path).get(name)
+            if found:
+                return found
+        return None
+
+    def _cached(self, cache, path, load):
+        if path in cache and path in self._checked:
+            return cache[path][1]
+
+        mtime = os.stat(path).st_mtime
+        self._checked.add(path)
+        if path in cache and cache[path][0] == mtime:
+            return cache[path][1]
+
+        value = load(path)
+        cache[path] = (mtime, value)
+        return value
+
+    def module(self, path, name):
+        '''
+        Return the registry of functions defined by a Python module. The module
+        is only run again if it changed.
+        '''
+        def load(path):
+            registry = subscript.registry.Registry(name)
+            runpy.run_path(path, init_globals={'register': registry.register})
+            return registry
+
+        return self._cached(self._modules, path, load)
+
+    def raw(self, path):
+        '''
+        Return the contents of a raw include.
+        '''
+        def load(path):
+            with open(path, 'rb') as file:
+                return file.read()
+
+        return self._cached(self._raw, path, load)
+
+    def _digest(self, path, digest, seen):
+        '''
+        Add the contents of `path`, and of everything it imports, to `digest`.
+        '''
+        if path in seen:
+            return
+        seen.add(path)
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        digest.update(path.encode())
+        digest.update(data)
+
+        if os.path.splitext(path)[1] != '.sub':
+            return
+        try:
+            tree = ast.parse(data.decode())
+        except (SyntaxError, ValueError):
+            # The compile will report it
+            return
+
+        for node in ast.walk(tree):
+            if type(node) == ast.Import:
+                for alias in node.names:
+                    found = self.find(alias.name, os.path.dirname(path))
+                    digest.update(alias.name.encode())
+                    if found:
+                        self._digest(found, digest, seen)
+
+    def key(self, path, rom=None, code=None):
+        '''
+        Return the key that an imported script is cached under. It changes
+        with the script, anything it imports, the game it is compiled for, the
+        name tables of the ROM and the compiler.
+        '''
+        digest = hashlib.sha1(compiler().encode())
+        self._digest(path, digest, set())
+
+        config = subscript.config.RomConfig()
+        if code in config:
+            digest.update(code.encode())
+            if rom:
+                with open(rom, 'rb') as file:
+                    for start, length, number in sorted(config[code].tables.values()):
+                        file.seek(start)
+                        digest.update(file.read(length * number))
+        return digest.hexdigest()[:16]
+
+    def script(self, path, name, rom=None, code=None):
+        '''
+        Return an imported script as a subscript.link.Object. Scripts are
+        compiled once for each version of their source and imports, and the
+        result is kept in a __subcache__ directory next to them, like Python's
+        __pycache__. Anything the script imports itself is included in the
+        object.
+        :param rom: The ROM that the importing script is compiled for.
+        :param code: Its game code.
+        '''
+        cached = (path, rom, code)
+        if cached in self._scripts and cached in self._checked:
+            return self._scripts[cached][1]
+
+        digest = self.key(path, rom, code)
+        self._checked.add(cached)
+        if cached in self._scripts and self._scripts[cached][0] == digest:
+            return self._scripts[cached][1]
+
+        cache = os.path.join(os.path.dirname(path), '__subcache__', '{}.{}.subo'.format(name, digest))
+        try:
+            obj = subscript.link.Object.load(cache)
+        except (IOError, ValueError):
+            obj = None
+
+        if obj == None:
+            if path in self._compiling:
+                raise ImportError('Circular import of "{}".'.format(name))
+
+            with open(path, 'rb') as file:
+                source = file.read()
+
+            self._compiling.add(path)
+            try:
+                c = subscript.compile.Compile(source.decode(), 0x08000000, rom, path=path, resolver=self, library=True, mode='release', code=code)
+            finally:
+                self._compiling.discard(path)
+            obj = c.object(name, embed=True)
+
+            try:
+                os.makedirs(os.path.dirname(cache), exist_ok=True)
+                obj.save(cache)
+            except OSError:
+                # Libraries in read-only places are simply compiled every time
+                pass
+
+        self._scripts[cached] = (digest, obj)
+        return obj
+
+    def definitions(self, path):
+        '''
+        Return the (name, type, value) definitions in a .json or .rbt file.
+        They are parsed once for each version of the file, and kept in a
+        __subcache__ directory next to it.
+        '''
+        def load(path):
+            with open(path, 'rb') as file:
+                data = file.read()
+
+            base, ext = os.path.splitext(os.path.basename(path))
+            digest = hashlib.sha1(data).hexdigest()[:16]
+            cache = os.path.join(os.path.dirname(path), '__subcache__', '{}{}.{}.defs'.format(base, ext, digest))
+            try:
+                with open(cache, 'rb') as file:
+                    return marshal.load(file)
+            except (IOError, EOFError, ValueError, TypeError):
+                pass
+
+            try:
+                definitions = subscript.definitions.parsers[ext](data.decode())
+            except ValueError as e:
+                raise ImportError('{} in "{}".'.format(e, path))
+
+            try:
+                os.makedirs(os.path.dirname(cache), exist_ok=True)
+                with open(cache, 'wb') as file:
+                    marshal.dump(definitions, file)
+            except OSError:
+                pass
+            return definitions
+
+        return self._cached(self._definitions, path, load)
+
+# Shared by compiles that don't bring their own
+default = Resolver()
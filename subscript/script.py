@@ -5,6 +5,7 @@ Basic components for script files.
 import collections
 import subscript.datatypes
 import subscript.config
+import subscript.profiler
 import json
 import inspect
 
@@ -13,31 +14,51 @@ class Script(object):
     Represents a script - a collection of sections.
     '''
 
-    def __init__(self, start, path):
+    def __init__(self, start, path=None, code=None):
         '''
-        Create a new script.
+        Create a new script. If no ROM path is given, the script is not
+        attached to any ROM.
+        :param code: Game code to compile for. Read from the ROM if not given.
         '''
         self.rom = path
         self.sections = []
         self.base = start
-        Section.counter = 0
-        SectionRaw.counter = 0
+
+        # Cached (base, {section: address}), see layout()
+        self._layout = None
+
+        # Symbols of imported objects: "module.symbol" -> (section, offset)
+        self.externals = {}
+
+        # Number of sections of each kind, for naming them
+        self.counters = collections.Counter()
 
         # State variables. Functions can store data here
         self._state = {}
 
-        self.config = subscript.config.RomConfig()
+        # Set by the compiler when profiling
+        self.profiler = subscript.profiler.null
+
+        # Counters for compile metrics
+        self.stats = collections.Counter()
 
-        with open(self.rom, 'rb') as file:
-            file.seek(0xAC)
+        # Keep readable copies of data. Set by the compiler.
+        self.debug = True
+        # (line, column) of the statement being compiled
+        self.position = None
 
-            # Code is in ASCII, but UTF-8 is ASCII compatible
-            self._code = file.read(4).decode()
+        self.config = subscript.config.RomConfig()
+
+        self._code = code
+        if self.rom and not code:
+            self._code = self.config.detect(self.rom)
+            self.stats['rom_reads'] += 1
 
     def add(self, value=None):
         '''
         Create a new section and add it to the list.
         '''
+        self._layout = None
         if value == None:
             section = Section(self)
             self.sections.append(section)
@@ -46,15 +67,61 @@ class Script(object):
             self.sections.append(value)
             return value
 
+    def remove(self, section):
+        '''
+        Remove a section that nothing points to any more.
+        '''
+        self.sections.remove(section)
+        self._layout = None
+
+    def layout(self):
+        '''
+        Return a dictionary mapping every section to its address. All the
+        addresses are worked out in a single pass, and kept until a section is
+        added or grows, or the base is moved.
+        '''
+        if self._layout == None or self._layout[0] != self.base:
+            addresses = {}
+            address = self.base
+            for section in self.sections:
+                addresses[section] = address
+                address += section.size
+            self._layout = (self.base, addresses)
+        return self._layout[1]
+
     def compile(self):
         for section in self.sections:
             print(section)
 
+    def reuse(self, index):
+        '''
+        Point raw sections at identical data that already exists in the ROM,
+        instead of inserting another copy. Returns the sections that were
+        reused.
+        :param index: A subscript.content.ContentIndex for the ROM.
+        '''
+        reused = []
+        for section in self.sections:
+            if type(section) != SectionRaw:
+                continue
+
+            offset = index.find(section.data)
+            if offset != None:
+                section.address = offset + 0x08000000
+                reused.append(section)
+
+        self.stats['reused'] += len(reused)
+
+        # Reused sections are no longer part of the output
+        self.sections = [s for s in self.sections if s.address == None]
+        self._layout = None
+        return reused
+
     @property
     def code(self):
         '''
         Return the 4 character game code for the GBA ROM that this script is
-        attached to.
+        attached to, or None if it isn't supported.
         '''
         return self._code
 
@@ -64,7 +131,7 @@ class Script(object):
         Return the scripting language that this ROM uses. Used to allow for syntax
         or semantic differences in each ROM.
         '''
-        return self.config[self._code]['language']
+        return self.config[self._code].language
 
     @property
     def state(self):
@@ -95,17 +162,22 @@ class Section(object):
     Represents a code section - a sequence of commands referenced by a dynamic
     pointer.
     '''
-    counter = 0
 
     def __init__(self, parent):
         '''
         Constructor.
         '''
         self.commands = []
+        # Offset of every command from the start of the section
+        self._offsets = []
         self._size = 0
         self._parent = parent
-        self.name = type(self).__name__ + str(self.__class__.counter)
-        self.__class__.counter += 1
+
+        # Fixed location, for sections that live outside the script
+        self.address = None
+        kind = type(self).__name__
+        self.name = kind + str(parent.counters[kind])
+        parent.counters[kind] += 1
 
     def append(self, command):
         '''
@@ -116,10 +188,33 @@ class Section(object):
                 self.append(item)
         else:
             try:
-                self._size += len(command)
+                size = len(command)
             except AttributeError:
                 raise TypeError
+            self._offsets.append(self._size)
+            self._size += size
             self.commands.append(command)
+            self._parent._layout = None
+            if self._parent.position and command.source == None:
+                command.source = self._parent.position
+
+    def replace(self, commands):
+        '''
+        Replace every command in this section.
+        '''
+        self.commands = []
+        self._offsets = []
+        self._size = 0
+        self._parent._layout = None
+        self.append(list(commands))
+
+    def offset(self, index):
+        '''
+        Return the number of bytes taken by the first `index` commands.
+        '''
+        if index < len(self._offsets):
+            return self._offsets[index]
+        return self._size
 
     def last(self):
         '''
@@ -167,6 +262,9 @@ class Command(object):
     with open('tables/commands.json') as file:
         commands = json.load(file)
 
+    # (line, column) of the statement the command was compiled from
+    source = None
+
     def __init__(self, name, args):
         self.name = name
         self.args = args
@@ -230,25 +328,24 @@ class Command(object):
 
         return cls(name, out)
 
-    def __str__(self):
-        out = self.name
-        for arg in self.args:
-            if str(arg).isdigit():
-                a = int(str(arg))
-                if a <= 0xFF:
-                    out += ' 0x{:02x}'.format(a)
-                elif a <= 0xFFFF:
-                    out += ' 0x{:04x}'.format(a)
-                elif a <= 0xFFFFFF:
-                    out += ' 0x{:06x}'.format(a)
-                elif a <= 0xFFFFFFFF:
-                    out += ' 0x{:08x}'.format(a)
-                else:
-                    out += ' 0x{:x}'.format(a)
-            else:
-                out += ' {}'.format(arg)
+    @staticmethod
+    def argument(arg, resolve=False):
+        '''
+        Format a single argument. Numbers are shown in hex, padded to a whole
+        number of bytes. Dynamic pointers are shown by name unless `resolve` is
+        set, in which case their address is shown.
+        '''
+        named = (subscript.datatypes.DynamicPointer, subscript.datatypes.SymbolPointer)
+        if not resolve and isinstance(arg, named):
+            return str(arg)
 
-        return out
+        value = arg.value
+        if type(value) != int or value < 0:
+            return str(arg)
+        return '0x{:0{}x}'.format(value, max(2, (value.bit_length() + 7) // 8 * 2))
+
+    def __str__(self):
+        return ' '.join([self.name] + [self.argument(arg) for arg in self.args])
 
     def __repr__(self):
         return 'Command("{}")'.format(str(self))
@@ -0,0 +1,356 @@
+'''
+Compile daemon. Keeps compile sessions warm for each ROM, so editors, the
+GUI and build scripts can compile without paying for start up, table loading
+and import resolution every time.
+
+Clients connect to a Unix socket or a localhost TCP port, and send one JSON
+request per line. Only loopback addresses can be listened on, since a
+compile runs the Python modules a script imports. Every request gets one
+JSON response line back, with the same "id"::
+
+    {"id": 1, "method": "compile", "params": {"source": "message('Hi')", "rom": "hack.gba"}}
+    {"id": 1, "result": {"size": 16, "bytecode": "...", "diagnostics": []}}
+
+    {"id": 2, "method": "nosuch"}
+    {"id": 2, "error": "Unknown method \"nosuch\""}
+
+Methods:
+
+compile
+    Compile "source", or the file at "path". Optional "rom", "offset"
+    (0x740000 by default), "code", "mode", "prefer", "optimize" and
+    "listing" (a format of subscript.listing). Imports are looked for in the
+    search path the daemon was started with. Returns the diagnostics, and
+    the size, bytecode (hex), game code and timings if there were no errors.
+disassemble
+    Decode the commands at "offset" in "rom", or in "data" (hex) placed at
+    "offset", until the script ends or "limit" commands were read.
+lookup
+    With "address", the statement that a command of the last compile of
+    "path" in the "rom" session came from. With "line", the addresses of
+    the commands compiled from it. With "table" and "value", the number of a
+    name in a table of the ROM, or the name of a number.
+ping
+    Returns "pong".
+shutdown
+    Stops the daemon once the response is sent.
+'''
+
+import asyncio
+import collections
+import ipaddress
+import json
+import os
+import socket
+import struct
+import subscript.compile
+import subscript.config
+import subscript.langtypes
+import subscript.resolver
+import subscript.script
+
+# Commands after which a script never carries on
+ends = ['end', 'return', 'goto']
+
+# Longest request line accepted, so a whole script fits in one
+limit = 16 * 1024 * 1024
+
+class RequestError(Exception):
+    pass
+
+def disassemble(data, base, limit=256):
+    '''
+    Return a list of (address, command) for the commands at the start of
+    `data`, up to the end of the script or the first thing that isn't a
+    command, such as the text of a message that follows it.
+    :param base: Address of the first byte of `data`.
+    '''
+    out = []
+    position = 0
+    while position < len(data) and len(out) < limit:
+        try:
+            command = subscript.script.Command.decompile(data[position:])
+        except (StopIteration, ValueError, struct.error):
+            if not out:
+                raise RequestError('No command at 0x{:08X}'.format(base + position))
+            break
+
+        out.append((base + position, command))
+        position += command.size
+        if command.name in ends:
+            break
+    return out
+
+class Session(object):
+    '''
+    Everything kept between compiles for one ROM and search path.
+    '''
+
+    def __init__(self, rom, search):
+        self.rom = rom
+        self.resolver = subscript.resolver.Resolver(search)
+        self.config = subscript.config.RomConfig()
+        self.code = self.config.detect(rom) if rom else None
+        # Source path -> the source map of its last compile
+        self.sourcemaps = {}
+        # Table lookups are made through the session as if it were a
+        # script, so it counts its ROM reads the same way
+        self.stats = collections.Counter()
+        # Compiles of a session run one at a time, since they share a resolver
+        self.lock = asyncio.Lock()
+
+    def compile(self, params):
+        if 'source' in params:
+            source = params['source']
+        elif 'path' in params:
+            with open(params['path']) as file:
+                source = file.read()
+        else:
+            raise RequestError('compile needs "source" or "path"')
+
+        # Pick up any imports that were edited since the last compile
+        self.resolver.refresh()
+
+        offset = params.get('offset', subscript.compile.default_offset)
+        c = subscript.compile.Compile(source, offset + 0x08000000, self.rom,
+            path=params.get('path'),
+            resolver=self.resolver,
+            optimize=params.get('optimize', True),
+            prefer=params.get('prefer', 'speed'),
+            mode=params.get('mode', 'debug'),
+            recover=True,
+            code=params.get('code', self.code))
+
+        out = {'diagnostics': c.diagnostics()}
+        if c.errors:
+            return out
+
+        data = c.bytecode()
+        self.sourcemaps[params.get('path')] = c.sourcemap()
+        out['size'] = len(data)
+        out['bytecode'] = data.hex()
+        out['code'] = c.script.code
+        out['timings'] = c.timings
+        if 'listing' in params:
+            out['listing'] = list(c.listing(params['listing']))
+        return out
+
+    def lookup(self, params):
+        if 'table' in params:
+            if not self.rom:
+                raise RequestError('Tables need a ROM')
+            table = subscript.langtypes.Table.lookup(self, params['table'])
+            try:
+                return table[params['value']]
+            except (KeyError, IndexError):
+                raise RequestError('No {} "{}"'.format(params['table'], params['value']))
+
+        try:
+            sourcemap = self.sourcemaps[params.get('path')]
+        except KeyError:
+            raise RequestError('Nothing was compiled from "{}"'.format(params.get('path')))
+
+        if 'address' in params:
+            found = sourcemap.lookup(params['address'])
+            if found == None:
+                return None
+            line, column, section = found
+            return {'line': line, 'column': column, 'section': section}
+        return sourcemap.addresses(params['line'])
+
+class Server(object):
+    '''
+    Handles requests, keeping a Session for every ROM asked for.
+    '''
+
+    def __init__(self, search=None):
+        '''
+        Constructor.
+        :param search: Directories to look for imports in. Requests can't
+            add their own, or any client could run code from anywhere.
+        '''
+        self.search = list(search) if search else []
+        self.sessions = {}
+        self.stopped = None
+        self.methods = {
+            'compile': self._compile,
+            'disassemble': self._disassemble,
+            'lookup': self._lookup,
+            'ping': self._ping,
+            'shutdown': self._shutdown,
+        }
+
+    def session(self, params):
+        rom = params.get('rom')
+        if rom:
+            rom = os.path.abspath(rom)
+        if rom not in self.sessions:
+            self.sessions[rom] = Session(rom, self.search)
+        return self.sessions[rom]
+
+    async def handle(self, line):
+        '''
+        Return the response line to a request line. Anything a method raises
+        is answered as an error of that request.
+        '''
+        try:
+            request = json.loads(line.decode())
+        except ValueError:
+            return json.dumps({'id': None, 'error': 'Request is not JSON'})
+
+        if type(request) != dict:
+            return json.dumps({'id': None, 'error': 'Request is not an object'})
+
+        response = {'id': request.get('id')}
+        method = request.get('method')
+        if type(method) != str or method not in self.methods:
+            response['error'] = 'Unknown method "{}"'.format(method)
+            return json.dumps(response)
+
+        try:
+            response['result'] = await self.methods[method](request.get('params', {}))
+        except RequestError as e:
+            response['error'] = str(e)
+        except KeyError as e:
+            response['error'] = 'Missing parameter "{}"'.format(e.args[0])
+        except Exception as e:
+            response['error'] = str(e) or type(e).__name__
+        return json.dumps(response)
+
+    async def _compile(self, params):
+        session = self.session(params)
+        async with session.lock:
+            # Compiles are run in a thread, so cheap requests are still
+            # answered while one runs
+            return await asyncio.get_event_loop().run_in_executor(None, session.compile, params)
+
+    async def _disassemble(self, params):
+        offset = params['offset']
+        count = params.get('limit', 256)
+        if 'data' in params:
+            data = bytes.fromhex(params['data'])
+        else:
+            # No script is longer than this
+            with open(params['rom'], 'rb') as file:
+                file.seek(offset)
+                data = file.read(count * 16)
+
+        return [{
+            'address': address,
+            'command': command.name,
+            'args': [arg.value for arg in command.args],
+            'size': command.size,
+        } for address, command in disassemble(data, offset + 0x08000000, count)]
+
+    async def _lookup(self, params):
+        session = self.session(params)
+        async with session.lock:
+            return session.lookup(params)
+
+    async def _ping(self, params):
+        return 'pong'
+
+    async def _shutdown(self, params):
+        self.stopped.set_result(None)
+        return None
+
+    async def client(self, reader, writer):
+        '''
+        Answer the requests of one connection, in order.
+        '''
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    writer.write(json.dumps({'id': None, 'error': 'Request is too long'}).encode() + b'\n')
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+
+                writer.write((await self.handle(line)).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, address):
+        '''
+        Start listening on `address`: a path for a Unix socket, or
+        "host:port". Raises ValueError if the host isn't a loopback address.
+        '''
+        host, port = split(address)
+        if port != None and not loopback(host):
+            raise ValueError('Can only listen on a loopback address, not "{}"'.format(host))
+
+        self.stopped = asyncio.get_event_loop().create_future()
+        if port == None:
+            if os.path.exists(host):
+                os.remove(host)
+            return await asyncio.start_unix_server(self.client, host, limit=limit)
+        return await asyncio.start_server(self.client, host, port, limit=limit)
+
+def split(address):
+    '''
+    Return the (host, port) of a "host:port" address, or (path, None) for a
+    Unix socket.
+    '''
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and '/' not in address:
+        # IPv6 addresses are written in brackets, e.g. [::1]:8000
+        return host.strip('[]'), int(port)
+    return address, None
+
+def loopback(host):
+    '''
+    Return whether `host` can only be reached from this machine.
+    '''
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def serve(address, search=None):
+    '''
+    Run a daemon on `address` until it is asked to shut down.
+    '''
+    loop = asyncio.get_event_loop()
+    server = Server(search)
+    listener = loop.run_until_complete(server.start(address))
+    try:
+        loop.run_until_complete(server.stopped)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        host, port = split(address)
+        if port == None and os.path.exists(host):
+            os.remove(host)
+
+def request(address, method, params=None):
+    '''
+    Send a single request to the daemon at `address`, and return its result.
+    Raises RequestError if it failed.
+    :param params: Dictionary of the method's parameters.
+    '''
+    host, port = split(address)
+    if port == None:
+        connection = socket.socket(socket.AF_UNIX)
+        connection.connect(host)
+    else:
+        connection = socket.create_connection((host, port))
+
+    with connection, connection.makefile('rwb') as file:
+        file.write(json.dumps({'id': 1, 'method': method, 'params': params if params else {}}).encode() + b'\n')
+        file.flush()
+        response = json.loads(file.readline().decode())
+
+    if 'error' in response:
+        raise RequestError(response['error'])
+    return response['result']
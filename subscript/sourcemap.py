@@ -0,0 +1,140 @@
+'''
+Source maps. A source map links the address of every compiled command back to
+the line and column of the statement it was compiled from, so debuggers,
+profilers and crash reports can show .sub lines instead of ROM addresses.
+
+Entries are kept in flat arrays sorted by address, so looking up an address is
+a binary search. On disk they are JSON, with the offsets and lines stored as
+the difference from the previous entry::
+
+    {
+        "version": 1,
+        "source": "scripts/nurse.sub",
+        "base": 141885440,
+        "sections": ["Section0", "Section1"],
+        "offsets": [0, 6, 5],
+        "sizes": [6, 5, 10],
+        "lines": [1, 0, 2],
+        "columns": [0, 0, 4],
+        "section": [0, 0, 1]
+    }
+'''
+
+import array
+import bisect
+import itertools
+import json
+import subscript.script
+
+class SourceMap(object):
+    '''
+    Maps the addresses of commands to (line, column, section) tuples.
+    '''
+
+    version = 1
+
+    # Lists that are stored as differences
+    deltas = ['offsets', 'lines']
+
+    def __init__(self, base=0x08000000, source=None):
+        '''
+        Constructor.
+        :param base: Pointer to the start of the script. Offsets are counted
+            from here, so the map moves with the script by changing it.
+        :param source: Path of the script the map is for.
+        '''
+        self.base = base
+        self.source = source
+        self.sections = []
+        self.offsets = array.array('L')
+        self.sizes = array.array('H')
+        self.lines = array.array('L')
+        self.columns = array.array('L')
+        self.section = array.array('L')
+
+    @classmethod
+    def from_sections(cls, sections, base, source=None):
+        '''
+        Create a map of sections placed one after the other from `base`, as
+        they are in a compiled script. Only commands that know which statement
+        they came from are included.
+        '''
+        out = cls(base, source)
+        position = 0
+        for section in sections:
+            if type(section) == subscript.script.Section:
+                index = None
+                for i, command in enumerate(section.commands):
+                    if command.source == None:
+                        continue
+                    if index == None:
+                        index = len(out.sections)
+                        out.sections.append(section.name)
+                    line, column = command.source
+                    out.offsets.append(position + section.offset(i))
+                    out.sizes.append(command.size)
+                    out.lines.append(line)
+                    out.columns.append(column)
+                    out.section.append(index)
+            position += section.size
+        return out
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def lookup(self, address):
+        '''
+        Return the (line, column, section) of the command that `address` is
+        part of, or None.
+        '''
+        offset = address - self.base
+        n = bisect.bisect_right(self.offsets, offset) - 1
+        if n < 0 or offset >= self.offsets[n] + self.sizes[n]:
+            return None
+        return self.lines[n], self.columns[n], self.sections[self.section[n]]
+
+    def addresses(self, line):
+        '''
+        Return the address of every command compiled from `line`, e.g. to set
+        a breakpoint on it.
+        '''
+        return [self.base + offset for offset, other in zip(self.offsets, self.lines) if other == line]
+
+    def save(self, path):
+        data = {
+            'version': self.version,
+            'source': self.source,
+            'base': self.base,
+            'sections': self.sections,
+        }
+        for name in ['offsets', 'sizes', 'lines', 'columns', 'section']:
+            values = getattr(self, name).tolist()
+            if name in self.deltas:
+                values = [b - a for a, b in zip([0] + values, values)]
+            data[name] = values
+
+        with open(path, 'w') as file:
+            json.dump(data, file, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read a map written by :meth:`save`.
+        '''
+        with open(path) as file:
+            try:
+                data = json.load(file)
+            except ValueError:
+                raise ValueError('"{}" is not a source map'.format(path))
+
+        if data.get('version') != cls.version:
+            raise ValueError('"{}" has unsupported source map version {}'.format(path, data.get('version')))
+
+        out = cls(data['base'], data['source'])
+        out.sections = data['sections']
+        for name in ['offsets', 'sizes', 'lines', 'columns', 'section']:
+            values = data[name]
+            if name in cls.deltas:
+                values = itertools.accumulate(values)
+            getattr(out, name).extend(values)
+        return out
@@ -0,0 +1,88 @@
+'''
+Multi-target compiles. A script written for several games is parsed once,
+and only lowered and linked once for each game, in parallel, giving one
+binary per game code.
+
+Targets map game codes from config/roms.json to the ROM that their tables
+are read from, or None if the script doesn't look anything up::
+
+    {'BPRE': 'firered.gba', 'BPGE': 'leafgreen.gba', 'AXVE': None}
+'''
+
+import ast
+import concurrent.futures
+import subscript.compile
+import subscript.config
+import subscript.resolver
+
+# One resolver per search path, kept for the life of a worker process
+resolvers = {}
+
+class TargetError(Exception):
+    pass
+
+def games():
+    '''
+    Return the game code of every ROM in config/roms.json.
+    '''
+    return list(subscript.config.RomConfig())
+
+def compile_target(source, tree, code, rom, base, path, search, options):
+    '''
+    Lower and link the parsed script for one game. Returns the bytecode, the
+    source map and the warnings as strings. Runs in a worker process, so only
+    picklable errors are raised.
+    '''
+    key = tuple(search) if search else ()
+    if key not in resolvers:
+        resolvers[key] = subscript.resolver.Resolver(search)
+
+    c = subscript.compile.Compile(source, base, rom, path=path, resolver=resolvers[key], recover=True, code=code, tree=tree, **options)
+    if c.errors:
+        raise TargetError('\n'.join('{}: {}:{}: {}'.format(code, path or '<script>', d['line'], d['message']) for d in c.diagnostics() if d['severity'] == 'error'))
+
+    return c.bytecode(), c.sourcemap(), [str(warning) for warning in c.warnings]
+
+def compile_all(source, base, targets, path=None, search=None, jobs=None, **options):
+    '''
+    Compile `source` for every game in `targets`. Returns a dictionary
+    mapping each game code to (bytecode, source map, warnings).
+    :param base: The offset at which every copy of the script starts.
+    :param path: Path of the source file. Imports are looked for next to it
+        first.
+    :param search: Directories to look for imports in.
+    :param jobs: Compiles to run at once. Defaults to one per processor.
+    :param options: Passed on to subscript.compile.Compile, e.g. mode.
+    '''
+    known = games()
+    for code in targets:
+        if code not in known:
+            raise TargetError('Unknown game code "{}"'.format(code))
+
+    # Syntax errors are the same for every game, so they are raised once
+    source = source.replace('\r\n', '\n')
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        raise TargetError('{}:{}: {}'.format(path or '<script>', e.lineno, e.msg))
+
+    out = {}
+    failed = []
+    if len(targets) > 1 and jobs != 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            futures = {pool.submit(compile_target, source, tree, code, rom, base, path, search, options): code for code, rom in targets.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    out[futures[future]] = future.result()
+                except TargetError as e:
+                    failed.append(str(e))
+    else:
+        for code, rom in targets.items():
+            try:
+                out[code] = compile_target(source, tree, code, rom, base, path, search, options)
+            except TargetError as e:
+                failed.append(str(e))
+
+    if failed:
+        raise TargetError('\n'.join(sorted(failed)))
+    return out
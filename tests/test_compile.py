@@ -0,0 +1,144 @@
+import ast
+import unittest
+import subscript.compile
+import subscript.errors
+
+def compile(source, **options):
+    return subscript.compile.Compile(source, 0x08740000, **options)
+
+def commands(c):
+    return [(command.name, [arg.value for arg in command.args]) for command in c.script.sections[0].commands]
+
+class LoopTest(unittest.TestCase):
+
+    def test_constant_as_argument(self):
+        c = compile('for n in [1, 2, 3]:\n    fanfare(n)\n')
+        self.assertEqual(commands(c), [('fanfare', [1]), ('fanfare', [2]), ('fanfare', [3])])
+
+    def test_constant_as_argument_recover(self):
+        c = compile('for n in [1, 2, 3]:\n    fanfare(n)\n', recover=True)
+        self.assertEqual(c.errors, [])
+
+    def test_constant_in_condition(self):
+        c = compile('for n in [1, 2, 3]:\n    if n == 2:\n        fanfare(n)\n', optimize=False)
+        self.assertEqual([name for name, args in commands(c)].count('goto'), 1)
+
+    def test_last_value(self):
+        # Unrolled when preferring speed, counted when preferring size
+        source = 'v = Var(0x4000)\nfor v in range(12):\n    fanfare(2)\n'
+        for prefer in ['speed', 'size']:
+            c = compile(source, prefer=prefer, optimize=False)
+            last = [args for name, args in commands(c) if name == 'setvar'][-1]
+            self.assertEqual(last, [0x4000, 11], prefer)
+
+    def test_assigned_in_body(self):
+        # The loop can't count in a variable the body changes
+        source = 'v = Var(0x4000)\nfor v in range(20):\n    v += 1\n    fanfare(2)\n'
+        for prefer in ['speed', 'size']:
+            c = compile(source, prefer=prefer, optimize=False)
+            names = [name for name, args in commands(c)]
+            self.assertEqual(names.count('fanfare'), 20, prefer)
+            self.assertNotIn('if1', names, prefer)
+
+class FunctionTest(unittest.TestCase):
+
+    def test_empty_body(self):
+        c = compile('def f():\n    pass\nf()\nfanfare(1)\n', optimize=False)
+        self.assertEqual(commands(c), [('call', [c.script.sections[1].dynamic().value]), ('fanfare', [1])])
+        self.assertEqual([command.name for command in c.script.sections[1].commands], ['return'])
+
+    def test_empty_body_recover(self):
+        c = compile('def f():\n    nosuch()\nf()\n', recover=True)
+        self.assertEqual([type(error) for error in c.errors], [subscript.errors.CompileNameError])
+
+class NameTest(unittest.TestCase):
+
+    def test_condition(self):
+        with self.assertRaises(subscript.errors.CompileNameError) as context:
+            compile('v = Var(0x4000)\nif v == nosuch:\n    fanfare(1)\n')
+        self.assertEqual(context.exception.message, 'nosuch')
+        self.assertEqual((context.exception.line, context.exception.col), (2, 8))
+
+    def test_diagnostic(self):
+        c = compile('if nosuch:\n    fanfare(1)\n', recover=True)
+        diagnostic, = c.diagnostics()
+        self.assertEqual(diagnostic['message'], 'Unknown name "nosuch"')
+        self.assertEqual((diagnostic['line'], diagnostic['column']), (1, 3))
+
+class BranchTest(unittest.TestCase):
+    header = 'v = Var(0x4000)\nw = Var(0x4001)\n'
+
+    def test_in(self):
+        c = compile(self.header + 'if v in [1, 2] and w == 1:\n    fanfare(1)\n', optimize=False)
+        self.assertEqual([(name, args[0]) for name, args in commands(c)], [
+            ('compare', 0x4000), ('if1', 1),
+            ('compare', 0x4000), ('if1', 5),
+            ('compare', 0x4001), ('if1', 1),
+        ])
+
+    def test_in_range(self):
+        c = compile(self.header + 'if v not in range(2, 5):\n    fanfare(1)\n', optimize=False)
+        target = c.script.sections[1].dynamic().value
+        self.assertEqual(commands(c), [('compare', [0x4000, 2]), ('if1', [0, target]), ('compare', [0x4000, 5]), ('if1', [4, target])])
+
+    def test_chained(self):
+        c = compile(self.header + 'if 1 < v < w:\n    fanfare(1)\n', optimize=False)
+        self.assertEqual([name for name, args in commands(c)], ['compare', 'if1', 'comparevars', 'if1'])
+
+    def test_chain_of_conditions(self):
+        # Not a switch, since the last test is of another variable
+        source = self.header + 'if v in [1, 2]:\n    fanfare(1)\nelif 10 < v <= 20:\n    fanfare(2)\nelif w == 3:\n    fanfare(3)\n'
+        c = compile(source, recover=True)
+        self.assertEqual(c.errors, [])
+
+    def test_relational_case(self):
+        source = self.header + 'if v in [1, 2]:\n    fanfare(1)\nelif v >= 50:\n    fanfare(2)\n'
+        c = compile(source)
+        var, cases, orelse = c._switch_cases(ast.parse(source).body[2])
+        self.assertEqual([ranges for ranges, body in cases], [[(1, 1), (2, 2)], [(50, 0xFFFF)]])
+
+    def test_unsupported(self):
+        with self.assertRaises(subscript.errors.CompileSyntaxError) as context:
+            compile(self.header + 'if v is 1:\n    fanfare(1)\n')
+        self.assertEqual((context.exception.line, context.exception.col), (3, 3))
+
+class ControlFlowTest(unittest.TestCase):
+    header = 'v = Var(0x4000)\nw = Var(0x4001)\n'
+
+    def returns(self, c):
+        # Where each branch goes back to when its body is done
+        return [section.commands[-1].args[0].value for section in c.script.sections[1:]
+                if section.commands and section.commands[-1].name == 'goto']
+
+    def after(self, c, number):
+        # Address of the fanfare(number) in the first section
+        section = c.script.sections[0]
+        for index, command in enumerate(section.commands):
+            if command.name == 'fanfare' and command.args[0].value == number:
+                return section.dynamic(index).value
+
+    def test_relative_pointer(self):
+        c = compile('fanfare(1)\nfanfare(2)\nfanfare(3)\n')
+        section = c.script.sections[0]
+        start = section.dynamic().value
+        self.assertEqual(section.dynamic(0).value, start)
+        self.assertEqual(section.dynamic(2).value, start + section.commands[0].size + section.commands[1].size)
+
+    def test_elif(self):
+        source = self.header + 'if v == 1:\n    fanfare(1)\nelif w == 2:\n    fanfare(2)\nelse:\n    fanfare(3)\nfanfare(4)\n'
+        c = compile(source, optimize=False)
+        self.assertEqual(self.returns(c), [self.after(c, 4)] * 3)
+
+    def test_while_in_if(self):
+        # The if carries on after the whole branch, not after the loop's test
+        source = self.header + 'if v == 1:\n    while w == 1:\n        fanfare(1)\n    fanfare(2)\nfanfare(3)\n'
+        c = compile(source, optimize=False)
+        self.assertEqual(self.returns(c)[0], self.after(c, 3))
+
+    def test_alias(self):
+        # Registry functions are given the script, which aliases pass on
+        c = compile('msgbox("Hello")\nhide(2)\n')
+        self.assertEqual([name for name, args in commands(c)], ['loadpointer', 'callstd', 'hidesprite'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,21 @@
+import os
+import tempfile
+import unittest
+import subscript.config
+
+class DetectTest(unittest.TestCase):
+
+    def detect(self, code):
+        with tempfile.NamedTemporaryFile(suffix='.gba', delete=False) as file:
+            file.write(bytes(subscript.config.header) + code + bytes(0x100))
+        self.addCleanup(os.remove, file.name)
+        return subscript.config.RomConfig().detect(file.name)
+
+    def test_header(self):
+        self.assertEqual(self.detect(b'BPRE'), 'BPRE')
+
+    def test_unknown(self):
+        self.assertEqual(self.detect(b'ZZZZ'), None)
+
+if __name__ == '__main__':
+    unittest.main()
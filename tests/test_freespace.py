@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import unittest
+import subscript.freespace
+import subscript.journal
+
+class ScanTest(unittest.TestCase):
+
+    def test_runs(self):
+        data = b'\x01' + b'\xFF' * 20 + b'\x02' * 4 + b'\xFF' * 8 + b'\x03' + b'\xFF' * 16
+        self.assertEqual(list(subscript.freespace.scan(data)), [(1, 21), (34, 50)])
+        self.assertEqual(list(subscript.freespace.scan(data, minimum=8)), [(1, 21), (25, 33), (34, 50)])
+        self.assertEqual(list(subscript.freespace.scan(data, start=5, end=40)), [(5, 21)])
+
+class FreeSpaceTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.rom = os.path.join(directory, 'rom.gba')
+        # Free blocks of 0x20 and 0x80 bytes, each after a terminator
+        with open(self.rom, 'wb') as file:
+            file.write(bytes(0x100) + b'\xFF' * 0x21 + bytes(0xDF) + b'\xFF' * 0x81)
+
+    def test_blocks(self):
+        space = subscript.freespace.FreeSpace(self.rom, 0)
+        self.assertEqual(space.blocks, [(0x101, 0x121), (0x201, 0x281)])
+        self.assertEqual(space.free, 0xA0)
+
+    def test_allocate(self):
+        space = subscript.freespace.FreeSpace(self.rom, 0)
+        self.assertEqual(space.allocate(0x10, 'a'), 0x104)
+        self.assertEqual(space.allocate(0x10, 'b'), 0x204)
+        self.assertEqual(space.owner(0x20A), (0x204, {'size': 0x10, 'name': 'b'}))
+        with self.assertRaises(MemoryError):
+            space.allocate(0x100)
+
+    def test_best_fit(self):
+        space = subscript.freespace.FreeSpace(self.rom, 0)
+        self.assertEqual(space.find(0x10, align=1, strategy='first'), 0x101)
+        self.assertEqual(space.find(0x70, align=1, strategy='best'), 0x201)
+        self.assertEqual(space.find(0x18, align=1, strategy='best'), 0x101)
+
+    def test_release(self):
+        space = subscript.freespace.FreeSpace(self.rom, 0)
+        offset = space.allocate(0x10, 'a', align=1)
+        space.release(offset)
+        self.assertEqual(space.blocks, [(0x101, 0x121), (0x201, 0x281)])
+        self.assertEqual(space.allocations, {})
+
+    def test_saved(self):
+        space = subscript.freespace.FreeSpace(self.rom, 0)
+        offset = space.allocate(0x10, 'a')
+        with open(self.rom, 'rb+') as file:
+            file.seek(offset)
+            file.write(bytes(0x10))
+        space.save()
+
+        loaded = subscript.freespace.FreeSpace(self.rom, 0)
+        self.assertEqual(loaded.blocks, space.blocks)
+        self.assertIn(offset, loaded.allocations)
+
+        # A map made for other settings is scanned again, keeping what was
+        # placed
+        other = subscript.freespace.FreeSpace(self.rom, 0x200)
+        self.assertEqual(other.blocks, [(0x200, 0x281)])
+        self.assertIn(offset, other.allocations)
+
+class FollowTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.rom = os.path.join(directory, 'rom.gba')
+        # Data in the first half, free space in the second
+        with open(self.rom, 'wb') as file:
+            file.write(bytes(range(256)) * 4 + b'\xFF' * 0x400)
+
+    def build(self, offset, data, allocated):
+        space = subscript.freespace.FreeSpace(self.rom, 0)
+        if allocated:
+            offset = space.allocate(len(data), 'script')
+        else:
+            space.reserve(offset, len(data), 'script')
+        subscript.journal.Journal(self.rom).record([(offset, data)], script='script', offset=offset, size=len(data), allocated=allocated)
+        space.save()
+        return offset
+
+    def undo(self):
+        space = subscript.freespace.FreeSpace(self.rom, 0)
+        space.follow(subscript.journal.Journal(self.rom).undo(), undo=True)
+        space.save()
+        return space
+
+    def test_allocated(self):
+        offset = self.build(None, b'\x02' * 16, True)
+        space = self.undo()
+        self.assertEqual(space.allocations, {})
+        self.assertEqual(space.find(0x400), offset)
+
+    def test_redo(self):
+        offset = self.build(None, b'\x02' * 16, True)
+        self.undo()
+        space = subscript.freespace.FreeSpace(self.rom, 0)
+        space.follow(subscript.journal.Journal(self.rom).redo())
+        self.assertEqual(space.allocations, {offset: {'size': 16, 'name': 'script'}})
+        self.assertEqual(space.find(0x400), None)
+
+    def test_offset(self):
+        self.build(0x100, b'\x02' * 16, False)
+        space = self.undo()
+        self.assertEqual(space.allocations, {})
+        # The original bytes are back, so nothing there is free
+        self.assertEqual(space.blocks, [(0x400, 0x800)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+import subscript.journal
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.rom = os.path.join(directory, 'rom.gba')
+        with open(self.rom, 'wb') as file:
+            file.write(bytes(0x100))
+
+    def read(self):
+        with open(self.rom, 'rb') as file:
+            return file.read()
+
+    def test_undo_redo(self):
+        journal = subscript.journal.Journal(self.rom)
+        journal.record([(0x10, b'\x01\x02')], script='a', offset=0x10, size=2)
+        journal.record([(0x11, b'\x03'), (0x20, b'\x04')], script='b', offset=0x20, size=1)
+        self.assertEqual(self.read()[0x10:0x12], b'\x01\x03')
+
+        self.assertEqual(journal.undo()['metadata']['script'], 'b')
+        self.assertEqual(self.read()[0x10:0x12], b'\x01\x02')
+        self.assertEqual(self.read()[0x20], 0)
+        journal.undo()
+        self.assertEqual(self.read(), bytes(0x100))
+        self.assertEqual(journal.undo(), None)
+
+        journal.redo()
+        self.assertEqual(self.read()[0x10:0x12], b'\x01\x02')
+        self.assertEqual(journal.head, 1)
+
+    def test_restore(self):
+        journal = subscript.journal.Journal(self.rom)
+        for n in range(3):
+            journal.record([(n, bytes([n + 1]))])
+        self.assertEqual(len(journal.restore(0)), 3)
+        self.assertEqual(self.read(), bytes(0x100))
+        journal.restore(2)
+        self.assertEqual(self.read()[:3], b'\x01\x02\x00')
+
+    def test_record_after_undo(self):
+        journal = subscript.journal.Journal(self.rom)
+        journal.record([(0, b'\x01')])
+        journal.record([(1, b'\x02')])
+        journal.undo()
+        self.assertEqual(journal.record([(2, b'\x03')]), 2)
+        self.assertEqual([build['build'] for build in journal.builds], [1, 2])
+
+        journal = subscript.journal.Journal(self.rom)
+        self.assertEqual([build['build'] for build in journal.builds], [1, 2])
+        journal.undo()
+        self.assertEqual(self.read()[:3], b'\x01\x00\x00')
+
+    def test_reload(self):
+        journal = subscript.journal.Journal(self.rom)
+        journal.record([(0, b'\x01')], script='a')
+        journal.record([(1, b'\x02')], script='b')
+        journal.undo()
+
+        for index in [True, False]:
+            if not index:
+                os.remove(journal.index)
+            loaded = subscript.journal.Journal(self.rom)
+            self.assertEqual(loaded.head, 1)
+            self.assertEqual([build['metadata']['script'] for build in loaded.builds], ['a', 'b'])
+            # Regions are only read when needed
+            self.assertNotIn('regions', loaded.builds[0])
+            self.assertEqual(loaded.regions(loaded.builds[1]), [(1, b'\x00', b'\x02')])
+
+    def test_shared(self):
+        # A journal that another one appended to since it was loaded
+        first = subscript.journal.Journal(self.rom)
+        second = subscript.journal.Journal(self.rom)
+        first.record([(0, b'\x01')])
+        second.record([(1, b'\x02')])
+        self.assertEqual(second.head, 2)
+        self.assertEqual(len(subscript.journal.Journal(self.rom).builds), 2)
+
+    def test_modified(self):
+        journal = subscript.journal.Journal(self.rom)
+        journal.record([(0, b'\x01')])
+        with open(self.rom, 'rb+') as file:
+            file.write(b'\x09')
+        with self.assertRaises(subscript.journal.JournalError):
+            journal.undo()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import subscript.compile
+import subscript.freespace
+import subscript.link
+
+source = '''def greet():
+    message("Hello")
+
+f = Flag(0x200)
+greet()
+if f:
+    greet()
+message("Bye")
+'''
+
+class ObjectTest(unittest.TestCase):
+
+    def test_same_as_compiled(self):
+        # A linked object holds the same bytes as a script compiled in place
+        direct = subscript.compile.Compile(source, 0x08750000).bytecode()
+        obj = subscript.compile.Compile(source, 0x08000000).object('greeting')
+        self.assertTrue(obj.relocations)
+
+        linker = subscript.link.Linker()
+        linker.add(obj, 0x750000)
+        (offset, data), = linker.link()
+        self.assertEqual(offset, 0x750000)
+        self.assertEqual(data, direct)
+        self.assertEqual(linker.symbols()['greeting.main'], 0x08750000)
+        self.assertIn('greeting.greet', linker.symbols())
+
+    def test_save(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'greeting.subo')
+
+        obj = subscript.compile.Compile(source, 0x08000000).object('greeting')
+        obj.save(path)
+        loaded = subscript.link.Object.load(path)
+        self.assertEqual(loaded.name, 'greeting')
+        self.assertEqual(loaded.relocated(0x08750000), obj.relocated(0x08750000))
+
+        with open(path, 'wb') as file:
+            file.write(b'nonsense')
+        with self.assertRaises(ValueError):
+            subscript.link.Object.load(path)
+
+class LinkerTest(unittest.TestCase):
+
+    def objects(self):
+        # a points to 4 bytes into its second section, and to the start of b
+        a = subscript.link.Object('a', [('first', bytes(8)), ('second', bytes(8))], {},
+                                  [(0, 0, 1, 4), (0, 4, 'b.main', 0)])
+        b = subscript.link.Object('b', [('only', b'\x01\x02\x03\x04')], {'main': (0, 0)})
+        return a, b
+
+    def test_link(self):
+        a, b = self.objects()
+        linker = subscript.link.Linker()
+        linker.add(a, 0x100)
+        linker.add(b, 0x200)
+        out = dict(linker.link())
+        self.assertEqual(struct.unpack_from('<II', out[0x100]), (0x08000000 + 0x100 + 8 + 4, 0x08000200))
+        self.assertEqual(out[0x200], b'\x01\x02\x03\x04')
+
+    def test_undefined(self):
+        a, b = self.objects()
+        linker = subscript.link.Linker()
+        linker.add(a, 0x100)
+        with self.assertRaises(ValueError):
+            linker.link()
+
+    def test_duplicate(self):
+        a, b = self.objects()
+        linker = subscript.link.Linker()
+        linker.add(a)
+        with self.assertRaises(ValueError):
+            linker.add(a)
+
+    def test_place(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        rom = os.path.join(directory, 'rom.gba')
+        with open(rom, 'wb') as file:
+            file.write(bytes(0x100) + b'\xFF' * 0x100)
+
+        a, b = self.objects()
+        linker = subscript.link.Linker()
+        linker.add(a)
+        linker.add(b, 0x40)
+        linker.place(subscript.freespace.FreeSpace(rom, 0))
+        # The first byte of free space is left alone, and objects are aligned
+        self.assertEqual(linker.offsets, {'a': 0x104, 'b': 0x40})
+
+if __name__ == '__main__':
+    unittest.main()
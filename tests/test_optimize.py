@@ -0,0 +1,34 @@
+import unittest
+import subscript.compile
+import subscript.optimize
+import subscript.script
+
+def compile(source):
+    return subscript.compile.Compile(source, 0x08740000, optimize=False)
+
+class SubvarTest(unittest.TestCase):
+    source = 'v = Var(0x4000)\nw = Var(0x4001)\nv = 10\nw = 3\nfanfare(1)\nif v == 7:\n    fanfare(2)\n'
+
+    def simplify(self, source, subvar):
+        c = compile(source)
+        section = c.script.sections[0]
+        # After the setvars, before the test
+        section.commands.insert(2, subscript.script.Command.create('subvar', *subvar))
+        subscript.optimize.simplify(c.script, [])
+        return [command.name for command in section.commands]
+
+    def test_variable(self):
+        # 10 - w is 7, so the test always jumps
+        self.assertEqual(self.simplify(self.source, (0x4000, 0x4001)), ['setvar', 'setvar', 'subvar', 'fanfare', 'goto'])
+
+    def test_unknown_variable(self):
+        names = self.simplify(self.source, (0x4000, 0x4002))
+        self.assertIn('compare', names)
+        self.assertIn('if1', names)
+
+    def test_word(self):
+        # 10 - 3 is 7 as well
+        self.assertEqual(self.simplify(self.source, (0x4000, 3)), ['setvar', 'setvar', 'subvar', 'fanfare', 'goto'])
+
+if __name__ == '__main__':
+    unittest.main()
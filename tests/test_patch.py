@@ -0,0 +1,162 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+import subscript.patch
+
+def apply_ips(source, patch):
+    target = bytearray(source)
+    assert patch[:5] == b'PATCH'
+    position = 5
+    while patch[position:position + 3] != b'EOF':
+        offset = struct.unpack('>I', b'\0' + patch[position:position + 3])[0]
+        size = struct.unpack('>H', patch[position + 3:position + 5])[0]
+        data = patch[position + 5:position + 5 + size]
+        position += 5 + size
+        if len(target) < offset + size:
+            target += bytes(offset + size - len(target))
+        target[offset:offset + size] = data
+    return bytes(target)
+
+def number(data, position):
+    # Variable length integer of UPS and BPS
+    value = 0
+    shift = 1
+    while True:
+        byte = data[position]
+        position += 1
+        value += (byte & 0x7F) * shift
+        if byte & 0x80:
+            return value, position
+        shift <<= 7
+        value += shift
+
+def checksums(source, target, patch):
+    crc = lambda data: struct.pack('<I', zlib.crc32(data) & 0xFFFFFFFF)
+    assert patch[-12:-8] == crc(source)
+    assert patch[-8:-4] == crc(target)
+    assert patch[-4:] == crc(patch[:-4])
+
+def apply_ups(source, patch):
+    assert patch[:4] == b'UPS1'
+    size, position = number(patch, 4)
+    assert size == len(source)
+    size, position = number(patch, position)
+    target = bytearray(source[:size] + bytes(max(size - len(source), 0)))
+
+    offset = 0
+    while position < len(patch) - 12:
+        skip, position = number(patch, position)
+        offset += skip
+        while patch[position]:
+            target[offset] ^= patch[position]
+            offset += 1
+            position += 1
+        offset += 1
+        position += 1
+
+    checksums(source, target, patch)
+    return bytes(target)
+
+def apply_bps(source, patch):
+    assert patch[:4] == b'BPS1'
+    size, position = number(patch, 4)
+    assert size == len(source)
+    size, position = number(patch, position)
+    metadata, position = number(patch, position)
+    position += metadata
+
+    target = bytearray()
+    while position < len(patch) - 12:
+        action, position = number(patch, position)
+        kind, length = action & 3, (action >> 2) + 1
+        if kind == 0:
+            target += source[len(target):len(target) + length]
+        elif kind == 1:
+            target += patch[position:position + length]
+            position += length
+        else:
+            raise ValueError('Copies are never written')
+    assert len(target) == size
+
+    checksums(source, target, patch)
+    return bytes(target)
+
+class RoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.rom = os.path.join(directory, 'rom.gba')
+
+    def round_trip(self, source, writes):
+        with open(self.rom, 'wb') as file:
+            file.write(source)
+        patch = subscript.patch.Patch(self.rom)
+        # Small chunks, so checksums are streamed over several
+        patch.chunk = 0x40
+        expected = bytearray(source)
+        for offset, data in writes:
+            patch.write(offset, data)
+            if len(expected) < offset + len(data):
+                expected += bytes(offset + len(data) - len(expected))
+            expected[offset:offset + len(data)] = data
+        expected = bytes(expected)
+
+        self.assertEqual(apply_ips(source, patch.ips()), expected)
+        self.assertEqual(apply_ups(source, patch.ups()), expected)
+        self.assertEqual(apply_bps(source, patch.bps()), expected)
+
+    def test_writes(self):
+        self.round_trip(bytes(range(256)) * 4, [(0x10, b'\xAA' * 4), (0x13, b'\xBB\xBB'), (0x200, b'\xCC' * 8)])
+
+    def test_unchanged(self):
+        # Writing what is already there changes nothing
+        self.round_trip(bytes(range(256)), [(0x10, bytes(range(0x10, 0x20)))])
+
+    def test_expanded(self):
+        self.round_trip(bytes(range(256)), [(0xF0, b'\xAA' * 0x20), (0x180, b'\xBB')])
+
+    def test_overlapping(self):
+        # Later writes win
+        self.round_trip(bytes(0x100), [(0x10, b'\x01' * 8), (0x14, b'\x02' * 8), (0x12, b'\x03')])
+
+class IPSTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.rom = os.path.join(directory, 'rom.gba')
+
+    def round_trip(self, source, writes):
+        with open(self.rom, 'wb') as file:
+            file.write(source)
+        patch = subscript.patch.Patch(self.rom)
+        expected = bytearray(source)
+        for offset, data in writes:
+            patch.write(offset, data)
+            if len(expected) < offset + len(data):
+                expected += bytes(offset + len(data) - len(expected))
+            expected[offset:offset + len(data)] = data
+        self.assertEqual(apply_ips(source, patch.ips()), bytes(expected))
+
+    def test_eof_offset(self):
+        source = bytes(range(251)) * (0x460000 // 251)
+        self.round_trip(source, [(0x454F46, b'\xAA\xBB\xCC')])
+
+    def test_eof_offset_expanded(self):
+        # The change is past the end of the ROM
+        self.round_trip(bytes(range(256)) * 4, [(0x454F46, b'\xAA\xBB\xCC')])
+
+    def test_too_large(self):
+        with open(self.rom, 'wb') as file:
+            file.write(bytes(0x100))
+        patch = subscript.patch.Patch(self.rom)
+        patch.write(0xFFFFFE, b'\x01\x02\x03')
+        with self.assertRaises(ValueError):
+            patch.ips()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import subscript.pointers
+
+class PointerIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.rom = os.path.join(directory, 'rom.gba')
+
+    def index(self, data, aligned=True):
+        with open(self.rom, 'wb') as file:
+            file.write(data)
+        return subscript.pointers.PointerIndex(self.rom, aligned)
+
+    def test_aligned(self):
+        data = bytearray(0x100)
+        struct.pack_into('<I', data, 0x10, 0x08000080)
+        struct.pack_into('<I', data, 0x21, 0x08000080)
+        index = self.index(data)
+        self.assertEqual(index.references(0x80), [(0x10, 0x80)])
+
+    def test_unaligned(self):
+        data = bytearray(0x100)
+        struct.pack_into('<I', data, 0x10, 0x08000080)
+        struct.pack_into('<I', data, 0x21, 0x08000080)
+        index = self.index(data, False)
+        self.assertEqual(index.references(0x80), [(0x10, 0x80), (0x21, 0x80)])
+
+    def test_starts_with_pointer_byte(self):
+        data = bytearray(b'\x08\x09\x08' + bytes(0xFD))
+        struct.pack_into('<I', data, 4, 0x08000040)
+        for aligned in [True, False]:
+            index = self.index(data, aligned)
+            self.assertEqual(index.references(0x40), [(4, 0x40)], aligned)
+
+    def test_outside(self):
+        data = bytearray(0x100)
+        # Past the end of the ROM, and below the ROM
+        struct.pack_into('<I', data, 0x10, 0x08000100)
+        struct.pack_into('<I', data, 0x20, 0x03000000)
+        self.assertEqual(len(self.index(data, False)), 0)
+
+    def test_range(self):
+        data = bytearray(0x100)
+        for n, target in enumerate([0x90, 0x80, 0xA0, 0x84]):
+            struct.pack_into('<I', data, n * 4, 0x08000000 + target)
+        index = self.index(data)
+        self.assertEqual(index.references(0x80, 0xA0), [(4, 0x80), (12, 0x84), (0, 0x90)])
+
+    def test_cached(self):
+        data = bytearray(0x100)
+        struct.pack_into('<I', data, 0x10, 0x08000080)
+        self.index(data)
+        index = subscript.pointers.PointerIndex(self.rom)
+        self.assertEqual(index.references(0x80), [(0x10, 0x80)])
+
+class RelocationTest(unittest.TestCase):
+
+    def test_relocate(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        rom = os.path.join(directory, 'rom.gba')
+
+        data = bytearray(0x100)
+        # A pointer to the data, and one inside it to itself
+        struct.pack_into('<I', data, 0x10, 0x08000040)
+        struct.pack_into('<I', data, 0x44, 0x08000040)
+        with open(rom, 'wb') as file:
+            file.write(data)
+
+        index = subscript.pointers.PointerIndex(rom, False)
+        with open(rom, 'rb+') as file:
+            patched = subscript.pointers.relocate(file, 0x40, 8, 0x80, index)
+            file.seek(0)
+            out = file.read()
+
+        self.assertEqual(patched, [0x10, 0x84])
+        self.assertEqual(struct.unpack_from('<I', out, 0x10)[0], 0x08000080)
+        self.assertEqual(struct.unpack_from('<I', out, 0x84)[0], 0x08000080)
+        self.assertEqual(out[0x40:0x48], b'\xFF' * 8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import asyncio
+import json
+import unittest
+import subscript.server
+
+def handle(server, request):
+    line = json.dumps(request).encode()
+    return json.loads(asyncio.get_event_loop().run_until_complete(server.handle(line)))
+
+class HandleTest(unittest.TestCase):
+
+    def test_compile(self):
+        response = handle(subscript.server.Server(), {'id': 1, 'method': 'compile', 'params': {'source': 'fanfare(1)\n'}})
+        self.assertEqual(response['id'], 1)
+        self.assertEqual(response['result']['diagnostics'], [])
+
+    def test_unexpected_error(self):
+        # The params aren't an object, so the method fails with an AttributeError
+        response = handle(subscript.server.Server(), {'id': 2, 'method': 'compile', 'params': []})
+        self.assertEqual(response['id'], 2)
+        self.assertIn('error', response)
+
+    def test_unknown_method(self):
+        response = handle(subscript.server.Server(), {'id': 3, 'method': ['compile']})
+        self.assertIn('error', response)
+
+    def test_search(self):
+        # Requests can't add directories to import from
+        server = subscript.server.Server(['scripts'])
+        handle(server, {'id': 4, 'method': 'compile', 'params': {'source': 'fanfare(1)\n', 'search': ['/tmp']}})
+        session, = server.sessions.values()
+        self.assertNotIn('/tmp', session.resolver.search)
+        self.assertIn('scripts', session.resolver.search)
+
+class AddressTest(unittest.TestCase):
+
+    def test_split(self):
+        self.assertEqual(subscript.server.split('localhost:8000'), ('localhost', 8000))
+        self.assertEqual(subscript.server.split('[::1]:8000'), ('::1', 8000))
+        self.assertEqual(subscript.server.split('/tmp/subscript.sock'), ('/tmp/subscript.sock', None))
+
+    def test_loopback(self):
+        for host in ['localhost', '127.0.0.1', '::1']:
+            self.assertTrue(subscript.server.loopback(host), host)
+        for host in ['0.0.0.0', '', '192.168.1.2', 'example.com']:
+            self.assertFalse(subscript.server.loopback(host), host)
+
+    def test_refused(self):
+        server = subscript.server.Server()
+        with self.assertRaises(ValueError):
+            asyncio.get_event_loop().run_until_complete(server.start('0.0.0.0:8000'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+import subscript.compile
+import subscript.sourcemap
+
+source = '''v = Var(0x4000)
+v = 1
+message("Hi")
+if v == 2:
+    fanfare(1)
+'''
+
+class SourceMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.c = subscript.compile.Compile(source, 0x08750000, path='test.sub', optimize=False)
+        self.map = self.c.sourcemap()
+
+    def test_lookup(self):
+        self.assertEqual(self.map.source, 'test.sub')
+        address, = self.map.addresses(2)
+        self.assertEqual(address, 0x08750000)
+        # Every byte of the command maps to its line
+        for offset in range(self.c.script.sections[0].commands[0].size):
+            self.assertEqual(self.map.lookup(address + offset)[:2], (2, 0))
+        self.assertEqual(self.map.lookup(0x08750000 - 1), None)
+        self.assertEqual(self.map.lookup(0x08750000 + len(self.c.bytecode())), None)
+
+    def test_sections(self):
+        address, = self.map.addresses(5)
+        self.assertEqual(self.map.lookup(address), (5, 4, 'Section1'))
+
+    def test_save(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'test.map.json')
+
+        self.map.save(path)
+        loaded = subscript.sourcemap.SourceMap.load(path)
+        for name in ['base', 'source', 'sections', 'offsets', 'sizes', 'lines', 'columns', 'section']:
+            self.assertEqual(getattr(loaded, name), getattr(self.map, name), name)
+
+        with open(path, 'w') as file:
+            file.write('{"version": 0}')
+        with self.assertRaises(ValueError):
+            subscript.sourcemap.SourceMap.load(path)
+
+if __name__ == '__main__':
+    unittest.main()